@@ -17,9 +17,14 @@
 # under the License.
 
 from django.apps import AppConfig
+from django.core import checks
 
 
 class Config(AppConfig):
 
     name = 'aether.sdk'
     verbose_name = 'Aether Django SDK'
+
+    def ready(self):
+        from aether.sdk.cache import check_shared_cache
+        checks.register(check_shared_cache, checks.Tags.caches)
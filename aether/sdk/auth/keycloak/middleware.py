@@ -18,8 +18,14 @@
 
 from django.contrib.auth.middleware import AuthenticationMiddleware
 from django.contrib.sessions.middleware import SessionMiddleware
+from django.utils.deprecation import MiddlewareMixin
 
-from aether.sdk.auth.keycloak.utils import check_user_token, check_gateway_token
+from aether.sdk.auth.keycloak.utils import (
+    check_gateway_token,
+    check_gateway_token_stateless,
+    check_user_token,
+    count_session_write_avoided,
+)
 
 
 class GatewayAuthenticationMiddleware(SessionMiddleware):
@@ -32,6 +38,18 @@ class GatewayAuthenticationMiddleware(SessionMiddleware):
         # checks the gateway keycloak token, if fails then forces logout
         check_gateway_token(request)
 
+    def process_response(self, request, response):
+        count_session_write_avoided(request)
+        return super(GatewayAuthenticationMiddleware, self).process_response(request, response)
+
+
+class StatelessGatewayAuthenticationMiddleware(MiddlewareMixin):
+
+    def process_request(self, request):
+        # checks the gateway keycloak token and sets the user in the request
+        # without creating or updating the session
+        check_gateway_token_stateless(request)
+
 
 class TokenAuthenticationMiddleware(AuthenticationMiddleware):
 
@@ -42,3 +60,7 @@ class TokenAuthenticationMiddleware(AuthenticationMiddleware):
 
         # checks the user keycloak token, if fails then forces logout
         check_user_token(request)
+
+    def process_response(self, request, response):
+        count_session_write_avoided(request)
+        return response
@@ -0,0 +1,112 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+import os
+import unittest
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from aether.sdk.auth.keycloak.utils import _KC_TOKEN_SESSION as TOKEN_KEY
+from aether.sdk.fake_keycloak import FakeKeycloakServer, benchmark
+from aether.sdk.tests import AetherTestCase
+from aether.sdk.utils import get_meta_http_name
+
+# the tests logging is discarded, the benchmark report goes to the standard error
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+REALM = 'testing'
+
+# number of requests per scenario, i.e.: `BENCHMARK=1000 ./scripts/test.sh`
+ITERATIONS = int(os.getenv('BENCHMARK') or 0)
+# fake keycloak server response time in seconds
+LATENCY = float(os.getenv('BENCHMARK_LATENCY', 0))
+
+
+@unittest.skipUnless(ITERATIONS, 'Set BENCHMARK to the number of requests to run.')
+class AuthMiddlewareBenchmark(AetherTestCase):
+    '''
+    Measures the full middleware chain under the different authentication modes
+    using the fake keycloak server.
+    '''
+
+    def setUp(self):
+        super(AuthMiddlewareBenchmark, self).setUp()
+
+        self.server = FakeKeycloakServer(latency=LATENCY, realms=[REALM])
+        self.server.start()
+        self.token = self.server.issue_token(REALM, 'user')
+        self.results = {}
+
+    def tearDown(self):
+        self.server.stop()
+
+        logger.info(f'Authentication middleware (latency={LATENCY}s, requests={ITERATIONS})')
+        for mode, stats in self.results.items():
+            logger.info(f'  {mode:<20} {stats["rps"]:>10} req/s'
+                        f'  p50 {stats["p50"]:>9} ms  p99 {stats["p99"]:>9} ms')
+
+        super(AuthMiddlewareBenchmark, self).tearDown()
+
+    def run_scenario(self, mode, client, url, **headers):
+        def call():
+            response = client.get(url, **headers)
+            assert response.status_code == 200, response.status_code
+
+        self.results[mode] = benchmark(call, iterations=ITERATIONS)
+        self.assertGreater(self.results[mode]['rps'], 0)
+
+    def test__auth_modes(self):
+        url = reverse('testmodel-list')
+        gateway_url = reverse('testmodel-list', kwargs={'realm': REALM})
+        gateway_header = {
+            get_meta_http_name(settings.GATEWAY_HEADER_TOKEN): self.token['access_token'],
+        }
+
+        # baseline: django session without keycloak token
+        user = get_user_model().objects.create_user(f'{REALM}__user', 'user@example.com', 'pwd')
+        client = Client()
+        client.force_login(user)
+        session = client.session
+        session[settings.REALM_COOKIE] = REALM
+        session.save()
+        self.run_scenario('session', client, url)
+
+        # keycloak token in session (refreshed in each request)
+        session[TOKEN_KEY] = self.token
+        session.save()
+        self.run_scenario('token', client, url)
+
+        # gateway token with session
+        self.run_scenario('gateway', Client(), gateway_url, **gateway_header)
+
+        # gateway token without session
+        middleware = [
+            m.replace('.GatewayAuthenticationMiddleware',
+                      '.StatelessGatewayAuthenticationMiddleware')
+            for m in settings.MIDDLEWARE
+        ]
+        with override_settings(MIDDLEWARE=middleware):
+            self.run_scenario('gateway-stateless', Client(), gateway_url, **gateway_header)
@@ -23,18 +23,48 @@ from importlib import import_module
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import RequestFactory, override_settings
+from django.core.cache import cache
+from django.test import Client, RequestFactory, override_settings
 from django.urls import reverse, resolve
 
+from prometheus_client import REGISTRY
+
 from aether.sdk.tests import AetherTestCase
+from aether.sdk.tests.fakeapp.models import TestModel
 from aether.sdk.unittest import MockResponse, UrlsTestCase
 from aether.sdk.utils import get_meta_http_name
-from aether.sdk.auth.keycloak.utils import _KC_TOKEN_SESSION as TOKEN_KEY
+from aether.sdk.auth.keycloak.utils import (
+    _KC_TOKEN_SESSION as TOKEN_KEY,
+    GatewayUser,
+    check_gateway_token_stateless,
+    check_realm,
+    check_user_token,
+    count_session_write_avoided,
+    logout_kc_stored_token,
+    logout_kc_token,
+    propagate_logout,
+    warm_realm_cache,
+)
 from aether.sdk.auth.keycloak.views import KeycloakLogoutView
 
 user_objects = get_user_model().objects
 
 
+def get_writes_avoided():
+    return REGISTRY.get_sample_value('aether_sdk_session_writes_avoided_total')
+
+
+def get_kc_requests(operation, realm, status):
+    return REGISTRY.get_sample_value(
+        'aether_sdk_keycloak_requests_total',
+        {'operation': operation, 'realm': realm, 'status': status},
+    ) or 0
+
+
+def get_logouts(status):
+    return REGISTRY.get_sample_value('aether_sdk_keycloak_logouts_total', {'status': status}) or 0
+
+
 @override_settings(
     AUTH_URL='accounts',
     KEYCLOAK_BEHIND_SCENES=True,
@@ -787,6 +817,7 @@ class KeycloakGatewayTests(UrlsTestCase):
         self.assertEqual(session.get(settings.REALM_COOKIE), REALM)
 
         # visit same page with a valid token again
+        writes_avoided = get_writes_avoided()
         with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
                         side_effect=[
                             # get userinfo from keycloak
@@ -814,6 +845,9 @@ class KeycloakGatewayTests(UrlsTestCase):
                 headers={'Authorization': f'Bearer {FAKE_TOKEN}'},
             )
 
+        # the gateway flag and the realm did not change, counted once
+        self.assertEqual(get_writes_avoided(), writes_avoided + 1)
+
         # visit any page without a valid token
         response = self.client.get(SAMPLE_URL)
         self.assertEqual(response.status_code, 403)
@@ -828,3 +862,373 @@ class KeycloakGatewayTests(UrlsTestCase):
             response = self.client.get(reverse('testmodel-list'), **{HTTP_HEADER: FAKE_TOKEN})
             self.assertEqual(response.status_code, 403)
             mock_req_4.assert_not_called()
+
+    def test_check_user_token__session_writes(self):
+        FAKE_TOKEN = {
+            'access_token': 'access-keycloak',
+            'refresh_token': 'refresh-keycloak',
+        }
+        NEW_TOKEN = {
+            'access_token': 'access-keycloak-2',
+            'refresh_token': 'refresh-keycloak-2',
+        }
+
+        engine = import_module(settings.SESSION_ENGINE)
+        store = engine.SessionStore()
+        store[TOKEN_KEY] = FAKE_TOKEN
+        store[settings.REALM_COOKIE] = 'testing'
+        store.save()
+
+        request = RequestFactory().get('/')
+        setattr(request, 'session', engine.SessionStore(store.session_key))
+
+        # same token, nothing to save
+        writes_avoided = get_writes_avoided()
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        return_value=MockResponse(status_code=200, json_data=FAKE_TOKEN)):
+            check_user_token(request)
+
+        self.assertFalse(request.session.modified)
+        count_session_write_avoided(request)
+        self.assertEqual(get_writes_avoided(), writes_avoided + 1)
+        # once per request
+        count_session_write_avoided(request)
+        self.assertEqual(get_writes_avoided(), writes_avoided + 1)
+
+        # same token but the session is modified later in the request
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        return_value=MockResponse(status_code=200, json_data=FAKE_TOKEN)):
+            check_user_token(request)
+        request.session['other'] = 'value'
+        count_session_write_avoided(request)
+        self.assertEqual(get_writes_avoided(), writes_avoided + 1)
+
+        # refreshed token, the session is saved
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        return_value=MockResponse(status_code=200, json_data=NEW_TOKEN)):
+            check_user_token(request)
+
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session[TOKEN_KEY], NEW_TOKEN)
+        count_session_write_avoided(request)
+        self.assertEqual(get_writes_avoided(), writes_avoided + 1)
+
+    def test_workflow__stateless(self):
+        FAKE_TOKEN = 'access-keycloak'
+        REALM = 'testing'
+        SAMPLE_URL = reverse('testmodel-list', kwargs={'realm': REALM})
+        HTTP_HEADER = get_meta_http_name(settings.GATEWAY_HEADER_TOKEN)
+        USERINFO = {
+            'preferred_username': 'user',
+            'given_name': 'John',
+            'family_name': 'Doe',
+            'email': 'john.doe@example.com',
+        }
+
+        middleware = [
+            m.replace('.GatewayAuthenticationMiddleware',
+                      '.StatelessGatewayAuthenticationMiddleware')
+            for m in settings.MIDDLEWARE
+        ]
+        # enforce CSRF checks like the browsers do
+        client = Client(enforce_csrf_checks=True)
+
+        with override_settings(MIDDLEWARE=middleware):
+            with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                            side_effect=[
+                                # get userinfo from keycloak
+                                MockResponse(status_code=404),
+                            ]):
+                response = client.get(SAMPLE_URL, **{HTTP_HEADER: FAKE_TOKEN})
+                self.assertEqual(response.status_code, 403)
+
+            with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                            side_effect=[
+                                # get userinfo from keycloak
+                                MockResponse(status_code=200, json_data=USERINFO),
+                            ]) as mock_req:
+                response = client.get(SAMPLE_URL, **{HTTP_HEADER: FAKE_TOKEN})
+                self.assertEqual(response.status_code, 200)
+                mock_req.assert_called_once()
+
+            # no session
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+            # the database user is needed to check if it is active
+            self.assertEqual(user_objects.filter(username='testing__user').count(), 1)
+
+            # no CSRF token is required
+            with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                            side_effect=[
+                                # get userinfo from keycloak
+                                MockResponse(status_code=200, json_data=USERINFO),
+                            ]):
+                response = client.post(SAMPLE_URL, data={'name': 'a name'},
+                                       **{HTTP_HEADER: FAKE_TOKEN})
+                self.assertEqual(response.status_code, 201, response.content)
+                self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+            # non gateway urls are not affected
+            with mock.patch('aether.sdk.auth.keycloak.utils.exec_request') as mock_req:
+                response = client.get(reverse('testmodel-list'), **{HTTP_HEADER: FAKE_TOKEN})
+                self.assertEqual(response.status_code, 403)
+                mock_req.assert_not_called()
+
+            # the users deactivated in the database are rejected
+            user_objects.filter(username='testing__user').update(is_active=False)
+            with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                            side_effect=[
+                                # get userinfo from keycloak
+                                MockResponse(status_code=200, json_data=USERINFO),
+                            ]):
+                response = client.get(SAMPLE_URL, **{HTTP_HEADER: FAKE_TOKEN})
+                self.assertEqual(response.status_code, 403)
+            user_objects.filter(username='testing__user').update(is_active=True)
+
+        # the request user can be assigned to the models
+        request = RequestFactory().post(SAMPLE_URL, **{HTTP_HEADER: FAKE_TOKEN})
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        return_value=MockResponse(status_code=200, json_data=USERINFO)):
+            check_gateway_token_stateless(request)
+
+        self.assertIsInstance(request.user, GatewayUser)
+        obj = TestModel.objects.create(name='b name', user=request.user)
+        self.assertEqual(obj.user, request.user)
+        self.assertEqual(obj.user.username, f'{REALM}__user')
+
+    def test_gateway_user(self):
+        REALM = 'testing'
+        request = RequestFactory().get(
+            reverse('testmodel-list', kwargs={'realm': REALM})
+        )
+
+        user = GatewayUser(request, {
+            'preferred_username': 'user',
+            'given_name': 'John',
+            'family_name': 'Doe',
+            'email': 'john.doe@example.com',
+        })
+        self.assertTrue(user.is_authenticated)
+        self.assertFalse(user.is_anonymous)
+        self.assertEqual(user.username, 'testing__user')
+        self.assertEqual(user.get_username(), 'testing__user')
+        self.assertEqual(str(user), 'testing__user')
+        self.assertEqual(user.first_name, 'John')
+
+        self.assertEqual(user_objects.filter(username='testing__user').count(), 0)
+
+        # database attributes
+        self.assertIsNotNone(user.pk)
+        self.assertTrue(user.is_active)
+        self.assertFalse(user.is_staff)
+        self.assertEqual(user_objects.filter(username='testing__user').count(), 1)
+        db_user = user_objects.get(username='testing__user')
+        self.assertEqual(user.pk, db_user.pk)
+        self.assertEqual(db_user.last_name, 'Doe')
+        self.assertEqual(db_user.email, 'john.doe@example.com')
+        self.assertEqual(user.groups.first().name, REALM)
+
+        # behaves like the database user
+        self.assertIsInstance(user, get_user_model())
+        self.assertEqual(user, db_user)
+        self.assertEqual(db_user, user)
+
+        obj = TestModel.objects.create(name='a', user=user)
+        self.assertEqual(obj.user_id, db_user.pk)
+        self.assertEqual(TestModel.objects.get(pk=obj.pk).user, db_user)
+
+
+@override_settings(KEYCLOAK_LOGOUT_ASYNC=True)
+@mock.patch('aether.sdk.auth.keycloak.utils.sleep')
+class KeycloakLogoutTests(AetherTestCase):
+
+    def test__propagate_logout(self, *args):
+        REALM = 'testing'
+        LOGOUT_CALL = mock.call(
+            method='post',
+            url=f'{settings.KEYCLOAK_SERVER_URL}/{REALM}/protocol/openid-connect/logout',
+            data={
+                'client_id': settings.KEYCLOAK_CLIENT_ID,
+                'refresh_token': 'refresh-keycloak',
+            },
+        )
+        queued = get_logouts('queued')
+        success = get_logouts('success')
+        retry = get_logouts('retry')
+
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        side_effect=[
+                            MockResponse(status_code=500),
+                            MockResponse(status_code=204),
+                        ]) as mock_req:
+            future = propagate_logout(REALM, 'refresh-keycloak')
+            self.assertTrue(future.result(timeout=5))
+            mock_req.assert_has_calls([LOGOUT_CALL, LOGOUT_CALL])
+
+        self.assertEqual(get_logouts('queued'), queued + 1)
+        self.assertEqual(get_logouts('success'), success + 1)
+        self.assertEqual(get_logouts('retry'), retry + 1)
+
+    def test__propagate_logout__sync(self, mock_sleep):
+        with override_settings(KEYCLOAK_LOGOUT_ASYNC=False), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                           return_value=MockResponse(status_code=500)) as mock_req:
+            self.assertFalse(propagate_logout('testing', 'refresh-keycloak'))
+            # not retried, the request is not blocked
+            mock_req.assert_called_once()
+            mock_sleep.assert_not_called()
+
+    def test__propagate_logout__rq(self, *args):
+        mock_rq = mock.MagicMock()
+        mock_redis = mock_rq.get_connection.return_value
+        with override_settings(SCHEDULER_REQUIRED=True), \
+                mock.patch.dict('sys.modules', {'django_rq': mock_rq}), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request') as mock_req:
+            propagate_logout('testing', 'refresh-keycloak')
+            mock_req.assert_not_called()
+
+        # the token is not included in the job arguments
+        mock_rq.enqueue.assert_called_once()
+        func, realm, key = mock_rq.enqueue.call_args.args
+        self.assertEqual((func, realm), (logout_kc_stored_token, 'testing'))
+        self.assertNotIn('refresh-keycloak', key)
+        mock_redis.set.assert_called_once_with(key, 'refresh-keycloak', ex=3600)
+
+        pipe = mock_redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [b'refresh-keycloak', 1]
+        with mock.patch.dict('sys.modules', {'django_rq': mock_rq}), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                           return_value=MockResponse(status_code=204)) as mock_req:
+            self.assertTrue(logout_kc_stored_token(realm, key))
+            self.assertEqual(mock_req.call_args.kwargs['data']['refresh_token'], 'refresh-keycloak')
+        pipe.get.assert_called_once_with(key)
+        pipe.delete.assert_called_once_with(key)
+
+        # expired
+        failure = get_logouts('failure')
+        pipe.execute.return_value = [None, 0]
+        with mock.patch.dict('sys.modules', {'django_rq': mock_rq}), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request') as mock_req:
+            self.assertFalse(logout_kc_stored_token(realm, key))
+            mock_req.assert_not_called()
+        self.assertEqual(get_logouts('failure'), failure + 1)
+
+    def test__logout_kc_token__failure(self, mock_sleep):
+        failure = get_logouts('failure')
+
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        return_value=MockResponse(status_code=500)) as mock_req:
+            self.assertFalse(logout_kc_token('testing', 'refresh-keycloak'))
+            self.assertEqual(mock_req.call_count, settings.KEYCLOAK_LOGOUT_RETRIES)
+
+        self.assertEqual(mock_sleep.call_count, settings.KEYCLOAK_LOGOUT_RETRIES - 1)
+        self.assertEqual(get_logouts('failure'), failure + 1)
+
+
+@override_settings(KEYCLOAK_REALM_TTL=60, KEYCLOAK_REALM_NEGATIVE_TTL=10)
+class KeycloakRealmCacheTests(AetherTestCase):
+
+    def setUp(self):
+        super(KeycloakRealmCacheTests, self).setUp()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        super(KeycloakRealmCacheTests, self).tearDown()
+
+    def test__check_realm(self):
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        side_effect=[
+                            MockResponse(status_code=204),
+                            MockResponse(status_code=404),
+                        ]) as mock_req:
+            check_realm('testing')
+            check_realm('testing')  # cached
+            mock_req.assert_called_once_with(
+                method='head',
+                url=f'{settings.KEYCLOAK_SERVER_URL}/testing/account',
+            )
+
+            with self.assertRaises(Exception):
+                check_realm('fake realm')
+            with self.assertRaises(ValueError):
+                check_realm('fake realm')  # cached
+            self.assertEqual(mock_req.call_count, 2)
+
+    def test__check_realm__metrics(self):
+        ok = get_kc_requests('realm', 'testing', '204')
+        not_found = get_kc_requests('realm', '-', '404')
+        error = get_kc_requests('realm', 'testing', 'error')
+
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        side_effect=[
+                            MockResponse(status_code=204),
+                            MockResponse(status_code=404),
+                            ConnectionError(),
+                        ]):
+            check_realm('testing')
+            with self.assertRaises(Exception):
+                check_realm('fake')
+            cache.clear()
+            with self.assertRaises(ConnectionError):
+                check_realm('testing')
+
+        self.assertEqual(get_kc_requests('realm', 'testing', '204'), ok + 1)
+        # the unknown realms are not labeled
+        self.assertEqual(get_kc_requests('realm', '-', '404'), not_found + 1)
+        self.assertEqual(get_kc_requests('realm', 'fake', '404'), 0)
+        self.assertEqual(get_kc_requests('realm', 'testing', 'error'), error + 1)
+        self.assertIsNotNone(REGISTRY.get_sample_value(
+            'aether_sdk_keycloak_request_duration_seconds_count',
+            {'operation': 'realm', 'realm': 'testing'},
+        ))
+
+    def test__check_realm__not_cached(self):
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                        side_effect=[
+                            MockResponse(status_code=500),
+                            MockResponse(status_code=204),
+                        ]) as mock_req:
+            with self.assertRaises(Exception):
+                check_realm('testing')
+            check_realm('testing')
+            self.assertEqual(mock_req.call_count, 2)
+
+        with override_settings(KEYCLOAK_REALM_NEGATIVE_TTL=0), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                           return_value=MockResponse(status_code=404)) as mock_req:
+            for _ in range(2):
+                with self.assertRaises(Exception):
+                    check_realm('fake')
+            self.assertEqual(mock_req.call_count, 2)
+
+    def test__warm_realm_cache(self):
+        warm_realm_cache()
+        warm_realm_cache(['testing'])
+
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request') as mock_req:
+            check_realm(settings.DEFAULT_REALM)
+            check_realm('testing')
+            mock_req.assert_not_called()
+
+    @mock.patch('aether.sdk.auth.keycloak.utils._KC_REALMS_WARMED', False)
+    def test__warm_realm_cache__lazy(self):
+        # warmed in the first check, not at start up
+        with mock.patch('aether.sdk.auth.keycloak.utils.exec_request') as mock_req, \
+                mock.patch('aether.sdk.auth.keycloak.utils.list_realms',
+                           return_value={settings.DEFAULT_REALM, 'testing'}) as mock_list:
+            check_realm('testing')
+            check_realm(settings.DEFAULT_REALM)
+            mock_req.assert_not_called()
+            mock_list.assert_called_once()
+
+        # only once, the database might not be available
+        cache.clear()
+        with mock.patch('aether.sdk.auth.keycloak.utils._KC_REALMS_WARMED', False), \
+                mock.patch('aether.sdk.auth.keycloak.utils.exec_request',
+                           return_value=MockResponse(status_code=204)) as mock_req, \
+                mock.patch('aether.sdk.auth.keycloak.utils.list_realms',
+                           side_effect=Exception) as mock_list:
+            check_realm('testing')
+            check_realm('other')
+            self.assertEqual(mock_req.call_count, 2)
+            mock_list.assert_called_once()
@@ -16,24 +16,56 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import logging
+import threading
 import urllib.parse
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
 
 from django.conf import settings
 from django.contrib.auth import login, logout
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
 from django.dispatch import receiver
 from django.middleware.csrf import CSRF_SESSION_KEY
 from django.urls import reverse
-
-from aether.sdk.auth.utils import get_or_create_user
-from aether.sdk.cache import cache_wrap
-from aether.sdk.multitenancy.utils import get_current_realm
+from django.utils.functional import SimpleLazyObject
+
+from aether.sdk.auth.utils import get_or_create_user, parse_username
+from aether.sdk.cache import cache_wrap, safe_cache_call
+from aether.sdk.metrics import (
+    KEYCLOAK_LOGOUTS,
+    KEYCLOAK_REQUEST_LATENCY,
+    KEYCLOAK_REQUESTS,
+    SESSION_WRITES_AVOIDED,
+)
+from aether.sdk.multitenancy.utils import (
+    get_current_realm,
+    get_path_realm,
+    list_realms,
+    set_current_realm,
+)
 from aether.sdk.utils import find_in_request_headers, request as exec_request
 
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.LOGGING_LEVEL)
 
 _KC_TOKEN_SESSION = '__keycloak__token__session__'
 _KC_URL = settings.KEYCLOAK_SERVER_URL
 _KC_OID_URL = 'protocol/openid-connect'
+_KC_REALM_CACHE_KEY = 'aether-sdk:keycloak:realm:{}'
+_KC_LOGOUT_TOKEN_KEY = 'aether-sdk:keycloak:logout:{}'
+_KC_LOGOUT_TOKEN_TTL = 60 * 60  # 1 hour
+
+# the known realms are added to the cache in the first realm check
+_KC_REALMS_WARMED = False
+
+# background workers to propagate the logout to keycloak server
+_KC_LOGOUT_POOL = None
+_KC_LOGOUT_POOL_LOCK = threading.Lock()
 
 
 def get_realm_auth_url(request):
@@ -52,12 +84,74 @@ def get_realm_auth_url(request):
 def check_realm(realm):
     '''
     Checks if the realm name is valid visiting its keycloak server login page.
+
+    The result is kept in the cache, the existing realms for
+    ``settings.KEYCLOAK_REALM_TTL`` seconds and the missing ones for
+    ``settings.KEYCLOAK_REALM_NEGATIVE_TTL`` seconds.
+    Keycloak server errors are never cached.
+
+    The first check of the process adds the known realms to the cache.
     '''
 
-    response = exec_request(method='head', url=f'{_KC_URL}/{realm}/account')
+    key = _get_realm_cache_key(realm)
+    exists = safe_cache_call(cache.get, key)
+    if exists is None and _warm_realm_cache_once():
+        exists = safe_cache_call(cache.get, key)
+    if exists is not None:
+        if not exists:
+            raise ValueError(f'Realm "{realm}" does not exist')
+        return
+
+    response = _kc_request('realm', realm, method='head', url=f'{_KC_URL}/{realm}/account')
+    if response.status_code < 500:
+        exists = response.status_code < 400
+        ttl = settings.KEYCLOAK_REALM_TTL if exists else settings.KEYCLOAK_REALM_NEGATIVE_TTL
+        if ttl > 0:
+            safe_cache_call(cache.set, key, exists, ttl)
     response.raise_for_status()
 
 
+def warm_realm_cache(realms=None):
+    '''
+    Marks the given realms, by default the known ones, as existing realms
+    in the cache so the login forms do not need to check them.
+    '''
+
+    if settings.KEYCLOAK_REALM_TTL <= 0:
+        return
+
+    if realms is None:
+        realms = list_realms()
+
+    safe_cache_call(
+        cache.set_many,
+        {_get_realm_cache_key(realm): True for realm in realms},
+        settings.KEYCLOAK_REALM_TTL,
+    )
+
+
+def _warm_realm_cache_once():
+    '''
+    Adds the known realms to the cache only the first time, lazily,
+    instead of at start up (management commands, empty databases...).
+
+    Returns ``True`` if the cache was warmed.
+    '''
+
+    global _KC_REALMS_WARMED
+
+    if _KC_REALMS_WARMED:
+        return False
+    _KC_REALMS_WARMED = True
+
+    try:
+        warm_realm_cache()
+        return True
+    except Exception as e:
+        logger.warning(f'Could not warm up the realm cache: {str(e)}')
+        return False
+
+
 def authenticate(request, username, password, realm):
     '''
     Logs in in the keycloak server with the given username, password and realm.
@@ -77,7 +171,7 @@ def authenticate(request, username, password, realm):
         return None
 
     # save the current realm in the session
-    request.session[settings.REALM_COOKIE] = realm
+    set_current_realm(request, realm)
     # save the user token in the session
     request.session[_KC_TOKEN_SESSION] = token
     request.session.modified = True
@@ -124,17 +218,18 @@ def check_user_token(request):
         response = refresh_kc_token(realm, token)
         try:
             response.raise_for_status()
-            request.session[_KC_TOKEN_SESSION] = response.json()
-            request.session.modified = True
+            _set_session_value(request, _KC_TOKEN_SESSION, response.json())
         except Exception:
             logout(request)
 
 
 # memoize (realm token pairs for TTL set by USER_TOKEN_TTL)
 # TTL must be longer than Token validity
-@cache_wrap(timeout=settings.USER_TOKEN_TTL)
+@cache_wrap(timeout=settings.USER_TOKEN_TTL, lock=True)
 def refresh_kc_token(realm, token):
-    return exec_request(
+    return _kc_request(
+        'refresh',
+        realm,
         method='post',
         url=f'{_KC_URL}/{realm}/{_KC_OID_URL}/token',
         data={
@@ -157,9 +252,8 @@ def check_gateway_token(request):
             userinfo = _get_user_info(realm, token)
 
             # flags that we are using the gateway to authenticate
-            request.session[settings.GATEWAY_HEADER_TOKEN] = True
-            request.session[settings.REALM_COOKIE] = realm
-            request.session.modified = True
+            _set_session_value(request, settings.GATEWAY_HEADER_TOKEN, True)
+            _set_session_value(request, settings.REALM_COOKIE, realm)
 
             user = _get_or_create_user(request, userinfo)
             # only login if the user changed otherwise it will refresh the Csrf
@@ -188,6 +282,70 @@ def check_gateway_token(request):
         logout(request)
 
 
+def check_gateway_token_stateless(request):
+    '''
+    Checks if the gateway token is valid fetching the user info from keycloak server
+    without using the session.
+
+    The request user is built with the token claims and the database user
+    is only fetched when any other attribute is requested.
+    '''
+
+    token = find_in_request_headers(request, settings.GATEWAY_HEADER_TOKEN)
+    # only the gateway urls are protected by the gateway token
+    realm = get_path_realm(request)
+    if not token or not realm or realm == settings.GATEWAY_PUBLIC_REALM:
+        return
+
+    try:
+        userinfo = _get_user_info(realm, token)
+    except Exception:
+        # something went wrong
+        request.user = AnonymousUser()
+        return
+
+    request.user = GatewayUser(request, userinfo)
+    # the token is not sent automatically by the browser like the cookies,
+    # there is no CSRF risk and no CSRF token to store anywhere.
+    request._dont_enforce_csrf_checks = True
+
+
+class GatewayUser(SimpleLazyObject):
+    '''
+    Authenticated user built with the gateway token claims.
+
+    The database user is fetched (or created) the first time that any attribute
+    not included in the claims is requested, like ``pk``, ``groups`` or
+    ``is_active`` (checked by the DRF authentication, the local deactivation wins).
+
+    Behaves like the database user in ``isinstance`` checks, comparisons and
+    foreign key assignments, i.e. ``serializer.save(user=request.user)``.
+    '''
+
+    def __init__(self, request, userinfo):
+        super(GatewayUser, self).__init__(lambda: _get_or_create_user(request, userinfo))
+
+        # the claims are kept outside the wrapped user,
+        # reading them does not fetch the database user
+        self.__dict__.update({
+            'username': parse_username(request, userinfo.get('preferred_username')),
+            'first_name': userinfo.get('given_name', ''),
+            'last_name': userinfo.get('family_name', ''),
+            'email': userinfo.get('email', ''),
+            'is_anonymous': False,
+            'is_authenticated': True,
+        })
+
+    def __bool__(self):
+        return True
+
+    def __str__(self):
+        return self.username
+
+    def get_username(self):
+        return self.username
+
+
 @receiver(user_logged_out)
 def _user_logged_out(sender, user, request, **kwargs):
     '''
@@ -199,14 +357,157 @@ def _user_logged_out(sender, user, request, **kwargs):
     realm = get_current_realm(request, default_realm=None)
     if token and realm:
         # logout
-        exec_request(
-            method='post',
-            url=f'{_KC_URL}/{realm}/{_KC_OID_URL}/logout',
-            data={
-                'client_id': settings.KEYCLOAK_CLIENT_ID,
-                'refresh_token': token['refresh_token'],
-            },
-        )
+        propagate_logout(realm, token['refresh_token'])
+
+
+def propagate_logout(realm, refresh_token):
+    '''
+    Logs out the token in the keycloak server without blocking the current request.
+
+    The call is queued in the RQ platform if the scheduler is enabled,
+    otherwise in a local thread pool. Only the queued calls are retried.
+    '''
+
+    if not settings.KEYCLOAK_LOGOUT_ASYNC:
+        return logout_kc_token(realm, refresh_token, retries=1)
+
+    KEYCLOAK_LOGOUTS.labels(status='queued').inc()
+    if settings.SCHEDULER_REQUIRED:
+        import django_rq
+
+        # the job arguments are kept in Redis along with the job (also the failed ones),
+        # the token is stored apart, with expiration, and removed once used
+        key = _KC_LOGOUT_TOKEN_KEY.format(uuid.uuid4().hex)
+        django_rq.get_connection().set(key, refresh_token, ex=_KC_LOGOUT_TOKEN_TTL)
+        return django_rq.enqueue(logout_kc_stored_token, realm, key)
+
+    return _get_logout_pool().submit(logout_kc_token, realm, refresh_token)
+
+
+def logout_kc_stored_token(realm, key):
+    '''
+    Logs out the token stored in the RQ Redis database with the given key,
+    the key is removed before calling the keycloak server.
+    '''
+
+    import django_rq
+
+    with django_rq.get_connection().pipeline() as pipe:
+        pipe.get(key)
+        pipe.delete(key)
+        refresh_token, _ = pipe.execute()
+
+    if not refresh_token:
+        KEYCLOAK_LOGOUTS.labels(status='failure').inc()
+        logger.warning(f'Keycloak logout failed in realm "{realm}": token expired')
+        return False
+
+    if isinstance(refresh_token, bytes):
+        refresh_token = refresh_token.decode()
+    return logout_kc_token(realm, refresh_token)
+
+
+def logout_kc_token(realm, refresh_token, retries=None):
+    '''
+    Logs out the token in the keycloak server making it invalid.
+
+    Retries the call ``retries`` times (``KEYCLOAK_LOGOUT_RETRIES`` by default)
+    if the server fails.
+    '''
+
+    retries = retries or settings.KEYCLOAK_LOGOUT_RETRIES
+    count = 0
+    while True:
+        count += 1
+        try:
+            response = _kc_request(
+                'logout',
+                realm,
+                method='post',
+                url=f'{_KC_URL}/{realm}/{_KC_OID_URL}/logout',
+                data={
+                    'client_id': settings.KEYCLOAK_CLIENT_ID,
+                    'refresh_token': refresh_token,
+                },
+            )
+            response.raise_for_status()
+            KEYCLOAK_LOGOUTS.labels(status='success').inc()
+            return True
+
+        except Exception as e:
+            if count >= retries:
+                KEYCLOAK_LOGOUTS.labels(status='failure').inc()
+                logger.warning(f'Keycloak logout failed in realm "{realm}": {str(e)}')
+                return False
+
+        KEYCLOAK_LOGOUTS.labels(status='retry').inc()
+        sleep(count)  # sleep longer in each iteration
+
+
+def _get_logout_pool():
+    global _KC_LOGOUT_POOL
+
+    with _KC_LOGOUT_POOL_LOCK:
+        if _KC_LOGOUT_POOL is None:
+            _KC_LOGOUT_POOL = ThreadPoolExecutor(
+                max_workers=settings.KEYCLOAK_LOGOUT_WORKERS,
+                thread_name_prefix='keycloak-logout',
+            )
+    return _KC_LOGOUT_POOL
+
+
+def _kc_request(operation, realm, **kwargs):
+    '''
+    Executes the request to the keycloak server collecting the number of calls
+    and the response time by operation and realm.
+    '''
+
+    status = 'error'
+    start = perf_counter()
+    try:
+        response = exec_request(**kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        # do not create a new series for each misspelled realm name
+        label = '-' if status == '404' else realm
+        KEYCLOAK_REQUESTS.labels(operation, label, status).inc()
+        KEYCLOAK_REQUEST_LATENCY.labels(operation, label).observe(perf_counter() - start)
+
+
+def _get_realm_cache_key(realm):
+    return _KC_REALM_CACHE_KEY.format(urllib.parse.quote(realm, safe=''))
+
+
+def _set_session_value(request, key, value):
+    '''
+    Sets the value in the session only if it changed.
+
+    Any assignment marks the session as modified and the ``SessionMiddleware``
+    saves it at the end of the request, skipping it avoids a session write
+    in each authenticated request.
+    '''
+
+    session = request.session
+    if key in session and session[key] == value:
+        request._session_write_skipped = True
+        return
+
+    session[key] = value
+
+
+def count_session_write_avoided(request):
+    '''
+    Counts the session write avoided by the request, once and only if
+    any value was skipped and the session was not modified afterwards.
+    '''
+
+    if not getattr(request, '_session_write_skipped', False):
+        return
+
+    request._session_write_skipped = False
+    if not request.session.modified:
+        SESSION_WRITES_AVOIDED.inc()
 
 
 def _get_login_url(request):
@@ -215,7 +516,9 @@ def _get_login_url(request):
 
 def _authenticate(realm, data):
     # get user token from the returned "code"
-    response = exec_request(
+    response = _kc_request(
+        'token',
+        realm,
         method='post',
         url=f'{_KC_URL}/{realm}/{_KC_OID_URL}/token',
         data=data,
@@ -227,9 +530,11 @@ def _authenticate(realm, data):
     return token, userinfo
 
 
-@cache_wrap(timeout=settings.USER_TOKEN_TTL)
+@cache_wrap(timeout=settings.USER_TOKEN_TTL, lock=True)
 def _get_user_info(realm, token):
-    response = exec_request(
+    response = _kc_request(
+        'userinfo',
+        realm,
         method='get',
         url=f'{_KC_URL}/{realm}/{_KC_OID_URL}/userinfo',
         headers={'Authorization': f'Bearer {token}'},
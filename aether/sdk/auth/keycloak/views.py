@@ -28,6 +28,7 @@ from django.utils.translation import gettext_lazy as _
 
 from aether.sdk.auth.keycloak.forms import RealmForm
 from aether.sdk.auth.keycloak.utils import post_authenticate, get_realm_auth_url
+from aether.sdk.multitenancy.utils import set_current_realm
 
 
 class KeycloakLoginView(LoginView):
@@ -50,16 +51,14 @@ class KeycloakLoginView(LoginView):
                 return HttpResponseRedirect(self.get_success_url())
         except Exception:
             # remove realm
-            request.session[settings.REALM_COOKIE] = None
-            request.session.modified = True
+            set_current_realm(request, None)
             messages.error(request, _('An error ocurred while authenticating against keycloak'))
 
         return super(KeycloakLoginView, self).get(request, *args, **kwargs)
 
     def form_valid(self, form):
         # save the current realm in the session
-        self.request.session[settings.REALM_COOKIE] = form.cleaned_data.get('realm')
-        self.request.session.modified = True
+        set_current_realm(self.request, form.cleaned_data.get('realm'))
         # redirect to keycloak
         return HttpResponseRedirect(get_realm_auth_url(self.request))
 
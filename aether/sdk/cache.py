@@ -16,15 +16,36 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import contextvars
+import hashlib
 import logging
+import math
+import random
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.http import JsonResponse
 from django.utils.timezone import now
 
+from aether.sdk.metrics import (
+    CACHE_TAG_INVALIDATIONS,
+    CACHE_WRAP_CALLS,
+    CACHE_WRAP_EVICTIONS,
+    CACHE_WRAP_REFRESHES,
+    CACHE_WRAP_SIZE,
+)
+
 logger = logging.getLogger(__name__)
 logger.setLevel(settings.LOGGING_LEVEL)
 
@@ -33,15 +54,206 @@ logger.setLevel(settings.LOGGING_LEVEL)
 # Use this as an in-memory cache
 CONTENT_TYPE_CACHE = {}
 
+_TAG_VERSION_KEY = 'aether-sdk:cache-version:{}'
+
+_REFRESH_POOL = None
+_REFRESH_POOL_LOCK = threading.Lock()
+
 
 def _is_cacheops_enabled():
     return settings.DJANGO_USE_CACHE and 'cacheops' in settings.INSTALLED_APPS
 
 
-def cache_wrap(timeout=settings.CACHE_TTL):
+def realm_tag(realm):
+    '''
+    Tag of the entries that depend on any data of the realm.
+    '''
+
+    return f'realm:{realm}'
+
+
+def model_tag(model, realm=None):
+    '''
+    Tag of the entries that depend on any instance of the model,
+    optionally only on the instances of the realm.
+    '''
+
+    tag = f'model:{model._meta.label_lower}'
+    return f'{tag}:realm:{realm}' if realm else tag
+
+
+def object_tag(model, pk):
+    '''
+    Tag of the entries that depend on the model instance.
+    '''
+
+    return f'object:{model._meta.label_lower}:{pk}'
+
+
+def get_tags_versions(tags):
+    '''
+    Returns the current version of each tag.
+
+    The first version is the current timestamp, this way a lost counter
+    (evicted or flushed) never brings back the entries of an old version.
+    '''
+
+    keys = {_TAG_VERSION_KEY.format(tag): tag for tag in tags}
+    versions = safe_cache_call(cache.get_many, list(keys)) or {}
+    for key in keys.keys() - versions.keys():
+        safe_cache_call(cache.add, key, time.time_ns(), None)
+        versions[key] = safe_cache_call(cache.get, key) or 0
+    return {tag: versions[key] for key, tag in keys.items()}
+
+
+def invalidate_tags(tags):
+    '''
+    Invalidates all the cache entries tagged with any of the tags
+    increasing their versions, the rest of the cache is kept.
+    '''
+
+    for tag in set(tags):
+        key = _TAG_VERSION_KEY.format(tag)
+        # a new version (the current timestamp) or increases the existing one
+        if not safe_cache_call(cache.add, key, time.time_ns(), None):
+            safe_cache_call(cache.incr, key)
+        # the object tags without the primary key, keeps the labels bounded
+        label = tag.rsplit(':', 1)[0] if tag.startswith('object:') else tag
+        CACHE_TAG_INVALIDATIONS.labels(label).inc()
+
+
+def _tags_digest(tags):
+    versions = get_tags_versions(tags)
+    value = ','.join(f'{tag}={versions[tag]}' for tag in sorted(versions))
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def tagged_cache_key(key, tags):
+    '''
+    Returns the key within the namespace of the current tags versions.
+
+    Use it with the Django cache to keep entries that must be
+    invalidated after any edit action on the tagged data.
+    '''
+
+    return f'aether-sdk:tagged:{_tags_digest(tags)}:{key}'
+
+
+def get_realm_cache_version(realm):
+    '''
+    Returns the current cache namespace version of the realm.
+    '''
+
+    return get_tags_versions([realm_tag(realm)])[realm_tag(realm)]
+
+
+def bump_realm_cache(realm):
+    '''
+    Invalidates all the cache entries of the realm namespace.
+    '''
+
+    invalidate_tags([realm_tag(realm)])
+
+
+def realm_cache_key(key, realm):
+    '''
+    Returns the key within the current realm namespace.
+
+    Use it with the Django cache to keep entries that must be
+    invalidated after any edit action in the realm.
+    '''
+
+    return f'aether-sdk:realm:{realm}:{get_realm_cache_version(realm)}:{key}'
+
+
+def _tags_namespace(realm, tags):
+    '''
+    Returns the function that builds the namespace of the call
+    with the versions of its tags.
+    '''
+
+    def namespace(args, kwargs):
+        call_tags = list(tags(*args, **kwargs) if callable(tags) else tags or [])
+        if realm:
+            from aether.sdk.multitenancy.utils import get_routed_realm
+
+            routed_realm = get_routed_realm()
+            if routed_realm is not None:
+                call_tags.append(realm_tag(routed_realm))
+        return _tags_digest(call_tags) if call_tags else None
+
+    return namespace
+
+
+def cache_wrap(
+    timeout=settings.CACHE_TTL,
+    realm=False,
+    tags=None,
+    lock=False,
+    early_refresh=0,
+    stale_ttl=0,
+):
+    '''
+    Memoizes the function results for ``timeout`` seconds.
+
+    With ``realm`` the results are kept within the current realm namespace
+    and are invalidated after any edit action in the realm.
+
+    With ``tags``, a list of tags or a function that receives the call
+    arguments and returns them, the results are invalidated along with the tags.
+
+    Options to protect the function against the bursts of calls
+    when a popular entry expires:
+
+    - ``lock``: only one caller computes the missing entry, the rest wait for it
+      up to ``settings.CACHE_WRAP_LOCK_TIMEOUT`` seconds. The lock is kept in the
+      django cache, shared by all the processes with Redis.
+
+    - ``early_refresh``: the entries are refreshed in background before they
+      expire, randomly, with more probability the closer the expiration time
+      and the slower the function ("XFetch" beta value, ``1`` is a good default).
+
+    - ``stale_ttl``: the expired entries are served ``stale_ttl`` seconds more
+      while they are refreshed in background, also if the refresh fails.
+
+    Without cacheops the results are kept in an in-process ``LRUCache``
+    of ``settings.CACHE_WRAP_MAX_SIZE`` entries by function.
+    '''
+
+    # the stale entries are kept along with the fresh ones
+    store_timeout = timeout + stale_ttl
+
     if _is_cacheops_enabled():
         from cacheops import cached
-        return cached(timeout=timeout)
+
+        def cache_decorator(fn):
+            # cacheops builds the key with the function module, name and line,
+            # the line of the wrapped functions is always the same one (``on_miss``)
+            return cached(timeout=store_timeout, extra=f'{fn.__module__}.{fn.__qualname__}')(fn)
+    elif settings.CACHE_WRAP_MAX_SIZE > 0:
+        cache_decorator = _lru_cached(
+            timeout=store_timeout,
+            max_size=settings.CACHE_WRAP_MAX_SIZE,
+        )
+    else:
+        cache_decorator = None
+
+    if cache_decorator:
+        if lock or early_refresh or stale_ttl:
+            protection = {
+                'timeout': timeout,
+                'lock': lock,
+                'early_refresh': early_refresh,
+                'stale_ttl': stale_ttl,
+            }
+        else:
+            protection = None
+
+        def decorator(fn):
+            namespace = _tags_namespace(realm, tags) if realm or tags else None
+            return _count_hits(fn, cache_decorator, namespace, protection)
+
+        return decorator
 
     # put a fake cache function on global scope so it doesn't complain
     def do_nothing(fn):
@@ -50,6 +262,314 @@ def cache_wrap(timeout=settings.CACHE_TTL):
     return do_nothing
 
 
+class _Busy(Exception):
+    '''
+    Another caller is computing the entry.
+    '''
+
+
+def _count_hits(fn, cache_decorator, namespace=None, protection=None):
+    '''
+    Applies the cache decorator counting the cache hits and misses.
+
+    The function is only executed in the cache misses.
+
+    With ``namespace``, a function that receives the call arguments,
+    its result is the first argument of the cached function,
+    it's part of the cache key.
+
+    With ``protection`` the cached values are ``(value, created, duration)``
+    tuples used to decide when to refresh them (see ``cache_wrap`` options).
+    '''
+
+    name = f'{fn.__module__}.{fn.__qualname__}'
+    state = threading.local()
+    protection = protection or {}
+
+    def compute(*args, **kwargs):
+        preset = getattr(state, 'preset', None)
+        if preset:
+            # the value refreshed in background, stores it
+            return preset
+
+        if protection.get('lock'):
+            key = _lock_key(name, args, kwargs)
+            if not _acquire_lock(key):
+                raise _Busy()
+            state.locked = key  # released once stored
+
+        state.executed = True
+        if not protection:
+            return fn(*args, **kwargs)
+        return _timed(fn, args, kwargs)
+
+    if namespace:
+        def on_miss(call_namespace, *args, **kwargs):
+            return compute(*args, **kwargs)
+    else:
+        def on_miss(*args, **kwargs):
+            return compute(*args, **kwargs)
+
+    cached_fn = cache_decorator(wraps(fn)(on_miss))
+
+    def call(*args, **kwargs):
+        if namespace:
+            return cached_fn(namespace(args, kwargs), *args, **kwargs)
+        return cached_fn(*args, **kwargs)
+
+    def fetch(*args, **kwargs):
+        deadline = time.monotonic() + settings.CACHE_WRAP_LOCK_TIMEOUT
+        while True:
+            state.locked = None
+            try:
+                return call(*args, **kwargs)
+            except _Busy:
+                if time.monotonic() >= deadline:
+                    # do not wait more, computes it without storing it
+                    state.executed = True
+                    return _timed(fn, args, kwargs)
+                time.sleep(0.05)
+            finally:
+                if state.locked:
+                    _release_lock(state.locked)
+
+    def refresh(*args, **kwargs):
+        key = _lock_key(name, args, kwargs)
+        if not _acquire_lock(key):
+            return  # already in progress
+
+        try:
+            state.preset = _timed(fn, args, kwargs)
+            # replaces the current value
+            wrapper.invalidate(*args, **kwargs)
+            call(*args, **kwargs)
+            CACHE_WRAP_REFRESHES.labels(name, 'success').inc()
+        except Exception as e:
+            # keeps serving the current value
+            logger.warning(f'Cache refresh of "{name}" failed: {str(e)}')
+            CACHE_WRAP_REFRESHES.labels(name, 'failure').inc()
+        finally:
+            state.preset = None
+            _release_lock(key)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        state.executed = False
+        if not protection:
+            result = call(*args, **kwargs)
+            CACHE_WRAP_CALLS.labels(name, 'miss' if state.executed else 'hit').inc()
+            return result
+
+        value, created, duration = fetch(*args, **kwargs)
+        age = time.time() - created
+        if state.executed:
+            result = 'miss'
+        elif age >= protection['timeout'] and protection['stale_ttl']:
+            result = 'stale'
+            _run_in_background(refresh, *args, **kwargs)
+        else:
+            result = 'hit'
+            beta = protection['early_refresh']
+            # XFetch: refresh if "age - duration * beta * log(rand) >= timeout"
+            if beta:
+                gap = -duration * beta * math.log(1 - random.random())
+                if age + gap >= protection['timeout']:
+                    _run_in_background(refresh, *args, **kwargs)
+
+        CACHE_WRAP_CALLS.labels(name, result).inc()
+        return value
+
+    # keep the cache helpers, like ``invalidate``
+    helpers = ['invalidate', 'key']
+    if not namespace:
+        helpers += ['cache']
+        if not protection:
+            helpers += ['get', 'set']
+    for attr in helpers:
+        if hasattr(cached_fn, attr):
+            helper = getattr(cached_fn, attr)
+            if namespace:
+                helper = _with_namespace(helper, namespace)
+            setattr(wrapper, attr, helper)
+
+    return wrapper
+
+
+def _with_namespace(helper, namespace):
+    @wraps(helper)
+    def wrapper(*args, **kwargs):
+        return helper(namespace(args, kwargs), *args, **kwargs)
+    return wrapper
+
+
+def _timed(fn, args, kwargs):
+    start = time.time()
+    value = fn(*args, **kwargs)
+    end = time.time()
+    return value, end, end - start
+
+
+def _lock_key(name, args, kwargs):
+    try:
+        call = repr(_make_key(args, kwargs))
+    except TypeError:
+        call = repr((args, kwargs))
+    return f'aether-sdk:cache-wrap-lock:{name}:{hashlib.md5(call.encode()).hexdigest()}'
+
+
+def _acquire_lock(key):
+    # without cache (``None``) nobody can wait, acquired
+    return safe_cache_call(cache.add, key, 1, settings.CACHE_WRAP_LOCK_TIMEOUT) is not False
+
+
+def _release_lock(key):
+    safe_cache_call(cache.delete, key)
+
+
+def _run_in_background(fn, *args, **kwargs):
+    '''
+    Runs the function in the local thread pool within the current context
+    (the routed realm is needed to build the realm namespace).
+    '''
+
+    global _REFRESH_POOL
+
+    with _REFRESH_POOL_LOCK:
+        if _REFRESH_POOL is None:
+            _REFRESH_POOL = ThreadPoolExecutor(
+                max_workers=settings.CACHE_WRAP_REFRESH_WORKERS,
+                thread_name_prefix='cache-refresh',
+            )
+    context = contextvars.copy_context()
+    return _REFRESH_POOL.submit(context.run, fn, *args, **kwargs)
+
+
+def _freeze(value):
+    '''
+    Returns a hashable version of the value, the dictionaries (like the tokens),
+    lists and sets are converted recursively.
+    '''
+
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: repr(item[0]))
+        return (dict, tuple((k, _freeze(v)) for k, v in items))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(_freeze(v) for v in value))
+    hash(value)  # raises TypeError if not hashable
+    return value
+
+
+def _make_key(args, kwargs):
+    return _freeze(args), _freeze(kwargs)
+
+
+class LRUCache(object):
+    '''
+    Thread-safe in-process cache with a maximum number of entries
+    and a time to live, the least recently used entries are discarded first.
+    '''
+
+    def __init__(self, max_size, timeout, name=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.name = name
+        self._data = OrderedDict()  # key: (expiration time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires <= time.monotonic():
+                del self._data[key]
+                self._report('expired')
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._report('size')
+            self._report()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._report()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._report()
+
+    def _report(self, eviction=None):
+        if self.name:
+            if eviction:
+                CACHE_WRAP_EVICTIONS.labels(self.name, eviction).inc()
+            CACHE_WRAP_SIZE.labels(self.name).set(len(self._data))
+
+
+def _lru_cached(timeout, max_size):
+    '''
+    Memoizes the function results in an in-process ``LRUCache``,
+    the calls with not hashable arguments are not memoized.
+    '''
+
+    def decorator(fn):
+        lru = LRUCache(max_size, timeout, name=f'{fn.__module__}.{fn.__qualname__}')
+        missing = object()
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                key = _make_key(args, kwargs)
+            except TypeError:
+                return fn(*args, **kwargs)
+
+            value = lru.get(key, missing)
+            if value is missing:
+                value = fn(*args, **kwargs)
+                lru.set(key, value)
+            return value
+
+        def invalidate(*args, **kwargs):
+            lru.delete(_make_key(args, kwargs))
+
+        wrapper.invalidate = invalidate
+        wrapper.cache = lru
+        return wrapper
+
+    return decorator
+
+
+def safe_cache_call(fn, *args):
+    '''
+    Executes the cache call ignoring the cache errors.
+
+    Use it when the cache is only an optimization and the process
+    must not fail because of it.
+    '''
+
+    try:
+        return fn(*args)
+    except Exception as e:
+        logger.warning(f'Cache not available: {str(e)}')
+        return None
+
+
 def get_content_type(model):
     try:
         return CONTENT_TYPE_CACHE[model]
@@ -63,14 +583,57 @@ def get_content_type(model):
     return None
 
 
-def clear_cache(objects=None, models=None, purge=False):
-    # this is required to refresh the templates content
-    # otherwise after any update the page will not refresh properly
-    try:
-        cache.clear()
-    except Exception as e:
-        # ignore errors
-        logger.error(str(e))
+def is_shared_cache():
+    '''
+    Checks if the default cache is shared by all the processes.
+    '''
+
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (DummyCache, LocMemCache))
+
+
+def check_shared_cache(app_configs=None, **kwargs):
+    '''
+    System check, the ``tags`` and ``realm`` invalidation modes keep the versions
+    in the default cache, it must be shared by all the processes.
+    '''
+
+    if (
+        not settings.DJANGO_USE_CACHE or
+        settings.DJANGO_CACHE_INVALIDATION not in ('realm', 'tags')
+    ):
+        return []
+
+    if is_shared_cache():
+        return []
+
+    return [
+        checks.Error(
+            f'The "{settings.DJANGO_CACHE_INVALIDATION}" cache invalidation mode'
+            ' requires a default cache shared by all the processes.',
+            hint='Set REDIS_DJANGO_CACHE or DJANGO_CACHE_INVALIDATION="all".',
+            id='aether.sdk.E001',
+        )
+    ]
+
+
+def clear_cache(objects=None, models=None, purge=False, realm=None, tags=None):
+    mode = settings.DJANGO_CACHE_INVALIDATION
+    tags = list(tags or []) if mode == 'tags' else []
+
+    if purge or mode == 'all' or not (realm or tags):
+        # this is required to refresh the templates content
+        # otherwise after any update the page will not refresh properly
+        try:
+            cache.clear()
+        except Exception as e:
+            # ignore errors
+            logger.error(str(e))
+    else:
+        # only the affected tags and the realm namespace,
+        # the rest of entries are kept
+        if realm:
+            tags.append(realm_tag(realm))
+        invalidate_tags(tags)
 
     if _is_cacheops_enabled():
         from cacheops import invalidate_all, invalidate_model, invalidate_obj
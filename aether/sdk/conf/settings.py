@@ -281,6 +281,16 @@ SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 # How often should we fetch userinfo from the Keycloak server?
 USER_TOKEN_TTL = int(os.getenv('USER_TOKEN_TTL', 60 * 1))   # 1 minute
 CACHE_TTL = int(os.getenv('DJANGO_CACHE_TIMEOUT', 60 * 5))  # 5 minutes
+# after any edit action invalidate "all" the django cache, only the "realm" namespace
+# or only the affected "tags" (models and object) and the realm namespace,
+# the last two keep the versions in the default cache, it must be shared (Redis)
+DJANGO_CACHE_INVALIDATION = os.getenv('DJANGO_CACHE_INVALIDATION', 'all')
+# entries by function of the in-process ``cache_wrap`` cache (used without cacheops)
+CACHE_WRAP_MAX_SIZE = int(os.getenv('CACHE_WRAP_MAX_SIZE', 0 if TESTING else 1000))
+# seconds waiting for the ``cache_wrap`` entries computed by other callers
+CACHE_WRAP_LOCK_TIMEOUT = int(os.getenv('CACHE_WRAP_LOCK_TIMEOUT', 10))
+# threads refreshing the ``cache_wrap`` entries in background
+CACHE_WRAP_REFRESH_WORKERS = int(os.getenv('CACHE_WRAP_REFRESH_WORKERS', 2))
 
 if (not TESTING) and DJANGO_USE_CACHE:
     SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
@@ -616,6 +626,18 @@ if KEYCLOAK_SERVER_URL:
         'aether.sdk.auth.keycloak.middleware.TokenAuthenticationMiddleware',
     ]
 
+    # The logout is propagated to keycloak in background (not during tests)
+    KEYCLOAK_LOGOUT_ASYNC = not TESTING and not bool(os.getenv('KEYCLOAK_LOGOUT_SYNC'))
+    KEYCLOAK_LOGOUT_RETRIES = int(os.getenv('KEYCLOAK_LOGOUT_RETRIES', 3))
+    KEYCLOAK_LOGOUT_WORKERS = int(os.getenv('KEYCLOAK_LOGOUT_WORKERS', 2))
+
+    # How long should we remember the realm checks? (0 disables the cache)
+    KEYCLOAK_REALM_TTL = int(os.getenv('KEYCLOAK_REALM_TTL', 0 if TESTING else 60 * 60))
+    # (the tests share the cache, a missing realm must not affect the following ones)
+    KEYCLOAK_REALM_NEGATIVE_TTL = int(
+        os.getenv('KEYCLOAK_REALM_NEGATIVE_TTL', 0 if TESTING else 60)
+    )
+
     GATEWAY_SERVICE_ID = os.getenv('GATEWAY_SERVICE_ID')
     if GATEWAY_SERVICE_ID:
         GATEWAY_ENABLED = True
@@ -633,9 +655,16 @@ if KEYCLOAK_SERVER_URL:
         USE_X_FORWARDED_HOST = True
         USE_X_FORWARDED_PORT = True
 
-        MIDDLEWARE += [
-            'aether.sdk.auth.keycloak.middleware.GatewayAuthenticationMiddleware',
-        ]
+        # Stateless mode: the gateway requests do not use sessions at all
+        GATEWAY_STATELESS = bool(os.getenv('GATEWAY_STATELESS'))
+        if GATEWAY_STATELESS:
+            MIDDLEWARE += [
+                'aether.sdk.auth.keycloak.middleware.StatelessGatewayAuthenticationMiddleware',
+            ]
+        else:
+            MIDDLEWARE += [
+                'aether.sdk.auth.keycloak.middleware.GatewayAuthenticationMiddleware',
+            ]
 
     else:
         logger.info('No Keycloak gateway enabled!')
@@ -659,13 +688,50 @@ NO_MULTITENANCY_REALM = '~'
 if MULTITENANCY:
     REALM_COOKIE = os.getenv('REALM_COOKIE', 'eha-realm')
     DEFAULT_REALM = os.getenv('DEFAULT_REALM', 'eha')
+    # number of instances added to the realm at once
+    MULTITENANCY_BATCH_SIZE = int(os.getenv('MULTITENANCY_BATCH_SIZE', 1000))
+    # number of primary keys checked at once in the ``is-accessible`` list endpoint
+    MULTITENANCY_MAX_ACCESSIBLE_PKS = int(os.getenv('MULTITENANCY_MAX_ACCESSIBLE_PKS', 1000))
 
     INSTALLED_APPS += ['aether.sdk.multitenancy', ]
     MIGRATION_MODULES['multitenancy'] = 'aether.sdk.multitenancy.migrations'
+    # resolves the realm once per request (after the authentication middlewares)
+    MIDDLEWARE += ['aether.sdk.multitenancy.middleware.RealmMiddleware', ]
     REST_FRAMEWORK['DEFAULT_PERMISSION_CLASSES'] += [
         'aether.sdk.multitenancy.permissions.IsAccessibleByRealm',
     ]
 
+    # PostgreSQL row level security policies (``mt_rls`` models)
+    MULTITENANCY_RLS = bool(os.getenv('MULTITENANCY_RLS'))
+    if MULTITENANCY_RLS:
+        MIDDLEWARE += ['aether.sdk.multitenancy.middleware.RealmRLSMiddleware', ]
+
+    # limits by realm, rate like "100/s" or "1000/minute" and requests in progress
+    MULTITENANCY_THROTTLE_RATE = os.getenv('MULTITENANCY_THROTTLE_RATE')
+    MULTITENANCY_MAX_CONCURRENT_REQUESTS = int(
+        os.getenv('MULTITENANCY_MAX_CONCURRENT_REQUESTS', 0)
+    )
+    if MULTITENANCY_THROTTLE_RATE or MULTITENANCY_MAX_CONCURRENT_REQUESTS:
+        # before any authentication work
+        MIDDLEWARE.insert(
+            MIDDLEWARE.index('django.contrib.auth.middleware.AuthenticationMiddleware'),
+            'aether.sdk.multitenancy.middleware.RealmThrottleMiddleware',
+        )
+
+    # database queries by realm and view (Prometheus metrics)
+    MULTITENANCY_QUERY_METRICS = bool(os.getenv('MULTITENANCY_QUERY_METRICS'))
+    if MULTITENANCY_QUERY_METRICS:
+        MIDDLEWARE += ['aether.sdk.multitenancy.middleware.RealmQueryMetricsMiddleware', ]
+
+    # realms database aliases, comma separated list of "realm:alias" pairs
+    MULTITENANCY_DATABASES = dict(
+        item.strip().split(':', 1)
+        for item in os.getenv('MULTITENANCY_DATABASES', '').split(',')
+        if item.strip()
+    )
+    if MULTITENANCY_DATABASES:
+        DATABASE_ROUTERS = ['aether.sdk.multitenancy.routers.RealmRouter', ]
+
 else:
     logger.info('No multi-tenancy enabled!')
 
@@ -178,6 +178,7 @@ class AdminUrlsUrlTest(UrlsTestCase):
     def test__urls(self):
         self.assertEqual(reverse('admin:index'), '/private/')
         self.assertEqual(reverse('get-realms'), '/private/~realms')
+        self.assertEqual(reverse('get-realm-stats'), '/private/~realm-stats')
         self.assertIsNotNone(resolve('/private/~prometheus/metrics'))
         self.assertIsNotNone(resolve('/private/~uwsgi/'))
         self.assertIsNotNone(resolve('/private/~realms'))
@@ -180,7 +180,7 @@ def _get_auth_urls():
 
 
 def _get_admin_urls():
-    from aether.sdk.multitenancy.views import get_realms
+    from aether.sdk.multitenancy.views import get_realm_stats, get_realms
 
     admin_urls = [
         # monitoring
@@ -189,6 +189,7 @@ def _get_admin_urls():
         path(route='~uwsgi/', view=include('django_uwsgi.urls')),
         # realms
         path(route='~realms', view=get_realms, name='get-realms'),
+        path(route='~realm-stats', view=get_realm_stats, name='get-realm-stats'),
     ]
 
     if settings.DJANGO_USE_CACHE:
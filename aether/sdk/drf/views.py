@@ -25,7 +25,7 @@ from rest_framework.decorators import action
 from rest_framework.permissions import SAFE_METHODS
 from rest_framework.response import Response
 
-from aether.sdk.cache import clear_cache
+from aether.sdk.cache import clear_cache, model_tag, object_tag
 
 
 class CacheViewSetMixin(object):
@@ -37,6 +37,41 @@ class CacheViewSetMixin(object):
     cache_models = []
     # purges cache every time an instance is updated?
     cache_purge = False
+    # the actions that do not edit anything even with unsafe methods (i.e. POST lookups)
+    cache_readonly_actions = []
+
+    def get_cache_realm(self):
+        '''
+        Returns the realm whose cache namespace is invalidated after
+        any edit action, ``None`` invalidates the whole cache.
+        '''
+
+        return None
+
+    def get_cache_tags(self):
+        '''
+        Returns the cache tags invalidated after any edit action,
+        the view model, the ``cache_models`` and the edited object.
+        '''
+
+        realm = self.get_cache_realm()
+        queryset = getattr(self, 'queryset', None)
+        model = getattr(queryset, 'model', None)
+        models = ([model] if model else []) + list(self.cache_models)
+
+        tags = [model_tag(m) for m in models]
+        if realm:
+            tags += [model_tag(m, realm) for m in models]
+
+        lookup_kwarg = (
+            getattr(self, 'lookup_url_kwarg', None) or
+            getattr(self, 'lookup_field', 'pk')
+        )
+        pk = getattr(self, 'kwargs', {}).get(lookup_kwarg)
+        if model and pk is not None:
+            tags.append(object_tag(model, pk))
+
+        return tags
 
     def finalize_response(self, request, response, *args, **kwargs):
         resp = super(CacheViewSetMixin, self).finalize_response(request, response, *args, **kwargs)
@@ -48,9 +83,18 @@ class CacheViewSetMixin(object):
         resp['Pragma'] = 'no-cache'                                      # HTTP 1.0.
         resp['Expires'] = '0'                                            # Proxies.
 
-        if resp.status_code < 400 and request.method not in SAFE_METHODS:
+        if (
+            resp.status_code < 400 and
+            request.method not in SAFE_METHODS and
+            getattr(self, 'action', None) not in self.cache_readonly_actions
+        ):
             # invalidate cache after any successful edit action
-            clear_cache(models=self.cache_models, purge=self.cache_purge)
+            clear_cache(
+                models=self.cache_models,
+                purge=self.cache_purge,
+                realm=self.get_cache_realm(),
+                tags=self.get_cache_tags(),
+            )
 
         return resp
 
@@ -0,0 +1,322 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+'''
+In-process fake Keycloak server to use in tests and benchmarks.
+
+It implements the subset of the OpenID Connect endpoints used by the SDK,
+issuing HS256 signed JSON Web Tokens, so the authentication middlewares can
+be exercised without a real Keycloak server::
+
+    with FakeKeycloakServer(latency=0.01) as server:
+        token = server.issue_token('my-realm', 'user')
+        response = client.get(url, HTTP_X_OAUTH_TOKEN=token['access_token'])
+
+While the server is running ``aether.sdk.auth.keycloak.utils`` points to it.
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import statistics
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep, time
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+_OID_PATH = 'protocol/openid-connect'
+
+
+def _b64encode(value):
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+class FakeKeycloakServer(object):
+    '''
+    Fake Keycloak server listening in a random local port.
+
+    Arguments:
+
+    - ``latency``: seconds to wait before answering each request.
+    - ``realms``: list of existing realms, ``None`` means any realm exists.
+    - ``users``: dictionary of ``username: password`` pairs accepted with the
+      ``password`` grant type, ``None`` means any password is valid.
+    - ``token_ttl``: access tokens validity in seconds.
+    '''
+
+    def __init__(self, latency=0, realms=None, users=None, token_ttl=300, secret=None):
+        self.latency = latency
+        self.realms = realms
+        self.users = users
+        self.token_ttl = token_ttl
+        self.secret = secret or uuid.uuid4().hex.encode('ascii')
+        self.kid = uuid.uuid4().hex
+
+        self.revoked = set()
+        self.requests = []
+
+        self.url = None
+        self._httpd = None
+        self._thread = None
+        self._patcher = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _build_handler(self))
+        self._httpd.daemon_threads = True
+        self.url = 'http://{}:{}'.format(*self._httpd.server_address[:2])
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever,
+            name='fake-keycloak',
+            daemon=True,
+        )
+        self._thread.start()
+
+        self._patcher = mock.patch('aether.sdk.auth.keycloak.utils._KC_URL', self.url)
+        self._patcher.start()
+
+    def stop(self):
+        if self._patcher:
+            self._patcher.stop()
+            self._patcher = None
+
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+    def realm_exists(self, realm):
+        return self.realms is None or realm in self.realms
+
+    def jwks(self):
+        return {
+            'keys': [{
+                'kid': self.kid,
+                'kty': 'oct',
+                'alg': 'HS256',
+                'use': 'sig',
+                'k': _b64encode(self.secret),
+            }],
+        }
+
+    def encode(self, claims):
+        header = {'alg': 'HS256', 'typ': 'JWT', 'kid': self.kid}
+        signing_input = '.'.join([
+            _b64encode(json.dumps(header).encode('utf-8')),
+            _b64encode(json.dumps(claims).encode('utf-8')),
+        ])
+        return f'{signing_input}.{_b64encode(self._sign(signing_input))}'
+
+    def decode(self, token, realm, typ='Bearer'):
+        '''
+        Returns the token claims or ``None`` if the token is not valid
+        for the given realm.
+        '''
+
+        try:
+            signing_input, signature = token.rsplit('.', 1)
+            if not hmac.compare_digest(self._sign(signing_input), _b64decode(signature)):
+                return None
+            claims = json.loads(_b64decode(signing_input.split('.')[1]))
+        except Exception:
+            return None
+
+        if (
+            claims.get('iss') != f'{self.url}/{realm}' or
+            claims.get('typ') != typ or
+            claims.get('exp', 0) < time() or
+            claims.get('sid') in self.revoked
+        ):
+            return None
+        return claims
+
+    def issue_token(self, realm, username, **userinfo):
+        '''
+        Returns a new token response (access and refresh tokens) for the user.
+        '''
+
+        now = int(time())
+        claims = {
+            'iss': f'{self.url}/{realm}',
+            'sub': str(uuid.uuid5(uuid.NAMESPACE_DNS, f'{realm}.{username}')),
+            'sid': uuid.uuid4().hex,
+            'iat': now,
+            'preferred_username': username,
+            'given_name': userinfo.get('given_name', username.title()),
+            'family_name': userinfo.get('family_name', realm.title()),
+            'email': userinfo.get('email', f'{username}@{realm}.example.com'),
+        }
+
+        return {
+            'access_token': self.encode({
+                **claims,
+                'typ': 'Bearer',
+                'exp': now + self.token_ttl,
+            }),
+            'refresh_token': self.encode({
+                **claims,
+                'typ': 'Refresh',
+                'exp': now + self.token_ttl * 6,
+            }),
+            'token_type': 'Bearer',
+            'expires_in': self.token_ttl,
+            'refresh_expires_in': self.token_ttl * 6,
+            'session_state': claims['sid'],
+        }
+
+    def userinfo(self, claims):
+        return {
+            key: claims[key]
+            for key in ('sub', 'preferred_username', 'given_name', 'family_name', 'email')
+        }
+
+    def _sign(self, signing_input):
+        return hmac.new(self.secret, signing_input.encode('ascii'), hashlib.sha256).digest()
+
+
+def _build_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass  # keep the tests output clean
+
+        def do_HEAD(self):
+            self._dispatch('HEAD')
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def _dispatch(self, method):
+            server.requests.append((method, self.path))
+            if server.latency:
+                sleep(server.latency)
+
+            parts = urlparse(self.path).path.strip('/').split('/')
+            realm, endpoint = parts[0], '/'.join(parts[1:])
+            if not server.realm_exists(realm):
+                return self._reply(404, {'error': 'Realm does not exist'})
+
+            if endpoint == 'account' and method in ('HEAD', 'GET'):
+                return self._reply(200)
+
+            if endpoint == f'{_OID_PATH}/certs' and method == 'GET':
+                return self._reply(200, server.jwks())
+
+            if endpoint == f'{_OID_PATH}/userinfo' and method == 'GET':
+                auth = self.headers.get('Authorization', '')
+                claims = server.decode(auth[len('Bearer '):], realm)
+                if not auth.startswith('Bearer ') or not claims:
+                    return self._reply(401, {'error': 'invalid_token'})
+                return self._reply(200, server.userinfo(claims))
+
+            if endpoint == f'{_OID_PATH}/token' and method == 'POST':
+                return self._token(realm, self._read_form())
+
+            if endpoint == f'{_OID_PATH}/logout' and method == 'POST':
+                claims = server.decode(self._read_form().get('refresh_token', ''), realm, 'Refresh')
+                if not claims:
+                    return self._reply(400, {'error': 'invalid_grant'})
+                server.revoked.add(claims['sid'])
+                return self._reply(204)
+
+            return self._reply(404, {'error': 'Not found'})
+
+        def _token(self, realm, data):
+            grant_type = data.get('grant_type')
+
+            if grant_type == 'password':
+                username = data.get('username')
+                password = data.get('password')
+                if username and (server.users is None or server.users.get(username) == password):
+                    return self._reply(200, server.issue_token(realm, username))
+
+            elif grant_type == 'refresh_token':
+                claims = server.decode(data.get('refresh_token', ''), realm, 'Refresh')
+                if claims:
+                    return self._reply(200, server.issue_token(realm, claims['preferred_username']))
+
+            elif grant_type == 'authorization_code':
+                # the code is the username
+                if data.get('code'):
+                    return self._reply(200, server.issue_token(realm, data['code']))
+
+            return self._reply(401, {'error': 'invalid_grant'})
+
+        def _read_form(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8')
+            return {key: values[0] for key, values in parse_qs(body).items()}
+
+        def _reply(self, status_code, data=None):
+            content = json.dumps(data).encode('utf-8') if data is not None else b''
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(content)
+
+    return Handler
+
+
+def benchmark(fn, iterations=100, warmup=5):
+    '''
+    Executes ``fn`` the given number of times and returns
+    the requests per second and the latency percentiles in milliseconds.
+    '''
+
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    start = perf_counter()
+    for _ in range(iterations):
+        begin = perf_counter()
+        fn()
+        timings.append((perf_counter() - begin) * 1000)
+    elapsed = perf_counter() - start
+
+    percentiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+    return {
+        'iterations': iterations,
+        'rps': round(iterations / elapsed, 2),
+        'p50': round(percentiles[49], 3),
+        'p99': round(percentiles[98], 3),
+    }
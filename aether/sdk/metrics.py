@@ -0,0 +1,105 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+'''
+Prometheus metrics collected by the SDK.
+
+All of them are registered in the default registry and are exposed along with
+the ``django_prometheus`` ones in the ``/admin/~prometheus/metrics`` endpoint.
+'''
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+SESSION_WRITES_AVOIDED = Counter(
+    'aether_sdk_session_writes_avoided_total',
+    'Number of requests that skipped the session write because nothing changed.',
+)
+
+KEYCLOAK_LOGOUTS = Counter(
+    'aether_sdk_keycloak_logouts_total',
+    'Number of logout propagations to the keycloak server by status.',
+    ['status'],  # queued, success, retry, failure
+)
+
+KEYCLOAK_REQUESTS = Counter(
+    'aether_sdk_keycloak_requests_total',
+    'Number of requests to the keycloak server by operation, realm and response status.',
+    ['operation', 'realm', 'status'],  # operation: token, refresh, userinfo, logout, realm
+)
+
+KEYCLOAK_REQUEST_LATENCY = Histogram(
+    'aether_sdk_keycloak_request_duration_seconds',
+    'Response time of the keycloak server by operation and realm.',
+    ['operation', 'realm'],
+)
+
+CACHE_WRAP_CALLS = Counter(
+    'aether_sdk_cache_wrap_calls_total',
+    'Number of calls to the functions decorated with `cache_wrap` by result.',
+    ['function', 'result'],  # hit, miss, stale
+)
+
+CACHE_WRAP_REFRESHES = Counter(
+    'aether_sdk_cache_wrap_refreshes_total',
+    'Number of background refreshes of the functions decorated with `cache_wrap` by result.',
+    ['function', 'result'],  # success, failure
+)
+
+CACHE_WRAP_SIZE = Gauge(
+    'aether_sdk_cache_wrap_size',
+    'Number of entries in the in-process cache of the functions decorated with `cache_wrap`.',
+    ['function'],
+)
+
+CACHE_WRAP_EVICTIONS = Counter(
+    'aether_sdk_cache_wrap_evictions_total',
+    'Number of entries discarded from the in-process cache of `cache_wrap` by reason.',
+    ['function', 'reason'],  # size, expired
+)
+
+CACHE_TAG_INVALIDATIONS = Counter(
+    'aether_sdk_cache_tag_invalidations_total',
+    'Number of invalidations of the cache tags (object tags without primary key).',
+    ['tag'],
+)
+
+REALM_REQUESTS = Counter(
+    'aether_sdk_realm_requests_total',
+    'Number of requests by realm and view.',
+    ['realm', 'view'],
+)
+
+REALM_DB_QUERIES = Counter(
+    'aether_sdk_realm_db_queries_total',
+    'Number of database queries executed by the requests by realm and view.',
+    ['realm', 'view'],
+)
+
+REALM_DB_QUERY_SECONDS = Counter(
+    'aether_sdk_realm_db_query_seconds_total',
+    'Time spent in the database queries executed by the requests by realm and view.',
+    ['realm', 'view'],
+)
+
+REALM_REQUESTS_REJECTED = Counter(
+    'aether_sdk_realm_requests_rejected_total',
+    'Number of requests rejected by the realm limits by realm and reason.',
+    ['realm', 'reason'],  # reason: rate, concurrency
+)
@@ -18,7 +18,7 @@
 
 from django.contrib import admin
 
-from aether.sdk.multitenancy.models import MtInstance
+from aether.sdk.multitenancy.models import MtInstance, MtRealm
 
 
 class MtInstanceAdmin(admin.ModelAdmin):
@@ -34,4 +34,18 @@ class MtInstanceAdmin(admin.ModelAdmin):
     list_per_page = 25
 
 
+class MtRealmAdmin(admin.ModelAdmin):
+
+    list_display = ('name', 'instances',)
+    readonly_fields = list_display
+
+    search_fields = ('name',)
+    ordering = ('name',)
+
+    show_full_result_count = True
+    empty_value_display = '---'
+    list_per_page = 25
+
+
 admin.site.register(MtInstance, MtInstanceAdmin)
+admin.site.register(MtRealm, MtRealmAdmin)
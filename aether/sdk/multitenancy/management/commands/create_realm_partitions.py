@@ -0,0 +1,51 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+
+from aether.sdk.multitenancy.partitions import create_realm_partitions
+from aether.sdk.multitenancy.utils import list_realms
+
+MESSAGE_OK = _('{count} realm partitions created.') + '\n'
+
+
+class Command(BaseCommand):
+
+    help = _('Create the realms partitions of the partitioned models.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--realm',
+            '-r',
+            type=str,
+            help=_('Indicate the realm (all the realms in the registry by default)'),
+            dest='realms',
+            action='append',
+            required=False,
+        )
+
+    def handle(self, *args, **options):
+        '''
+        Creates the missing realms partitions, the rows of the new realms
+        are kept in the default partition meanwhile.
+        '''
+
+        realms = options['realms'] or sorted(list_realms())
+        count = create_realm_partitions(realms)
+        self.stdout.write(MESSAGE_OK.format(count=count))
@@ -0,0 +1,191 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import time
+
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db import connections
+from django.http import JsonResponse
+from django.dispatch import receiver
+from django.utils.deprecation import MiddlewareMixin
+
+from aether.sdk.metrics import (
+    REALM_DB_QUERIES,
+    REALM_DB_QUERY_SECONDS,
+    REALM_REQUESTS,
+    REALM_REQUESTS_REJECTED,
+)
+from aether.sdk.multitenancy.throttling import (
+    acquire_realm_slot,
+    check_realm_rate,
+    release_realm_slot,
+)
+from aether.sdk.multitenancy.utils import (
+    get_realm_database,
+    is_registered_realm,
+    peek_realm,
+    reset_routed_realm,
+    resolve_realm,
+    set_rls_realm,
+    set_routed_realm,
+)
+
+
+class RealmMiddleware(MiddlewareMixin):
+    '''
+    Resolves the current realm once per request and sets it in ``request.realm``
+    and in the ``RealmRouter`` context.
+
+    Must be placed after the authentication middlewares,
+    they can change the realm stored in the session.
+    '''
+
+    def process_request(self, request):
+        request._routed_realm_token = set_routed_realm(resolve_realm(request))
+
+    def process_response(self, request, response):
+        if hasattr(request, '_routed_realm_token'):
+            reset_routed_realm(request._routed_realm_token)
+        return response
+
+
+class RealmRLSMiddleware(MiddlewareMixin):
+    '''
+    Sets the current realm in the database session variable checked by the
+    row level security policies and resets it at the end of the request.
+
+    Must be placed after the ``RealmMiddleware``.
+    '''
+
+    def process_request(self, request):
+        realm = resolve_realm(request)
+        request._rls_database = get_realm_database(realm)
+        set_rls_realm(realm, using=request._rls_database)
+
+    def process_response(self, request, response):
+        # the connection could be reused by the next request,
+        # the view could change the realm (i.e. logging in)
+        if hasattr(request, '_rls_database'):
+            set_rls_realm(None, using=request._rls_database)
+        return response
+
+
+class RealmThrottleMiddleware:
+    '''
+    Limits the rate of requests (``settings.MULTITENANCY_THROTTLE_RATE``) and
+    the number of requests in progress (``settings.MULTITENANCY_MAX_CONCURRENT_REQUESTS``)
+    by realm, the counters are kept in the default cache.
+
+    The realm is not verified yet, the realms not included in the ``MtRealm``
+    registry share the same quota (``-``), the clients cannot exhaust the quota
+    of other realms sending arbitrary names.
+
+    Must be placed before the authentication middlewares, the rejected requests
+    do not hit the database nor the authentication server.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        realm = peek_realm(request)
+        if not is_registered_realm(realm):
+            realm = '-'
+
+        wait = check_realm_rate(realm, settings.MULTITENANCY_THROTTLE_RATE)
+        if wait is not None:
+            return _reject(realm, 'rate', wait)
+
+        max_requests = settings.MULTITENANCY_MAX_CONCURRENT_REQUESTS
+        if not acquire_realm_slot(realm, max_requests):
+            return _reject(realm, 'concurrency', 1)
+
+        try:
+            return self.get_response(request)
+        finally:
+            release_realm_slot(realm, max_requests)
+
+
+def _reject(realm, reason, wait):
+    REALM_REQUESTS_REJECTED.labels(realm, reason).inc()
+    response = JsonResponse(
+        {'detail': f'Request was throttled. Expected available in {wait} seconds.'},
+        status=429,
+    )
+    response['Retry-After'] = str(wait)
+    return response
+
+
+class RealmQueryMetricsMiddleware:
+    '''
+    Counts the database queries executed by the view, and the time spent
+    in them, by realm and view name.
+
+    The anonymous requests and the realms not included in the ``MtRealm``
+    registry are labelled as ``-``, the clients cannot create new series.
+
+    Must be placed after the ``RealmMiddleware``.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = _QueryStats()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+
+        # known after resolving the request path
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match and match.view_name else '-'
+        realm = resolve_realm(request)
+        user = getattr(request, 'user', None)
+        if not (user and user.is_authenticated and is_registered_realm(realm)):
+            realm = '-'
+
+        REALM_REQUESTS.labels(realm, view).inc()
+        REALM_DB_QUERIES.labels(realm, view).inc(stats.count)
+        REALM_DB_QUERY_SECONDS.labels(realm, view).inc(stats.seconds)
+        return response
+
+
+class _QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.monotonic() - start
+
+
+@receiver(user_logged_out)
+def _user_logged_out(sender, user, request, **kwargs):
+    # the session is going to be flushed
+    if request is not None and hasattr(request, '_current_realm'):
+        resolve_realm(request, use_session=False)
@@ -0,0 +1,81 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from collections import Counter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, migrations, models
+
+
+def populate_realms(apps, schema_editor):
+    # the registry is kept in the default database
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+
+    MtInstance = apps.get_model('multitenancy', 'MtInstance')
+    MtRealm = apps.get_model('multitenancy', 'MtRealm')
+
+    databases = {DEFAULT_DB_ALIAS, *getattr(settings, 'MULTITENANCY_DATABASES', {}).values()}
+    counts = Counter()
+    for database in sorted(databases):
+        # the databases not migrated yet are counted later with ``refresh_realms``
+        if MtInstance._meta.db_table not in connections[database].introspection.table_names():
+            continue
+
+        counts.update(dict(
+            MtInstance.objects
+            .using(database)
+            .order_by()
+            .values('realm')
+            .annotate(count=models.Count('pk'))
+            .values_list('realm', 'count')
+        ))
+
+    MtRealm.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+        MtRealm(name=realm, instances=count)
+        for realm, count in counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multitenancy', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MtRealm',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID',
+                    )),
+                ('name', models.TextField(unique=True, verbose_name='name')),
+                ('instances', models.PositiveIntegerField(default=0, verbose_name='instances')),
+            ],
+            options={
+                'verbose_name': 'realm',
+                'verbose_name_plural': 'realms',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.RunPython(populate_realms, migrations.RunPython.noop),
+    ]
@@ -16,12 +16,22 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import islice
+
+from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
-from aether.sdk.multitenancy.utils import get_current_realm
+from aether.sdk.multitenancy.utils import annotate_realm, get_current_realm, get_realm_databases
 
 
 class MtInstance(models.Model):
@@ -47,6 +57,13 @@ class MtInstance(models.Model):
     def __str__(self):
         return str(self.instance)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(MtInstance, cls).from_db(db, field_names, values)
+        # keep the stored realm to update the realms registry after saving
+        instance._stored_realm = instance.__dict__.get('realm', _UNKNOWN)
+        return instance
+
     class Meta:
         app_label = 'multitenancy'
         ordering = ['instance']
@@ -57,11 +74,90 @@ class MtInstance(models.Model):
         verbose_name_plural = _('instances by realm')
 
 
+class MtRealm(models.Model):
+    '''
+    Multitenancy model to keep the list of realms with linked instances.
+
+    Maintained by the ``MtInstance`` signals and refreshed after the bulk
+    operations with ``refresh_realms``. The counts are updated once the
+    transactions are committed, never below zero.
+
+    The ``MtInstance`` deletion signal (needed to keep the counts) prevents
+    the "fast delete" of the links, they are fetched before deleting them.
+
+    :ivar text     name:      The realm name.
+    :ivar int      instances: Number of instances linked to the realm.
+    '''
+
+    name = models.TextField(
+        unique=True,
+        verbose_name=_('name'),
+    )
+
+    instances = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('instances'),
+    )
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        app_label = 'multitenancy'
+        ordering = ['name']
+        verbose_name = _('realm')
+        verbose_name_plural = _('realms')
+
+
+class MtQuerySet(models.QuerySet):
+    '''
+    The local realm field (``mt_realm_field``) is kept by the ``pre_save`` signal,
+    skipped by ``bulk_create`` and ``update``. ``bulk_create`` copies the realm of
+    the linked instances in the child models, after any ``update`` that changes
+    the ``mt_path`` relation run ``utils.backfill_realm``. The rows without local
+    realm belong to the default realm.
+    '''
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        _set_mt_realms(self.model, objs)
+        return super(MtQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def delete(self):
+        if not issubclass(self.model, MtModelAbstract):
+            return super(MtQuerySet, self).delete()
+
+        with _deleting_mt_instances():
+            return super(MtQuerySet, self).delete()
+
+    def with_realm(self):
+        '''
+        Includes the instances realm in the same query.
+        '''
+
+        if issubclass(self.model, MtModelChildAbstract):
+            if not self.model.mt_path:
+                return self  # unknown path
+            return annotate_realm(self, self.model.mt_path)
+        return annotate_realm(self)
+
+
 class MtModelAbstract(models.Model):
     '''
     The ``settings.MULTITENANCY_MODEL`` class must extend this one.
+
+    :ivar str mt_realm_field: (Optional) Name of the local field that keeps
+                              a copy of the instance realm to filter by realm
+                              without joining the ``MtInstance`` table.
+    :ivar bool mt_rls:        (Optional) Indicates that the table is protected by
+                              the realm row level security policy.
     '''
 
+    mt_realm_field = None
+    mt_rls = False
+
+    objects = MtQuerySet.as_manager()
+
     def add_to_realm(self, request):
         '''
         Adds the instance to the current realm.
@@ -93,11 +189,19 @@ class MtModelAbstract(models.Model):
         if not settings.MULTITENANCY:
             return None
 
+        realm = _get_known_realm(self)
+        if realm is not _UNKNOWN:
+            return realm or settings.DEFAULT_REALM
+
         try:
             return self.mt.realm
         except ObjectDoesNotExist:
             return settings.DEFAULT_REALM
 
+    def delete(self, *args, **kwargs):
+        with _deleting_mt_instances():
+            return super(MtModelAbstract, self).delete(*args, **kwargs)
+
     class Meta:
         abstract = True
 
@@ -108,27 +212,309 @@ class MtModelChildAbstract(models.Model):
     and implement the ``get_mt_instance`` method.
 
     The type of relation could be one to one or one to many but never many to many.
+
+    :ivar str mt_path:        (Optional) Lookup path to the ``settings.MULTITENANCY_MODEL``
+                              instance, like ``parent`` or ``parent__parent``.
+    :ivar str mt_realm_field: (Optional) Name of the local field that keeps
+                              a copy of the instance realm. Requires ``mt_path``.
+    :ivar bool mt_rls:        (Optional) Indicates that the table is protected by
+                              the realm row level security policy.
+    :ivar bool mt_partitioned: (Optional) Indicates that the table is partitioned
+                               by the realm field, new realms get a new partition.
     '''
 
+    mt_path = None
+    mt_realm_field = None
+    mt_rls = False
+    mt_partitioned = False
+
+    objects = MtQuerySet.as_manager()
+
     def is_accessible(self, realm):
         '''
         Checks if the instance "realm" is the given realm.
         '''
 
-        return self.get_mt_instance().is_accessible(realm)
+        return settings.MULTITENANCY and self.get_realm() == realm
 
     def get_realm(self):
         '''
         Returns the instance "realm" or the default one if missing.
         '''
 
+        if not settings.MULTITENANCY:
+            return None
+
+        realm = _get_known_realm(self)
+        if realm is not _UNKNOWN:
+            return realm or settings.DEFAULT_REALM
+
         return self.get_mt_instance().get_realm()
 
     def get_mt_instance(self):
         '''
         Returns the ``settings.MULTITENANCY_MODEL`` instance linked to this one.
+
+        Follows the ``mt_path`` if indicated otherwise must be implemented.
         '''
-        raise NotImplementedError
+
+        if not self.mt_path:
+            raise NotImplementedError
+
+        instance = self
+        for name in self.mt_path.split('__'):
+            instance = getattr(instance, name)
+        return instance
 
     class Meta:
         abstract = True
+
+
+_UNKNOWN = object()
+# the ``settings.MULTITENANCY_MODEL`` instances are being deleted (with their links)
+_DELETING_MT_INSTANCES = ContextVar('aether_sdk_deleting_mt_instances', default=False)
+
+
+@contextmanager
+def _deleting_mt_instances():
+    token = _DELETING_MT_INSTANCES.set(True)
+    try:
+        yield
+    finally:
+        _DELETING_MT_INSTANCES.reset(token)
+
+
+def _get_known_realm(instance):
+    # realm annotated in the query (``MtQuerySet.with_realm``, ``utils.filter_by_realm``)
+    return instance.__dict__.get('mt_realm', _UNKNOWN)
+
+
+def get_mt_realm_models():
+    '''
+    Returns the child models that keep a copy of the realm.
+    '''
+
+    return [
+        model
+        for model in apps.get_models()
+        if issubclass(model, MtModelChildAbstract) and model.mt_realm_field and model.mt_path
+    ]
+
+
+def _set_mt_realms(model, objs):
+    # copies the realm of the linked instances with one query, like ``_mt_pre_save``
+    realm_field = getattr(model, 'mt_realm_field', None)
+    mt_path = getattr(model, 'mt_path', None)
+    if not settings.MULTITENANCY or not realm_field or not mt_path or not objs:
+        return
+
+    name, *path = mt_path.split('__')
+    fk = model._meta.get_field(name)
+    target = fk.target_field.name
+    ids = {getattr(obj, fk.attname) for obj in objs} - {None}
+    realms = {}
+    if ids:
+        realms = dict(
+            fk.related_model._base_manager
+            .filter(**{f'{target}__in': ids})
+            .values_list(target, '__'.join(path + ['mt', 'realm']))
+        )
+
+    for obj in objs:
+        setattr(obj, realm_field, realms.get(getattr(obj, fk.attname)))
+
+
+def _get_mt_realm(instance):
+    try:
+        return instance.mt.realm
+    except ObjectDoesNotExist:
+        return None
+
+
+@receiver(pre_save)
+def _mt_pre_save(sender, instance, raw, **kwargs):
+    if raw or not settings.MULTITENANCY or not getattr(sender, 'mt_realm_field', None):
+        return
+
+    # the ``MtInstance`` is the source of truth, the in-memory value could be outdated
+    if isinstance(instance, MtModelAbstract):
+        realm = None if instance._state.adding else _get_mt_realm(instance)
+    elif isinstance(instance, MtModelChildAbstract):
+        realm = _get_mt_realm(instance.get_mt_instance())
+    else:
+        return
+
+    setattr(instance, sender.mt_realm_field, realm)
+
+
+@receiver(pre_save, sender=MtInstance)
+def _mt_instance_pre_save(sender, instance, raw, **kwargs):
+    if raw or instance.pk is None:
+        return
+
+    # not loaded from the database (or with the realm deferred)
+    if getattr(instance, '_stored_realm', _UNKNOWN) is _UNKNOWN:
+        instance._stored_realm = MtInstance.objects \
+            .filter(pk=instance.pk) \
+            .values_list('realm', flat=True) \
+            .first()
+
+
+@receiver(post_save, sender=MtInstance)
+def _mt_instance_saved(sender, instance, raw, created, **kwargs):
+    if not raw:
+        # keep the linked python object up to date
+        model = _get_mt_model()
+        if model.mt_realm_field and MtInstance.instance.is_cached(instance):
+            setattr(instance.instance, model.mt_realm_field, instance.realm)
+
+        stored_realm = None if created else getattr(instance, '_stored_realm', None)
+        if stored_realm != instance.realm:
+            _sync_realm([instance.instance_id], instance.realm)
+            _count_realms({stored_realm: -1, instance.realm: 1}, using=instance._state.db)
+        instance._stored_realm = instance.realm
+
+
+@receiver(post_delete, sender=MtInstance)
+def _mt_instance_deleted(sender, instance, **kwargs):
+    # the linked instance and its children are deleted too (cascade)
+    if not _DELETING_MT_INSTANCES.get():
+        _sync_realm([instance.instance_id], None)
+
+    stored_realm = getattr(instance, '_stored_realm', _UNKNOWN)
+    realm = instance.realm if stored_realm is _UNKNOWN else stored_realm
+    _count_realms({realm: -1}, using=instance._state.db)
+
+
+def bulk_add_to_realm(instances, realm, batch_size=None):
+    '''
+    Adds the instances (list or queryset) to the realm even if they already
+    belong to another one.
+
+    Executes four queries per batch of ``settings.MULTITENANCY_BATCH_SIZE``
+    instances, plus one for each linked model with local realm field,
+    and updates the affected realms counts at the end.
+    '''
+
+    if not settings.MULTITENANCY:
+        return
+
+    batch_size = batch_size or settings.MULTITENANCY_BATCH_SIZE
+    if isinstance(instances, models.QuerySet):
+        pks = instances.values_list('pk', flat=True).iterator(chunk_size=batch_size)
+    else:
+        pks = (instance.pk for instance in instances)
+
+    deltas = Counter()
+    while True:
+        batch = list(dict.fromkeys(islice(pks, batch_size)))
+        if not batch:
+            break
+
+        # Django 3.2 does not support ``update_conflicts``:
+        # insert the missing ones and then update the rest
+        stored = dict(
+            MtInstance.objects
+            .filter(instance_id__in=batch)
+            .order_by()
+            .values_list('instance_id', 'realm')
+        )
+        MtInstance.objects.bulk_create(
+            [MtInstance(instance_id=pk, realm=realm) for pk in batch if pk not in stored],
+            ignore_conflicts=True,
+        )
+        moved = [pk for pk, stored_realm in stored.items() if stored_realm != realm]
+        MtInstance.objects.filter(instance_id__in=moved).update(realm=realm)
+        _sync_realm(batch, realm)
+
+        deltas[realm] += len(batch) - len(stored) + len(moved)
+        deltas.subtract(stored[pk] for pk in moved)
+
+    _count_realms(deltas, using=router.db_for_write(MtInstance))
+
+    if not isinstance(instances, models.QuerySet):
+        model = _get_mt_model()
+        for instance in instances:
+            # remove the outdated ``mt`` relation
+            instance._state.fields_cache.pop('mt', None)
+            if model.mt_realm_field:
+                setattr(instance, model.mt_realm_field, realm)
+
+
+def _get_mt_model():
+    return MtInstance._meta.get_field('instance').related_model
+
+
+def _sync_realm(instance_ids, realm):
+    model = _get_mt_model()
+    if model.mt_realm_field:
+        model._base_manager \
+            .filter(pk__in=instance_ids) \
+            .update(**{model.mt_realm_field: realm})
+
+    for child_model in get_mt_realm_models():
+        child_model._base_manager \
+            .filter(**{f'{child_model.mt_path}__in': instance_ids}) \
+            .update(**{child_model.mt_realm_field: realm})
+
+
+def refresh_realms(realms=None):
+    '''
+    Recalculates the number of linked instances of the given realms
+    (all of them if ``None``) in the realms registry, in all the realms databases.
+
+    To be used after bulk operations that skip the ``MtInstance`` signals.
+    '''
+
+    qs = MtInstance.objects.order_by()
+    if realms is not None:
+        realms = set(realms)
+        qs = qs.filter(realm__in=realms)
+    qs = qs.values('realm').annotate(count=models.Count('pk')).values_list('realm', 'count')
+
+    counts = Counter()
+    for database in get_realm_databases():
+        counts.update(dict(qs.using(database)))
+    with transaction.atomic():
+        MtRealm.objects.bulk_create(
+            [MtRealm(name=name) for name in counts],
+            ignore_conflicts=True,
+        )
+
+        entries = MtRealm.objects.select_for_update()
+        if realms is not None:
+            entries = entries.filter(name__in=realms)
+        entries = list(entries)
+        for entry in entries:
+            entry.instances = counts.get(entry.name, 0)
+        MtRealm.objects.bulk_update(entries, ['instances'])
+
+
+def _count_realms(deltas, using=DEFAULT_DB_ALIAS):
+    '''
+    Adds the deltas to the realms counts once the current transaction
+    is committed, the changes of the discarded savepoints are discarded too.
+
+    Keeps the registry rows locked only for a moment instead of until
+    the end of each transaction that links or unlinks instances.
+    '''
+
+    deltas = {realm: delta for realm, delta in deltas.items() if realm is not None and delta}
+    if not deltas:
+        return
+
+    def flush():
+        for realm, delta in deltas.items():
+            _count_realm(realm, delta)
+
+    transaction.on_commit(flush, using=using)
+
+
+def _count_realm(realm, delta):
+    qs = MtRealm.objects.filter(name=realm)
+    if delta < 0:
+        # never below zero, even if the count was already outdated
+        qs.update(instances=Greatest(F('instances') + delta, 0))
+    elif not qs.update(instances=F('instances') + delta):
+        MtRealm.objects.bulk_create([MtRealm(name=realm)], ignore_conflicts=True)
+        qs.update(instances=F('instances') + delta)
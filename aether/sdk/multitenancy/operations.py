@@ -0,0 +1,223 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from django.conf import settings
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+from aether.sdk.multitenancy.partitions import add_realm_partition, get_partition_name
+from aether.sdk.multitenancy.utils import RLS_REALM_VARIABLE
+
+RLS_POLICY_NAME = 'aether_realm_isolation'
+
+
+class EnableRealmRLS(Operation):
+    '''
+    Migration operation that enables the realm row level security policy
+    in the model table. Only for PostgreSQL databases, ignored otherwise.
+
+    The rows are only visible if the realm column is the one set in the
+    database session variable (``utils.set_rls_realm``) or if the variable
+    is not set (management commands, background jobs...). The rows without
+    realm (``bulk_create``, ``update``...) belong to ``settings.DEFAULT_REALM``,
+    the value at the time the migration is applied.
+
+    ::
+
+        operations = [
+            ...
+            EnableRealmRLS('MyModel', realm_field='realm'),
+        ]
+    '''
+
+    reversible = True
+    reduces_to_sql = True
+
+    def __init__(self, model_name, realm_field='realm'):
+        self.model_name = model_name
+        self.realm_field = realm_field
+
+    def deconstruct(self):
+        return (
+            self.__class__.__name__,
+            [self.model_name],
+            {'realm_field': self.realm_field},
+        )
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+
+        table, column = self._get_table_column(app_label, schema_editor, to_state)
+        default_realm = schema_editor.quote_value(settings.DEFAULT_REALM)
+        current_realm = f"current_setting('{RLS_REALM_VARIABLE}', true)"
+        condition = (
+            f"COALESCE({current_realm}, '') = ''"
+            f' OR COALESCE({column}, {default_realm}) = {current_realm}'
+        )
+        schema_editor.execute(f'ALTER TABLE {table} ENABLE ROW LEVEL SECURITY')
+        # the table owner is usually the application database user
+        schema_editor.execute(f'ALTER TABLE {table} FORCE ROW LEVEL SECURITY')
+        schema_editor.execute(
+            f'CREATE POLICY {RLS_POLICY_NAME} ON {table}'
+            f' USING ({condition}) WITH CHECK ({condition})'
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+
+        table, _ = self._get_table_column(app_label, schema_editor, from_state)
+        schema_editor.execute(f'DROP POLICY IF EXISTS {RLS_POLICY_NAME} ON {table}')
+        schema_editor.execute(f'ALTER TABLE {table} NO FORCE ROW LEVEL SECURITY')
+        schema_editor.execute(f'ALTER TABLE {table} DISABLE ROW LEVEL SECURITY')
+
+    def describe(self):
+        return f'Enable realm row level security on {self.model_name}'
+
+    @property
+    def migration_name_fragment(self):
+        return f'{self.model_name.lower()}_realm_rls'
+
+    def _get_table_column(self, app_label, schema_editor, state):
+        model = state.apps.get_model(app_label, self.model_name)
+        column = model._meta.get_field(self.realm_field).column
+        quote_name = schema_editor.quote_name
+        return quote_name(model._meta.db_table), quote_name(column)
+
+
+class PartitionByRealm(Operation):
+    '''
+    Migration operation that replaces the model table with a table partitioned
+    by the realm column (LIST partitioning), with a partition for each one of
+    the existing realms plus the default one. Only for PostgreSQL databases,
+    ignored otherwise.
+
+    The primary key and the unique constraints must include the partition column,
+    that is the reason why the model table cannot have unique constraints
+    (other than the primary key, replaced by an index) nor be referenced by
+    other tables.
+
+    ::
+
+        operations = [
+            ...
+            PartitionByRealm('MyModel', realm_field='realm'),
+        ]
+    '''
+
+    reversible = False
+    reduces_to_sql = False
+
+    def __init__(self, model_name, realm_field='realm'):
+        self.model_name = model_name
+        self.realm_field = realm_field
+
+    def deconstruct(self):
+        return (
+            self.__class__.__name__,
+            [self.model_name],
+            {'realm_field': self.realm_field},
+        )
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        connection = schema_editor.connection
+        if connection.vendor != 'postgresql':
+            return
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        self._check_model(model)
+
+        meta = model._meta
+        quote_name = schema_editor.quote_name
+        table = meta.db_table
+        column = meta.get_field(self.realm_field).column
+        pk_column = meta.pk.column
+        old_table = truncate_name(f'{table}_unpartitioned', connection.ops.max_name_length())
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk_column])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(
+                f'SELECT DISTINCT {quote_name(column)} FROM {quote_name(table)}'
+                f' WHERE {quote_name(column)} IS NOT NULL'
+            )
+            realms = [row[0] for row in cursor.fetchall()]
+
+        schema_editor.execute(f'ALTER TABLE {quote_name(table)} RENAME TO {quote_name(old_table)}')
+        schema_editor.execute(
+            f'CREATE TABLE {quote_name(table)} (LIKE {quote_name(old_table)} INCLUDING DEFAULTS)'
+            f' PARTITION BY LIST ({quote_name(column)})'
+        )
+        schema_editor.execute(
+            f'CREATE TABLE {quote_name(get_partition_name(table, None, connection))}'
+            f' PARTITION OF {quote_name(table)} DEFAULT'
+        )
+        schema_editor.execute(
+            f'INSERT INTO {quote_name(table)} SELECT * FROM {quote_name(old_table)}'
+        )
+        if sequence:
+            # otherwise it is dropped along with the old table
+            schema_editor.execute(
+                f'ALTER SEQUENCE {sequence} OWNED BY {quote_name(table)}.{quote_name(pk_column)}'
+            )
+        schema_editor.execute(f'DROP TABLE {quote_name(old_table)}')
+
+        # the indexes and foreign keys names are free again
+        schema_editor.execute(
+            schema_editor._create_index_sql(model, fields=[meta.pk], suffix='_pk')
+        )
+        for sql in schema_editor._model_indexes_sql(model):
+            schema_editor.execute(sql)
+        for field in meta.local_fields:
+            if field.remote_field and field.db_constraint:
+                schema_editor.execute(
+                    schema_editor._create_fk_sql(model, field, '_fk_%(to_table)s_%(to_column)s')
+                )
+
+        for realm in realms:
+            add_realm_partition(model, realm, self.realm_field, schema_editor)
+
+    def describe(self):
+        return f'Partition {self.model_name} by realm'
+
+    @property
+    def migration_name_fragment(self):
+        return f'{self.model_name.lower()}_realm_partitions'
+
+    def _check_model(self, model):
+        meta = model._meta
+        meta.get_field(self.realm_field)
+
+        if meta.related_objects or meta.local_many_to_many:
+            raise ValueError(
+                f'{model.__name__} cannot be partitioned, it is referenced by other tables.'
+            )
+
+        if (
+            any(field.unique and not field.primary_key for field in meta.local_fields) or
+            meta.unique_together or
+            meta.total_unique_constraints
+        ):
+            raise ValueError(f'{model.__name__} cannot be partitioned, it has unique constraints.')
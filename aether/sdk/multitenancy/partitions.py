@@ -0,0 +1,149 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, router
+from django.db.backends.utils import names_digest, truncate_name
+
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.LOGGING_LEVEL)
+
+
+def get_mt_partitioned_models():
+    '''
+    Returns the models with the table partitioned by realm.
+    '''
+
+    return [
+        model
+        for model in apps.get_models()
+        if getattr(model, 'mt_partitioned', False) and getattr(model, 'mt_realm_field', None)
+    ]
+
+
+def get_partition_name(table, realm, connection):
+    '''
+    Returns the name of the realm partition table, ``None`` for the default one.
+    '''
+
+    suffix = 'default' if realm is None else names_digest(realm, length=8)
+    return truncate_name(f'{table}_{suffix}', connection.ops.max_name_length())
+
+
+def add_realm_partition(model, realm, realm_field=None, schema_editor=None):
+    '''
+    Creates the realm partition of the model table, moves the realm rows
+    kept in the default partition and attaches it.
+
+    Only for PostgreSQL databases. Returns ``True`` if the partition was created.
+    '''
+
+    if schema_editor is None:
+        connection = connections[router.db_for_write(model)]
+        if connection.vendor != 'postgresql':
+            return False
+
+        with connection.schema_editor() as schema_editor:
+            return add_realm_partition(model, realm, realm_field, schema_editor)
+
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return False
+
+    table = model._meta.db_table
+    partition = get_partition_name(table, realm, connection)
+    if _table_exists(connection, partition):
+        return False
+
+    quote_name = schema_editor.quote_name
+    column = quote_name(model._meta.get_field(realm_field or model.mt_realm_field).column)
+    default = quote_name(get_partition_name(table, None, connection))
+
+    schema_editor.execute(
+        f'CREATE TABLE {quote_name(partition)} (LIKE {quote_name(table)} INCLUDING DEFAULTS)'
+    )
+    # the default partition cannot keep rows of the attached realms
+    schema_editor.execute(
+        f'WITH moved AS (DELETE FROM {default} WHERE {column} = %s RETURNING *)'
+        f' INSERT INTO {quote_name(partition)} SELECT * FROM moved',
+        [realm],
+    )
+    # the statement is formatted even without parameters
+    value = schema_editor.quote_value(realm).replace('%', '%%')
+    schema_editor.execute(
+        f'ALTER TABLE {quote_name(table)} ATTACH PARTITION {quote_name(partition)}'
+        f' FOR VALUES IN ({value})'
+    )
+    return True
+
+
+def detach_realm_partition(model, realm, drop=False):
+    '''
+    Detaches the realm partition of the model table, the realm rows are no longer
+    accessible through the model. Much faster than deleting them.
+
+    Only for PostgreSQL databases. Returns ``True`` if the partition was detached.
+    '''
+
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor != 'postgresql':
+        return False
+
+    table = model._meta.db_table
+    partition = get_partition_name(table, realm, connection)
+    if not _table_exists(connection, partition):
+        return False
+
+    with connection.schema_editor() as schema_editor:
+        quote_name = schema_editor.quote_name
+        schema_editor.execute(
+            f'ALTER TABLE {quote_name(table)} DETACH PARTITION {quote_name(partition)}'
+        )
+        if drop:
+            schema_editor.execute(f'DROP TABLE {quote_name(partition)}')
+    return True
+
+
+def create_realm_partitions(realms):
+    '''
+    Creates the realms partitions of all the partitioned models.
+    Returns the number of partitions created.
+
+    Takes table locks, run it out of the requests (``create_realm_partitions``
+    management command), the rows of the new realms are kept in the default
+    partition meanwhile.
+    '''
+
+    count = 0
+    for model in get_mt_partitioned_models():
+        for realm in realms:
+            try:
+                count += add_realm_partition(model, realm)
+            except Exception as e:
+                # the realm rows are kept in the default partition
+                logger.warning(f'Partition of realm "{realm}" in {model.__name__} failed: {str(e)}')
+    return count
+
+
+def _table_exists(connection, name):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [connection.ops.quote_name(name)])
+        return cursor.fetchone()[0] is not None
@@ -0,0 +1,85 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from django.apps import apps
+
+from aether.sdk.multitenancy.models import MtInstance, MtModelAbstract, MtModelChildAbstract
+from aether.sdk.multitenancy.utils import (
+    get_realm_database,
+    get_realm_databases,
+    get_routed_realm,
+)
+
+
+def _is_routed(model):
+    return issubclass(model, (MtInstance, MtModelAbstract, MtModelChildAbstract))
+
+
+class RealmRouter:
+    '''
+    Routes the multitenancy models queries to the database of the current realm
+    indicated in ``settings.MULTITENANCY_DATABASES``, the ``default`` one otherwise.
+
+    The rest of models (users, groups, sessions, realms registry...) are kept
+    in the ``default`` database.
+    '''
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        '''
+        The multitenancy instances can be related with the instances of the same
+        database and with the ones kept in the ``default`` database (users...).
+        '''
+
+        routed1, routed2 = _is_routed(type(obj1)), _is_routed(type(obj2))
+        if routed1 and routed2:
+            return obj1._state.db == obj2._state.db
+        if routed1 or routed2:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        '''
+        The multitenancy models tables are only created in the realms databases.
+        '''
+
+        if model_name is None:
+            return None
+
+        try:
+            model = apps.get_model(app_label, model_name)
+        except LookupError:
+            return None
+        return db in get_realm_databases() if _is_routed(model) else None
+
+    def _db_for_model(self, model, instance=None, **hints):
+        if not _is_routed(model):
+            return None
+
+        # keep the related multitenancy instances together,
+        # the rest of instances (users...) are in the default database
+        if instance is not None and _is_routed(type(instance)) and instance._state.db:
+            return instance._state.db
+
+        realm = get_routed_realm()
+        return get_realm_database(realm) if realm else None
@@ -16,10 +16,18 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from rest_framework.serializers import PrimaryKeyRelatedField
+from django.core.exceptions import ValidationError as DjangoValidationError
+
+from rest_framework.relations import MANY_RELATION_KWARGS, ManyRelatedField
+from rest_framework.serializers import ListSerializer, PrimaryKeyRelatedField, ValidationError
 
 from aether.sdk.drf.serializers import DynamicFieldsModelSerializer
-from aether.sdk.multitenancy.utils import filter_by_realm, filter_users_by_realm
+from aether.sdk.multitenancy.models import bulk_add_to_realm
+from aether.sdk.multitenancy.utils import (
+    filter_by_realm,
+    filter_users_by_realm,
+    get_current_realm,
+)
 
 
 class MtModelSerializer(DynamicFieldsModelSerializer):
@@ -31,15 +39,77 @@ class MtModelSerializer(DynamicFieldsModelSerializer):
 
     def create(self, validated_data):
         instance = super(MtModelSerializer, self).create(validated_data)
-        instance.add_to_realm(self.context['request'])
+        # the list serializer adds all the new instances at once
+        if not getattr(self, '_mt_bulk', False):
+            instance.add_to_realm(self.context['request'])
         return instance
 
 
+class MtListSerializer(ListSerializer):
+    '''
+    Overrides ``create`` method to add all the new instances to the current realm
+    at once.
+
+    Set it as ``Meta.list_serializer_class`` in the ``MtModelSerializer`` subclasses.
+    '''
+
+    def create(self, validated_data):
+        # keeps the child ``create`` overrides, only the realm is added in bulk
+        self.child._mt_bulk = True
+        try:
+            instances = [self.child.create(attrs) for attrs in validated_data]
+        finally:
+            self.child._mt_bulk = False
+        bulk_add_to_realm(instances, get_current_realm(self.context['request']))
+        return instances
+
+
+class MtManyRelatedField(ManyRelatedField):
+    '''
+    Overrides ``to_internal_value`` method to fetch all the related instances
+    in one query instead of one query per primary key, and reports all the
+    missing ones (or not accessible by the current realm) at once.
+    '''
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+
+        child = self.child_relation
+        queryset = child.get_queryset()
+        pk_field = queryset.model._meta.pk
+
+        pks = []
+        for item in data:
+            if child.pk_field is not None:
+                item = child.pk_field.to_internal_value(item)
+            try:
+                if isinstance(item, bool):
+                    raise TypeError
+                pks.append(pk_field.to_python(item))
+            except (DjangoValidationError, TypeError, ValueError):
+                child.fail('incorrect_type', data_type=type(item).__name__)
+
+        instances = {obj.pk: obj for obj in queryset.filter(pk__in=set(pks))}
+        missing = [pk for pk in dict.fromkeys(pks) if pk not in instances]
+        if missing:
+            raise ValidationError(
+                [child.error_messages['does_not_exist'].format(pk_value=pk) for pk in missing],
+                code='does_not_exist',
+            )
+
+        return [instances[pk] for pk in pks]
+
+
 class MtPrimaryKeyRelatedField(PrimaryKeyRelatedField):
     '''
     Overrides ``get_queryset`` method to include filter by realm.
 
     Expects ``mt_field`` property.
+
+    With ``many=True`` validates all the primary keys in one query.
     '''
 
     mt_field = None
@@ -48,6 +118,14 @@ class MtPrimaryKeyRelatedField(PrimaryKeyRelatedField):
         self.mt_field = kwargs.pop('mt_field', self.mt_field)
         super(MtPrimaryKeyRelatedField, self).__init__(**kwargs)
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return MtManyRelatedField(**list_kwargs)
+
     def get_queryset(self):
         qs = super(MtPrimaryKeyRelatedField, self).get_queryset()
         qs = filter_by_realm(self.context['request'], qs, self.mt_field)
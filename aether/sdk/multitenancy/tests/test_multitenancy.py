@@ -17,13 +17,27 @@
 # under the License.
 
 import base64
+import importlib
+import io
 
+from unittest import mock
+
+from django.apps import apps
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.contrib.auth import get_user_model, logout
+from django.contrib.auth.models import Group
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.migrations.state import ProjectState
+from django.http import HttpResponse
 from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from rest_framework import status
+from prometheus_client import REGISTRY
+from rest_framework import serializers, status
 from rest_framework.authtoken.models import Token
 
 from aether.sdk.tests import AetherTestCase
@@ -37,7 +51,34 @@ from aether.sdk.tests.fakeapp.serializers import (
     TestModelSerializer,
     TestChildModelSerializer,
 )
-from aether.sdk.multitenancy.models import MtInstance
+from aether.sdk.multitenancy.middleware import (
+    RealmMiddleware,
+    RealmRLSMiddleware,
+    RealmThrottleMiddleware,
+)
+from aether.sdk.multitenancy.models import (
+    MtInstance,
+    MtRealm,
+    _count_realms,
+    bulk_add_to_realm,
+    refresh_realms,
+)
+from aether.sdk.multitenancy.operations import EnableRealmRLS, PartitionByRealm
+from aether.sdk.multitenancy.partitions import (
+    add_realm_partition,
+    detach_realm_partition,
+    get_mt_partitioned_models,
+    get_partition_name,
+)
+from aether.sdk.multitenancy.routers import RealmRouter
+from aether.sdk.multitenancy.serializers import MtManyRelatedField, MtPrimaryKeyRelatedField
+from aether.sdk.multitenancy.throttling import (
+    RealmRateThrottle,
+    acquire_realm_slot,
+    check_realm_rate,
+    parse_rate,
+    release_realm_slot,
+)
 from aether.sdk.multitenancy import utils
 from aether.sdk.utils import get_meta_http_name
 
@@ -105,6 +146,341 @@ class MultitenancyTests(AetherTestCase):
         self.assertEqual(str(realm1), str(obj1))
         self.assertEqual(realm1.realm, TEST_REALM)
 
+    def test_models__realm_field(self):
+        obj1 = TestModel.objects.create(name='one')
+        child1 = TestChildModel.objects.create(name='child', parent=obj1)
+        self.assertIsNone(obj1.realm)
+        self.assertIsNone(child1.realm)
+
+        obj1.add_to_realm(self.request)
+        self.assertEqual(obj1.realm, TEST_REALM)
+        child1.refresh_from_db()
+        self.assertEqual(child1.realm, TEST_REALM)
+
+        child2 = TestChildModel.objects.create(name='child', parent=obj1)
+        self.assertEqual(child2.realm, TEST_REALM)
+
+        # the outdated values are not saved
+        obj1_copy = TestModel.objects.get(pk=obj1.pk)
+        MtInstance.objects.filter(instance=obj1).update(realm=TEST_REALM_2)
+        obj1_copy.save()
+        self.assertEqual(obj1_copy.realm, TEST_REALM_2)
+
+        # changes in the realm are propagated
+        mt = MtInstance.objects.get(instance=obj1)
+        mt.realm = TEST_REALM
+        mt.save()
+        self.assertEqual(TestModel.objects.get(pk=obj1.pk).realm, TEST_REALM)
+        self.assertEqual(TestChildModel.objects.filter(realm=TEST_REALM).count(), 2)
+
+        # saved without realm changes
+        with self.assertNumQueries(1):
+            mt.save()
+
+        mt.delete()
+        self.assertIsNone(TestModel.objects.get(pk=obj1.pk).realm)
+        self.assertEqual(TestChildModel.objects.filter(realm__isnull=True).count(), 2)
+
+        # filter without joins
+        obj1.add_to_realm(self.request)
+        for model, mt_field in [(TestModel, None), (TestChildModel, 'parent')]:
+            qs = utils.filter_by_realm(self.request, model.objects.all(), mt_field)
+            self.assertNotIn('multitenancy_mtinstance', str(qs.query))
+            self.assertTrue(qs.exists())
+            self.assertEqual(qs.first().mt_realm, TEST_REALM)
+
+        grandchild = TestGrandChildModel.objects.create(name='grandchild', parent=child1)
+        qs = utils.filter_by_realm(self.request, TestGrandChildModel.objects, 'parent__parent')
+        self.assertIn('multitenancy_mtinstance', str(qs.query))
+        self.assertEqual(list(qs), [grandchild])
+
+        # the realm is not synchronized in the rows being deleted
+        obj2 = TestModel.objects.create(name='two')
+        obj2.add_to_realm(self.request)
+        with mock.patch('aether.sdk.multitenancy.models._sync_realm') as mock_sync:
+            obj1.delete()
+            TestModel.objects.filter(pk=obj2.pk).delete()
+        mock_sync.assert_not_called()
+        self.assertFalse(TestChildModel.objects.exists())
+        self.assertFalse(MtInstance.objects.exists())
+
+    def test_models__with_realm(self):
+        obj1 = TestModel.objects.create(name='one')
+        obj1.add_to_realm(self.request)
+        TestModel.objects.create(name='two')
+        child1 = TestChildModel.objects.create(name='child', parent=obj1)
+        TestGrandChildModel.objects.create(name='grandchild', parent=child1)
+
+        with self.assertNumQueries(2):
+            objs = list(TestModel.objects.with_realm().order_by('name'))
+            children = list(TestChildModel.objects.with_realm())
+
+            self.assertEqual([o.get_realm() for o in objs], [TEST_REALM, settings.DEFAULT_REALM])
+            self.assertTrue(objs[0].is_accessible(TEST_REALM))
+            self.assertFalse(objs[1].is_accessible(TEST_REALM))
+            self.assertTrue(objs[1].is_accessible(settings.DEFAULT_REALM))
+
+            self.assertEqual(children[0].get_realm(), TEST_REALM)
+            self.assertTrue(children[0].is_accessible(TEST_REALM))
+
+        # without local realm field
+        qs = utils.annotate_realm(TestGrandChildModel.objects, 'parent__parent')
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.first().get_realm(), TEST_REALM)
+        # unknown path
+        grandchild = TestGrandChildModel.objects.with_realm().first()
+        self.assertRaises(NotImplementedError, grandchild.get_realm)
+
+        # annotated by the views, the permission check does not need the parent
+        url = reverse('testchildmodel-detail', kwargs={'pk': child1.pk})
+        with mock.patch.object(TestModel, 'get_realm', side_effect=AssertionError):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_backfill_realm(self):
+        obj1 = TestModel.objects.create(name='one')
+        obj1.add_to_realm(self.request)
+        obj2 = TestModel.objects.create(name='two')
+        TestModel.objects.create(name='three')
+        MtInstance.objects.create(instance=obj2, realm=TEST_REALM_2)
+        TestChildModel.objects.create(name='child', parent=obj1)
+        TestChildModel.objects.create(name='child', parent=obj2)
+
+        TestModel.objects.update(realm=None)
+        TestChildModel.objects.update(realm=None)
+
+        with self.assertNumQueries(6):  # 3 batches (+1 empty) and 3 updates
+            utils.backfill_realm(TestModel, batch_size=2)
+        utils.backfill_realm(TestChildModel, mt_path='parent')
+
+        self.assertEqual(
+            list(TestModel.objects.order_by('pk').values_list('realm', flat=True)),
+            [TEST_REALM, TEST_REALM_2, None],
+        )
+        self.assertEqual(
+            list(TestChildModel.objects.order_by('pk').values_list('realm', flat=True)),
+            [TEST_REALM, TEST_REALM_2],
+        )
+
+    def test_models__bulk_create(self):
+        obj1 = TestModel.objects.create(name='one')
+        obj1.add_to_realm(self.request)
+        obj2 = TestModel.objects.create(name='two')
+
+        # the pre_save signal is skipped but the realm is copied in one query
+        with self.assertNumQueries(2):
+            TestChildModel.objects.bulk_create([
+                TestChildModel(name='child-1', parent=obj1),
+                TestChildModel(name='child-2', parent=obj2),
+            ])
+        self.assertEqual(
+            list(TestChildModel.objects.order_by('pk').values_list('realm', flat=True)),
+            [TEST_REALM, None],
+        )
+        self.assertEqual(
+            list(utils.filter_by_realm(self.request, TestChildModel.objects)
+                 .values_list('name', flat=True)),
+            ['child-1'],
+        )
+
+        # the rows without realm belong to the default realm
+        self.request.COOKIES[settings.REALM_COOKIE] = settings.DEFAULT_REALM
+        self.assertEqual(
+            list(utils.filter_by_realm(self.request, TestChildModel.objects)
+                 .values_list('name', flat=True)),
+            ['child-2'],
+        )
+        self.assertEqual(
+            list(utils.filter_by_realm(self.request, TestModel.objects)
+                 .values_list('name', flat=True)),
+            ['two'],
+        )
+        # until the realm is backfilled
+        TestModel.objects.update(realm=None)
+        self.assertEqual(
+            utils.filter_by_realm(self.request, TestModel.objects).count(),
+            2,
+        )
+
+    def test_bulk_add_to_realm(self):
+        TestModel.objects.bulk_create([TestModel(name=str(i)) for i in range(5)])
+        objs = list(TestModel.objects.order_by('pk'))
+        child = TestChildModel.objects.create(name='child', parent=objs[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            objs[0].add_to_realm(self.request)
+        self.assertEqual(objs[0].mt.realm, TEST_REALM)
+
+        # 3 batches * (stored realms + insert + 2 realm fields updates)
+        # + 1 update of the moved ones, the realms counts after commit
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertNumQueries(12 + 1):
+                bulk_add_to_realm(objs, TEST_REALM_2, batch_size=2)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(utils.get_realms_sizes(), {
+            settings.DEFAULT_REALM: 0,
+            TEST_REALM_2: 5,
+        })
+
+        self.assertEqual(MtInstance.objects.filter(realm=TEST_REALM_2).count(), 5)
+        self.assertEqual(TestModel.objects.filter(realm=TEST_REALM_2).count(), 5)
+        child.refresh_from_db()
+        self.assertEqual(child.realm, TEST_REALM_2)
+        for obj in objs:
+            self.assertEqual(obj.realm, TEST_REALM_2)
+            self.assertEqual(obj.get_realm(), TEST_REALM_2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_add_to_realm(
+                TestModel.objects.filter(pk__in=[objs[0].pk, objs[1].pk]),
+                TEST_REALM,
+            )
+        self.assertEqual(
+            list(TestModel.objects.with_realm().order_by('pk').values_list('mt_realm', flat=True)),
+            [TEST_REALM, TEST_REALM] + [TEST_REALM_2] * 3,
+        )
+        self.assertEqual(MtInstance.objects.count(), 5)
+        self.assertEqual(utils.get_realms_sizes(), {
+            settings.DEFAULT_REALM: 0,
+            TEST_REALM: 2,
+            TEST_REALM_2: 3,
+        })
+
+        with override_settings(MULTITENANCY=False):
+            bulk_add_to_realm(objs, TEST_REALM)
+        self.assertEqual(MtInstance.objects.filter(realm=TEST_REALM).count(), 2)
+
+    def test_realms_registry(self):
+        self.assertEqual(utils.get_realms_sizes(), {settings.DEFAULT_REALM: 0})
+
+        obj1 = TestModel.objects.create(name='one')
+        obj2 = TestModel.objects.create(name='two')
+        with self.captureOnCommitCallbacks(execute=True):
+            obj1.add_to_realm(self.request)
+            obj2.add_to_realm(self.request)
+            # counted after commit
+            self.assertFalse(MtRealm.objects.filter(name=TEST_REALM).exists())
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM).instances, 2)
+
+        # move to another realm
+        self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM_2
+        with self.captureOnCommitCallbacks(execute=True):
+            obj2.add_to_realm(self.request)
+        self.assertEqual(utils.get_realms_sizes(), {
+            settings.DEFAULT_REALM: 0,
+            TEST_REALM: 1,
+            TEST_REALM_2: 1,
+        })
+
+        with self.captureOnCommitCallbacks(execute=True):
+            # saving the same realm does not change the counts
+            obj2.add_to_realm(self.request)
+            # not loaded from the database
+            MtInstance(pk=obj1.mt.pk, instance=obj1, realm=TEST_REALM_2).save()
+        self.assertEqual(utils.get_realms_sizes(), {
+            settings.DEFAULT_REALM: 0,
+            TEST_REALM_2: 2,
+        })
+        self.assertEqual(utils.list_realms(), {settings.DEFAULT_REALM, TEST_REALM_2})
+
+        # the changes of the discarded savepoints are discarded too
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    obj1.delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM_2).instances, 2)
+        obj1 = TestModel.objects.get(name='one')
+
+        # deleting the instance deletes the link
+        with self.captureOnCommitCallbacks(execute=True):
+            obj1.delete()
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM_2).instances, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            MtInstance.objects.all().delete()
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM_2).instances, 0)
+        self.assertEqual(utils.list_realms(), {settings.DEFAULT_REALM})
+
+        # outdated counts never go below zero
+        MtRealm.objects.filter(name=TEST_REALM_2).update(instances=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            _count_realms({TEST_REALM_2: -5})
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM_2).instances, 0)
+
+        # skipping the signals
+        MtInstance.objects.bulk_create([MtInstance(instance=obj2, realm=TEST_REALM)])
+        self.assertEqual(utils.list_realms(), {settings.DEFAULT_REALM})
+        refresh_realms()
+        self.assertEqual(utils.get_realms_sizes(), {
+            settings.DEFAULT_REALM: 0,
+            TEST_REALM: 1,
+        })
+
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.assertTrue(utils.is_registered_realm(settings.DEFAULT_REALM))
+        self.assertFalse(utils.is_registered_realm(None))
+        self.assertFalse(utils.is_registered_realm('unknown'))
+        with self.assertNumQueries(0):
+            # cached
+            self.assertTrue(utils.is_registered_realm(TEST_REALM))
+            self.assertTrue(utils.is_registered_realm(TEST_REALM_2))
+
+        # the migration counts the links too (only in the default database)
+        populate_realms = importlib.import_module(
+            'aether.sdk.multitenancy.migrations.0002_mtrealm'
+        ).populate_realms
+        MtRealm.objects.all().delete()
+        populate_realms(apps, mock.Mock(connection=mock.Mock(alias='shard')))
+        self.assertFalse(MtRealm.objects.exists())
+        populate_realms(apps, mock.Mock(connection=connection))
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM).instances, 1)
+
+        # counts the links of all the realms databases
+        with mock.patch(
+            'aether.sdk.multitenancy.models.get_realm_databases',
+            return_value=['default', 'default'],
+        ):
+            refresh_realms([TEST_REALM])
+        self.assertEqual(MtRealm.objects.get(name=TEST_REALM).instances, 2)
+
+    def test_serializers__many(self):
+        serializer = TestModelSerializer(
+            data=[{'name': str(i)} for i in range(10)],
+            context={'request': self.request},
+            many=True,
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(10 + 4):  # 10 inserts + bulk realm
+                serializer.save()
+        self.assertEqual(utils.get_realms_sizes()[TEST_REALM], 10)
+
+        self.assertEqual(MtInstance.objects.filter(realm=TEST_REALM).count(), 10)
+        self.assertEqual(TestModel.objects.filter(realm=TEST_REALM).count(), 10)
+
+        # the child serializer ``create`` overrides are kept
+        class CustomSerializer(TestModelSerializer):
+            def create(self, validated_data):
+                validated_data['name'] = 'custom-' + validated_data['name']
+                return super(CustomSerializer, self).create(validated_data)
+
+        serializer = CustomSerializer(
+            data=[{'name': str(i)} for i in range(2)],
+            context={'request': self.request},
+            many=True,
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(2 + 4):  # 2 inserts + bulk realm
+                serializer.save()
+        self.assertEqual(
+            sorted(TestModel.objects.filter(name__startswith='custom-', realm=TEST_REALM)
+                   .values_list('name', flat=True)),
+            ['custom-0', 'custom-1'],
+        )
+
     def test_serializers(self):
         obj1 = TestModelSerializer(
             data={'name': 'a name'},
@@ -169,6 +545,41 @@ class MultitenancyTests(AetherTestCase):
         self.assertEqual(str(child2.errors['parent'][0]),
                          f'Invalid pk "{obj2.pk}" - object does not exist.')
 
+    def test_serializers__many_related(self):
+        class ParentsSerializer(serializers.Serializer):
+            parents = MtPrimaryKeyRelatedField(many=True, queryset=TestModel.objects.all())
+
+        self.assertIsInstance(ParentsSerializer().fields['parents'], MtManyRelatedField)
+
+        objs = [TestModel.objects.create(name=str(i)) for i in range(5)]
+        bulk_add_to_realm(objs[:3], TEST_REALM)
+        bulk_add_to_realm(objs[3:], TEST_REALM_2)
+
+        pks = [objs[2].pk, objs[0].pk, objs[2].pk]
+        serializer = ParentsSerializer(data={'parents': pks}, context={'request': self.request})
+        with self.assertNumQueries(1):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(serializer.validated_data['parents'], [objs[2], objs[0], objs[2]])
+
+        # reports all the missing ones at once
+        pks = [objs[0].pk, objs[3].pk, 99, objs[4].pk]
+        serializer = ParentsSerializer(data={'parents': pks}, context={'request': self.request})
+        with self.assertNumQueries(1):
+            self.assertFalse(serializer.is_valid())
+        self.assertEqual(
+            [str(error) for error in serializer.errors['parents']],
+            [f'Invalid pk "{pk}" - object does not exist.' for pk in pks[1:]],
+        )
+        self.assertEqual(serializer.errors['parents'][0].code, 'does_not_exist')
+
+        serializer = ParentsSerializer(data={'parents': ['a']}, context={'request': self.request})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['parents'][0].code, 'incorrect_type')
+
+        serializer = ParentsSerializer(data={'parents': 1}, context={'request': self.request})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['parents'][0].code, 'not_a_list')
+
     def test_views(self):
         # create data assigned to different realms
         realm1_group = utils.get_auth_group(self.request)
@@ -289,6 +700,135 @@ class MultitenancyTests(AetherTestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_views__is_accessible_queries(self):
+        obj1 = TestModel.objects.create(name='one')
+        child1 = TestChildModel.objects.create(name='child1', parent=obj1)
+        obj1.add_to_realm(self.request)
+
+        self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM_2
+        obj2 = TestModel.objects.create(name='two')
+        obj2.add_to_realm(self.request)
+
+        def count_model_queries(model, url, expected_status):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.head(url)
+            self.assertEqual(response.status_code, expected_status)
+            return len([
+                q for q in ctx.captured_queries
+                if f'"{model._meta.db_table}"' in q['sql']
+            ])
+
+        # existence and realm are checked in one query
+        for model, pk, expected_status in [
+            (TestModel, obj1.pk, 204),
+            (TestModel, obj2.pk, 403),
+            (TestModel, 99, 404),
+            (TestChildModel, child1.pk, 204),
+        ]:
+            url = reverse(f'{model._meta.model_name}-is-accessible', kwargs={'pk': pk})
+            self.assertEqual(count_model_queries(model, url, expected_status), 1, url)
+
+    def test_views__are_accessible(self):
+        obj1 = TestModel.objects.create(name='one')
+        child1 = TestChildModel.objects.create(name='child1', parent=obj1)
+        obj1.add_to_realm(self.request)
+
+        self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM_2
+        obj2 = TestModel.objects.create(name='two')
+        child2 = TestChildModel.objects.create(name='child2', parent=obj2)
+        obj2.add_to_realm(self.request)
+
+        url = reverse('testmodel-are-accessible')
+        self.assertEqual(url, '/testtestmodel/is-accessible/')
+        expected = {
+            str(obj1.pk): 'accessible',
+            str(obj2.pk): 'forbidden',
+            '99': 'missing',
+            'abc': 'missing',
+        }
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f'{url}?pk={obj1.pk},{obj2.pk}&pk=99&pk=abc')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected)
+        # all of them are checked in one query
+        self.assertEqual(
+            len([q for q in ctx.captured_queries if TestModel._meta.db_table in q['sql']]),
+            1,
+        )
+
+        response = self.client.post(
+            url,
+            data=[obj1.pk, obj2.pk, 99, 'abc'],
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected)
+
+        url = reverse('testchildmodel-are-accessible')
+        response = self.client.post(
+            url,
+            data={'pk': [child1.pk, child2.pk]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            str(child1.pk): 'accessible',
+            str(child2.pk): 'forbidden',
+        })
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {})
+
+        with override_settings(MULTITENANCY_MAX_ACCESSIBLE_PKS=2):
+            response = self.client.get(f'{url}?pk=1,2,3')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.post(url, data=[1, 2, 3], content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            # duplicated keys are checked once
+            response = self.client.get(f'{url}?pk=1,2,1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(DJANGO_USE_CACHE=True)
+    @mock.patch('aether.sdk.drf.views.clear_cache')
+    def test_views__cache_invalidation(self, mock_clear):
+        response = self.client.get(reverse('testmodel-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_clear.assert_not_called()
+
+        # lookups with POST do not edit anything
+        response = self.client.post(
+            reverse('testmodel-are-accessible'),
+            data=[1, 2],
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_clear.assert_not_called()
+
+        response = self.client.post(
+            reverse('testmodel-list'),
+            data={'name': 'one'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_clear.assert_called_once_with(
+            models=[],
+            purge=False,
+            realm=TEST_REALM,
+            tags=['model:fakeapp.testmodel', f'model:fakeapp.testmodel:realm:{TEST_REALM}'],
+        )
+
+        mock_clear.reset_mock()
+        pk = response.json()['id']
+        response = self.client.patch(
+            reverse('testmodel-detail', kwargs={'pk': pk}),
+            data={'name': 'two'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(mock_clear.call_args.kwargs['tags'][-1], f'object:fakeapp.testmodel:{pk}')
+
     def test_get_current_realm(self):
         request = RequestFactory().get('/')
         self.assertEqual(utils.get_current_realm(request), settings.DEFAULT_REALM)
@@ -304,6 +844,529 @@ class MultitenancyTests(AetherTestCase):
         request.session[settings.REALM_COOKIE] = 'in-session'
         self.assertEqual(utils.get_current_realm(request), 'in-session')
 
+    def test_realm_middleware(self):
+        request = RequestFactory().get(reverse('testmodel-list', kwargs={'realm': TEST_REALM_2}))
+        setattr(request, 'session', {settings.REALM_COOKIE: 'in-session'})
+        request.COOKIES[settings.REALM_COOKIE] = 'in-cookies'
+
+        with mock.patch('aether.sdk.multitenancy.utils.resolve',
+                        wraps=utils.resolve) as mock_resolve:
+            RealmMiddleware(lambda r: None).process_request(request)
+            self.assertEqual(request.realm, TEST_REALM_2)
+
+            for _ in range(10):
+                self.assertEqual(utils.get_path_realm(request), TEST_REALM_2)
+                self.assertEqual(utils.get_current_realm(request), TEST_REALM_2)
+            mock_resolve.assert_called_once()
+
+        request = RequestFactory().get('/')
+        setattr(request, 'session', SessionStore())
+        RealmMiddleware(lambda r: None).process_request(request)
+        self.assertEqual(request.realm, settings.DEFAULT_REALM)
+        self.assertIsNone(utils.get_current_realm(request, default_realm=None))
+
+        # the session is only checked once
+        request.session[settings.REALM_COOKIE] = 'in-session'
+        self.assertEqual(utils.get_current_realm(request), settings.DEFAULT_REALM)
+
+        # unless the realm is changed with the helper
+        utils.set_current_realm(request, 'in-session')
+        self.assertEqual(request.realm, 'in-session')
+        self.assertEqual(utils.get_current_realm(request), 'in-session')
+
+        # or the user logs out
+        request.user = self.request.user
+        request.COOKIES[settings.REALM_COOKIE] = 'in-cookies'
+        logout(request)
+        self.assertEqual(request.realm, 'in-cookies')
+        self.assertEqual(utils.get_current_realm(request), 'in-cookies')
+
+    def test_realm_middleware__requests(self):
+        response = self.client.get(reverse('testmodel-list'))
+        self.assertEqual(response.wsgi_request.realm, TEST_REALM)
+
+        session = self.client.session
+        session[settings.REALM_COOKIE] = TEST_REALM_2
+        session.save()
+
+        response = self.client.get(reverse('testmodel-list'))
+        self.assertEqual(response.wsgi_request.realm, TEST_REALM_2)
+
+    def test_realm_middleware__router(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.REALM_COOKIE] = TEST_REALM
+
+        with utils.use_realm(None):
+            response = RealmMiddleware(lambda request: utils.get_routed_realm())(request)
+            self.assertEqual(response, TEST_REALM)
+            self.assertIsNone(utils.get_routed_realm())
+
+    @override_settings(MULTITENANCY_DATABASES={TEST_REALM_2: 'shard'})
+    def test_router(self):
+        router = RealmRouter()
+        obj = TestModel.objects.create(name='one')
+
+        with utils.use_realm(None):
+            self.assertIsNone(router.db_for_read(TestModel))
+            self.assertIsNone(router.db_for_write(TestModel))
+
+            with utils.use_realm(TEST_REALM_2):
+                self.assertEqual(utils.get_routed_realm(), TEST_REALM_2)
+                for model in (TestModel, TestChildModel, MtInstance):
+                    self.assertEqual(router.db_for_read(model), 'shard')
+                    self.assertEqual(router.db_for_write(model), 'shard')
+                # kept in the default database
+                for model in (Group, MtRealm, TestNoMtModel):
+                    self.assertIsNone(router.db_for_read(model))
+                    self.assertIsNone(router.db_for_write(model))
+                # with the related instance
+                self.assertEqual(router.db_for_read(TestChildModel, instance=obj), 'default')
+                # the shared instances are not kept together
+                user = get_user_model().objects.first()
+                self.assertEqual(router.db_for_write(TestModel, instance=user), 'shard')
+
+                # relations
+                shard_obj = TestModel(name='shard')
+                shard_obj._state.db = 'shard'
+                self.assertFalse(router.allow_relation(obj, shard_obj))
+                self.assertTrue(router.allow_relation(obj, TestModel.objects.first()))
+                self.assertTrue(router.allow_relation(shard_obj, user))
+                self.assertTrue(router.allow_relation(user, shard_obj))
+                self.assertIsNone(router.allow_relation(user, Group()))
+
+            with utils.use_realm(TEST_REALM):
+                self.assertEqual(router.db_for_read(TestModel), 'default')
+
+            self.assertIsNone(utils.get_routed_realm())
+
+        self.assertEqual(utils.filter_by_realm(self.request, TestModel.objects.all()).db, 'default')
+        self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM_2
+        self.assertEqual(utils.filter_by_realm(self.request, TestModel.objects.all()).db, 'shard')
+        self.assertEqual(utils.filter_by_realm(self.request, TestModel.objects).db, 'shard')
+
+        # migrations
+        self.assertEqual(utils.get_realm_databases(), ['default', 'shard'])
+        for db in ('default', 'shard'):
+            self.assertTrue(router.allow_migrate(db, 'fakeapp', 'testmodel'))
+            self.assertTrue(router.allow_migrate(db, 'multitenancy', 'mtinstance'))
+            self.assertIsNone(router.allow_migrate(db, 'multitenancy', 'mtrealm'))
+        self.assertFalse(router.allow_migrate('other', 'fakeapp', 'testchildmodel'))
+        self.assertIsNone(router.allow_migrate('other', 'auth', 'user'))
+        self.assertIsNone(router.allow_migrate('other', 'fakeapp'))
+        self.assertIsNone(router.allow_migrate('other', 'fakeapp', 'unknown'))
+
+    def test_throttling(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.assertEqual(parse_rate(None), (None, None))
+        self.assertEqual(parse_rate('100/s'), (100, 1))
+        self.assertEqual(parse_rate('10/minute'), (10, 60))
+        self.assertEqual(parse_rate('1/hour'), (1, 3600))
+
+        self.assertIsNone(check_realm_rate(TEST_REALM, None))
+        self.assertIsNone(check_realm_rate(TEST_REALM, '2/d'))
+        self.assertIsNone(check_realm_rate(TEST_REALM, '2/d'))
+        self.assertGreater(check_realm_rate(TEST_REALM, '2/d'), 0)
+        self.assertIsNone(check_realm_rate(TEST_REALM_2, '2/d'))
+
+        self.assertTrue(acquire_realm_slot(TEST_REALM, 0))
+        self.assertTrue(acquire_realm_slot(TEST_REALM, 1))
+        self.assertFalse(acquire_realm_slot(TEST_REALM, 1))
+        self.assertTrue(acquire_realm_slot(TEST_REALM_2, 1))
+        release_realm_slot(TEST_REALM, 1)
+        self.assertTrue(acquire_realm_slot(TEST_REALM, 1))
+
+        # the counter expiration is never extended (leaked slots)
+        with mock.patch('aether.sdk.multitenancy.throttling.cache.touch') as mock_touch:
+            self.assertFalse(acquire_realm_slot(TEST_REALM, 1))
+            mock_touch.assert_not_called()
+
+        # the counter expired while the requests were in progress
+        cache.delete('aether-sdk:realm-in-flight:' + TEST_REALM)
+        self.assertTrue(acquire_realm_slot(TEST_REALM, 2))
+        release_realm_slot(TEST_REALM, 2)
+        release_realm_slot(TEST_REALM, 2)
+        self.assertEqual(cache.get('aether-sdk:realm-in-flight:' + TEST_REALM), 0)
+
+        # cache not available, never rejects
+        with mock.patch('aether.sdk.multitenancy.throttling.cache.incr', side_effect=Exception):
+            self.assertIsNone(check_realm_rate(TEST_REALM, '2/d'))
+            self.assertTrue(acquire_realm_slot(TEST_REALM, 1))
+
+    def test_throttle_middleware(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        MtRealm.objects.bulk_create([MtRealm(name=TEST_REALM), MtRealm(name=TEST_REALM_2)])
+
+        def get_request(realm):
+            request = RequestFactory().get('/')
+            request.COOKIES[settings.REALM_COOKIE] = realm
+            # the session is not checked
+            request.session = mock.Mock(side_effect=AssertionError)
+            return request
+
+        rejected = REGISTRY.get_sample_value(
+            'aether_sdk_realm_requests_rejected_total',
+            {'realm': TEST_REALM, 'reason': 'rate'},
+        ) or 0
+
+        middleware = RealmThrottleMiddleware(lambda request: HttpResponse())
+        with override_settings(MULTITENANCY_THROTTLE_RATE='1/d'):
+            self.assertEqual(middleware(get_request(TEST_REALM)).status_code, 200)
+            response = middleware(get_request(TEST_REALM))
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response['Retry-After']), 0)
+            self.assertEqual(middleware(get_request(TEST_REALM_2)).status_code, 200)
+
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'aether_sdk_realm_requests_rejected_total',
+                {'realm': TEST_REALM, 'reason': 'rate'},
+            ),
+            rejected + 1,
+        )
+
+        # the nested request is rejected while the first one is in progress
+        def nested(request):
+            response = middleware(get_request(TEST_REALM))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            return HttpResponse()
+
+        middleware = RealmThrottleMiddleware(nested)
+        with override_settings(MULTITENANCY_MAX_CONCURRENT_REQUESTS=1):
+            self.assertEqual(middleware(get_request(TEST_REALM)).status_code, 200)
+            # released
+            self.assertTrue(acquire_realm_slot(TEST_REALM, 1))
+
+        # the unknown realms share the same quota
+        middleware = RealmThrottleMiddleware(lambda request: HttpResponse())
+        with override_settings(MULTITENANCY_THROTTLE_RATE='1/d'):
+            self.assertEqual(middleware(get_request('unknown-1')).status_code, 200)
+            self.assertEqual(middleware(get_request('unknown-2')).status_code, 429)
+
+        self.assertIsNone(REGISTRY.get_sample_value(
+            'aether_sdk_realm_requests_rejected_total',
+            {'realm': 'unknown-2', 'reason': 'rate'},
+        ))
+        self.assertGreater(REGISTRY.get_sample_value(
+            'aether_sdk_realm_requests_rejected_total',
+            {'realm': '-', 'reason': 'rate'},
+        ), 0)
+
+    def test_realm_rate_throttle(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        with override_settings(MULTITENANCY_THROTTLE_RATE=None):
+            throttle = RealmRateThrottle()
+            self.assertTrue(throttle.allow_request(self.request, None))
+            self.assertTrue(throttle.allow_request(self.request, None))
+
+        with override_settings(MULTITENANCY_THROTTLE_RATE='1/d'):
+            self.assertTrue(RealmRateThrottle().allow_request(self.request, None))
+            throttle = RealmRateThrottle()
+            self.assertFalse(throttle.allow_request(self.request, None))
+            self.assertGreater(throttle.wait(), 0)
+
+            self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM_2
+            self.assertTrue(RealmRateThrottle().allow_request(self.request, None))
+
+    def test_realm_query_metrics(self):
+        def get_value(name, realm=TEST_REALM, view='testmodel-list'):
+            return REGISTRY.get_sample_value(
+                f'aether_sdk_realm_{name}_total',
+                {'realm': realm, 'view': view},
+            ) or 0
+
+        cache.clear()
+        self.addCleanup(cache.clear)
+        MtRealm.objects.create(name=TEST_REALM)
+
+        requests = get_value('requests')
+        queries = get_value('db_queries')
+        seconds = get_value('db_query_seconds')
+        anonymous = get_value('requests', realm='-')
+
+        middleware = settings.MIDDLEWARE + [
+            'aether.sdk.multitenancy.middleware.RealmQueryMetricsMiddleware',
+        ]
+        with override_settings(MIDDLEWARE=middleware):
+            response = self.client.get(reverse('testmodel-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get('/unknown')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            # unknown realm
+            self.client.cookies[settings.REALM_COOKIE] = 'unknown'
+            response = self.client.get(reverse('testmodel-list'))
+            self.assertEqual(get_value('requests', realm='unknown'), 0)
+            self.assertEqual(get_value('requests', realm='-'), anonymous + 1)
+
+            # anonymous user
+            self.client.logout()
+            self.client.cookies[settings.REALM_COOKIE] = TEST_REALM
+            response = self.client.get(reverse('testmodel-list'))
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self.assertEqual(get_value('requests', realm='-'), anonymous + 2)
+
+        self.assertEqual(get_value('requests'), requests + 1)
+        self.assertGreater(get_value('db_queries'), queries)
+        self.assertGreater(get_value('db_query_seconds'), seconds)
+        self.assertGreater(get_value('requests', view='-'), 0)
+
+        stats = utils.collect_realm_stats()
+        self.assertIn(
+            {
+                'realm': TEST_REALM,
+                'view': 'testmodel-list',
+                'requests': get_value('requests'),
+                'queries': get_value('db_queries'),
+                'seconds': get_value('db_query_seconds'),
+            },
+            stats,
+        )
+        self.assertEqual(stats, sorted(stats, key=lambda entry: -entry['seconds']))
+
+        # only admin users
+        url = reverse('get-realm-stats')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secretsecret')
+        self.assertTrue(self.client.login(username='admin', password='secretsecret'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(TEST_REALM, [entry['realm'] for entry in response.json()['stats']])
+
+    def test_rls_middleware(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.REALM_COOKIE] = TEST_REALM
+        middleware = RealmRLSMiddleware(lambda request: 'response')
+
+        with mock.patch('aether.sdk.multitenancy.middleware.set_rls_realm') as mock_set:
+            self.assertEqual(middleware(request), 'response')
+        self.assertEqual(mock_set.call_args_list, [
+            mock.call(TEST_REALM, using='default'),
+            mock.call(None, using='default'),
+        ])
+
+        # in the realm database
+        with mock.patch('aether.sdk.multitenancy.middleware.set_rls_realm') as mock_set, \
+                override_settings(MULTITENANCY_DATABASES={TEST_REALM: 'shard'}):
+            self.assertEqual(middleware(request), 'response')
+        self.assertEqual(mock_set.call_args_list, [
+            mock.call(TEST_REALM, using='shard'),
+            mock.call(None, using='shard'),
+        ])
+
+        # resets the same database even if the view changes the realm
+        def change_realm(request):
+            request.COOKIES[settings.REALM_COOKIE] = 'another'
+            return 'response'
+
+        middleware = RealmRLSMiddleware(change_realm)
+        with mock.patch('aether.sdk.multitenancy.middleware.set_rls_realm') as mock_set, \
+                override_settings(MULTITENANCY_DATABASES={TEST_REALM: 'shard'}):
+            self.assertEqual(middleware(request), 'response')
+        self.assertEqual(mock_set.call_args_list, [
+            mock.call(TEST_REALM, using='shard'),
+            mock.call(None, using='shard'),
+        ])
+
+    @override_settings(MULTITENANCY_RLS=True)
+    def test_rls(self):
+        obj = TestModel.objects.create(name='one')
+        obj.add_to_realm(self.request)
+        obj = TestModel.objects.get(pk=obj.pk)
+        connection.ensure_connection()
+
+        # only PostgreSQL
+        with self.assertNumQueries(0):
+            utils.set_rls_realm(TEST_REALM)
+        self.assertFalse(utils.is_protected_by_rls(TestModel, TEST_REALM))
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor') as mock_cursor, \
+                mock.patch.object(TestModel, 'mt_rls', True):
+            mock_execute = mock_cursor.return_value.__enter__.return_value.execute
+
+            self.assertFalse(utils.is_protected_by_rls(TestModel, TEST_REALM))
+            utils.set_rls_realm(TEST_REALM)
+            mock_execute.assert_called_once_with(
+                'SELECT set_config(%s, %s, false)',
+                ['aether.realm', TEST_REALM],
+            )
+            self.assertTrue(utils.is_protected_by_rls(TestModel, TEST_REALM))
+            self.assertFalse(utils.is_protected_by_rls(TestModel, TEST_REALM_2))
+            self.assertFalse(utils.is_protected_by_rls(TestChildModel, TEST_REALM))
+
+            # skips the object check, the database already did it
+            self.request.COOKIES[settings.REALM_COOKIE] = TEST_REALM
+            with self.assertNumQueries(0):
+                self.assertTrue(utils.is_accessible_by_realm(self.request, obj))
+
+            utils.set_rls_realm(None)
+            mock_execute.assert_called_with(
+                'SELECT set_config(%s, %s, false)',
+                ['aether.realm', ''],
+            )
+            self.assertFalse(utils.is_protected_by_rls(TestModel, TEST_REALM))
+
+    def test_rls_operation(self):
+        operation = EnableRealmRLS('TestModel')
+        self.assertEqual(
+            operation.deconstruct(),
+            ('EnableRealmRLS', ['TestModel'], {'realm_field': 'realm'}),
+        )
+        state = ProjectState.from_apps(apps)
+
+        schema_editor = mock.Mock()
+        schema_editor.quote_name = connection.ops.quote_name
+        schema_editor.quote_value = lambda value: f"'{value}'"
+
+        # only PostgreSQL
+        schema_editor.connection.vendor = 'sqlite'
+        operation.database_forwards('fakeapp', schema_editor, state, state)
+        schema_editor.execute.assert_not_called()
+
+        schema_editor.connection.vendor = 'postgresql'
+
+        operation.database_forwards('fakeapp', schema_editor, state, state)
+        sql = [c.args[0] for c in schema_editor.execute.call_args_list]
+        self.assertEqual(sql[:2], [
+            'ALTER TABLE "fakeapp_testmodel" ENABLE ROW LEVEL SECURITY',
+            'ALTER TABLE "fakeapp_testmodel" FORCE ROW LEVEL SECURITY',
+        ])
+        self.assertIn('CREATE POLICY aether_realm_isolation ON "fakeapp_testmodel"', sql[2])
+        # the rows without realm belong to the default realm
+        self.assertIn(
+            f'COALESCE("realm", \'{settings.DEFAULT_REALM}\')'
+            " = current_setting('aether.realm', true)",
+            sql[2],
+        )
+        self.assertNotIn('IS NULL', sql[2])
+
+        schema_editor.execute.reset_mock()
+        operation.database_backwards('fakeapp', schema_editor, state, state)
+        sql = [c.args[0] for c in schema_editor.execute.call_args_list]
+        self.assertEqual(sql, [
+            'DROP POLICY IF EXISTS aether_realm_isolation ON "fakeapp_testmodel"',
+            'ALTER TABLE "fakeapp_testmodel" NO FORCE ROW LEVEL SECURITY',
+            'ALTER TABLE "fakeapp_testmodel" DISABLE ROW LEVEL SECURITY',
+        ])
+
+    def test_partitions(self):
+        self.assertEqual(get_mt_partitioned_models(), [])
+
+        # only PostgreSQL
+        self.assertFalse(add_realm_partition(TestChildModel, TEST_REALM))
+        self.assertFalse(detach_realm_partition(TestChildModel, TEST_REALM))
+
+        with mock.patch.object(TestChildModel, 'mt_partitioned', True), \
+                mock.patch(
+                    'aether.sdk.multitenancy.partitions.add_realm_partition',
+                    side_effect=[True, False, True],
+                ) as mock_add:
+            self.assertEqual(get_mt_partitioned_models(), [TestChildModel])
+
+            # new realms do not get partitions within the requests
+            obj1 = TestModel.objects.create(name='one')
+            with self.captureOnCommitCallbacks(execute=True):
+                obj1.add_to_realm(self.request)
+            mock_add.assert_not_called()
+
+            out = io.StringIO()
+            call_command('create_realm_partitions', stdout=out)
+            self.assertEqual(out.getvalue(), '1 realm partitions created.\n')
+            self.assertEqual(
+                [c.args for c in mock_add.call_args_list],
+                [(TestChildModel, settings.DEFAULT_REALM), (TestChildModel, TEST_REALM)],
+            )
+
+            call_command('create_realm_partitions', '--realm=new', stdout=out)
+            mock_add.assert_called_with(TestChildModel, 'new')
+
+        schema_editor = mock.Mock()
+        schema_editor.connection.vendor = 'postgresql'
+        schema_editor.connection.ops = connection.ops
+        schema_editor.quote_name = connection.ops.quote_name
+        schema_editor.quote_value = lambda value: f"'{value}'"
+
+        partition = get_partition_name('fakeapp_testchildmodel', '100%', connection)
+        self.assertEqual(
+            get_partition_name('fakeapp_testchildmodel', None, connection),
+            'fakeapp_testchildmodel_default',
+        )
+
+        with mock.patch('aether.sdk.multitenancy.partitions._table_exists', return_value=True):
+            self.assertFalse(add_realm_partition(TestChildModel, '100%', None, schema_editor))
+        schema_editor.execute.assert_not_called()
+
+        with mock.patch('aether.sdk.multitenancy.partitions._table_exists', return_value=False):
+            self.assertTrue(add_realm_partition(TestChildModel, '100%', None, schema_editor))
+        self.assertEqual([c.args for c in schema_editor.execute.call_args_list], [
+            (f'CREATE TABLE "{partition}" (LIKE "fakeapp_testchildmodel" INCLUDING DEFAULTS)',),
+            (
+                f'WITH moved AS (DELETE FROM "fakeapp_testchildmodel_default" WHERE "realm" = %s'
+                f' RETURNING *) INSERT INTO "{partition}" SELECT * FROM moved',
+                ['100%'],
+            ),
+            (
+                f'ALTER TABLE "fakeapp_testchildmodel" ATTACH PARTITION "{partition}"'
+                f" FOR VALUES IN ('100%%')",
+            ),
+        ])
+
+    def test_partitions_operation(self):
+        operation = PartitionByRealm('TestChildModel')
+        self.assertEqual(
+            operation.deconstruct(),
+            ('PartitionByRealm', ['TestChildModel'], {'realm_field': 'realm'}),
+        )
+        self.assertFalse(operation.reversible)
+
+        state = ProjectState.from_apps(apps)
+        schema_editor = mock.MagicMock()
+        schema_editor.connection.ops = connection.ops
+        schema_editor.quote_name = connection.ops.quote_name
+        schema_editor.quote_value = lambda value: f"'{value}'"
+        mock_cursor = schema_editor.connection.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = ('"fakeapp_testchildmodel_id_seq"',)
+        mock_cursor.fetchall.return_value = [(TEST_REALM,)]
+
+        # only PostgreSQL
+        schema_editor.connection.vendor = 'sqlite'
+        operation.database_forwards('fakeapp', schema_editor, state, state)
+        schema_editor.execute.assert_not_called()
+
+        schema_editor.connection.vendor = 'postgresql'
+        # referenced by other tables
+        with self.assertRaises(ValueError):
+            operation.database_forwards('fakeapp', schema_editor, state, state)
+        schema_editor.execute.assert_not_called()
+
+        state.remove_model('fakeapp', 'testgrandchildmodel')
+        with mock.patch('aether.sdk.multitenancy.partitions._table_exists', return_value=False):
+            operation.database_forwards('fakeapp', schema_editor, state, state)
+        sql = [str(c.args[0]) for c in schema_editor.execute.call_args_list]
+        self.assertEqual(sql[:6], [
+            'ALTER TABLE "fakeapp_testchildmodel" RENAME TO "fakeapp_testchildmodel_unpartitioned"',
+            'CREATE TABLE "fakeapp_testchildmodel" (LIKE "fakeapp_testchildmodel_unpartitioned"'
+            ' INCLUDING DEFAULTS) PARTITION BY LIST ("realm")',
+            'CREATE TABLE "fakeapp_testchildmodel_default" PARTITION OF "fakeapp_testchildmodel"'
+            ' DEFAULT',
+            'INSERT INTO "fakeapp_testchildmodel"'
+            ' SELECT * FROM "fakeapp_testchildmodel_unpartitioned"',
+            'ALTER SEQUENCE "fakeapp_testchildmodel_id_seq"'
+            ' OWNED BY "fakeapp_testchildmodel"."id"',
+            'DROP TABLE "fakeapp_testchildmodel_unpartitioned"',
+        ])
+        # existing realms partitions
+        self.assertIn('ATTACH PARTITION', sql[-1])
+        self.assertIn(f"FOR VALUES IN ('{TEST_REALM}')", sql[-1])
+
     def test_is_accessible_by_realm(self):
         # not affected by realm value
         obj2 = TestNoMtModel.objects.create(name='two')
@@ -352,6 +1415,95 @@ class MultitenancyTests(AetherTestCase):
         self.assertEqual(self.request.user.groups.count(), 0)
         self.assertNotIn(realm_group, self.request.user.groups.all())
 
+    def test_auth_group_registry(self):
+        self.addCleanup(utils.invalidate_auth_groups)
+
+        # not registered until the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            group_id = utils.get_auth_group_id(TEST_REALM)
+            self.assertNotIn(TEST_REALM, utils._AUTH_GROUPS)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(Group.objects.get(name=TEST_REALM).pk, group_id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_auth_group_id(TEST_REALM), group_id)
+            self.assertEqual(utils.get_auth_group(self.request).pk, group_id)
+
+        # shared with the other processes
+        utils._AUTH_GROUPS.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_auth_group_id(TEST_REALM), group_id)
+
+        # the registry version expires (changes not seen with a cache per process)
+        cache.delete(utils._AUTH_GROUPS_VERSION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(1):
+                self.assertEqual(utils.get_auth_group_id(TEST_REALM), group_id)
+
+        # any group change invalidates the registry
+        Group.objects.filter(pk=group_id).update(name='old-realm')
+        Group.objects.get(pk=group_id).save()
+        with self.assertNumQueries(4):  # select + (savepoint) insert
+            self.assertNotEqual(utils.get_auth_group_id(TEST_REALM), group_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group_id = utils.get_auth_group_id(TEST_REALM)
+        Group.objects.get(pk=group_id).delete()
+        with self.assertNumQueries(4):
+            self.assertNotEqual(utils.get_auth_group_id(TEST_REALM), group_id)
+
+        # the users are filtered by the group id
+        qs = utils.filter_users_by_realm(self.request, get_user_model().objects.all())
+        self.assertNotIn('auth_group', str(qs.query))
+
+    def test_check_user_in_realm__local_cache(self):
+        self.addCleanup(utils.invalidate_auth_groups)
+        self.addCleanup(cache.clear)
+        user = self.request.user
+        with self.captureOnCommitCallbacks(execute=True):
+            utils.add_user_to_realm(self.request, user)
+
+        # the membership is not cached with a cache per process
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertNumQueries(1):
+                    self.assertTrue(utils.check_user_in_realm(self.request, user))
+            self.assertEqual(callbacks, [])
+
+    @mock.patch('aether.sdk.multitenancy.utils.is_shared_cache', return_value=True)
+    def test_check_user_in_realm__cache(self, *args):
+        self.addCleanup(utils.invalidate_auth_groups)
+        self.addCleanup(cache.clear)
+        user = self.request.user
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(utils.check_user_in_realm(self.request, user))
+        with self.assertNumQueries(0):
+            self.assertFalse(utils.check_user_in_realm(self.request, user))
+
+        utils.add_user_to_realm(self.request, user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(utils.check_user_in_realm(self.request, user))
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.check_user_in_realm(self.request, user))
+
+        # from the group side
+        group = utils.get_auth_group(self.request)
+        group.user_set.remove(user)
+        self.assertFalse(utils.check_user_in_realm(self.request, user))
+
+        user.groups.add(group)
+        self.assertTrue(utils.check_user_in_realm(self.request, user))
+
+        user.groups.clear()
+        self.assertFalse(utils.check_user_in_realm(self.request, user))
+
+        user.groups.add(group)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(utils.check_user_in_realm(self.request, user))
+        group.user_set.clear()
+        self.assertFalse(utils.check_user_in_realm(self.request, user))
+
     def test_serializers_gateway(self):
         obj1 = TestModel.objects.create(name='one')
         obj1.add_to_realm(self.request)
@@ -551,7 +1703,8 @@ class MultitenancyTests(AetherTestCase):
         self.assertFalse(obj1.is_accessible(TEST_REALM))
         self.assertEqual(response.json(), {'realms': [settings.DEFAULT_REALM]})
 
-        obj1.add_to_realm(self.request)
+        with self.captureOnCommitCallbacks(execute=True):
+            obj1.add_to_realm(self.request)
         self.assertTrue(MtInstance.objects.count() > 0)
         self.assertEqual(obj1.mt.realm, TEST_REALM)
         self.assertTrue(obj1.is_accessible(TEST_REALM))
@@ -560,6 +1713,9 @@ class MultitenancyTests(AetherTestCase):
         realms = set(response.json()['realms'])
         self.assertEqual(realms, set([TEST_REALM, settings.DEFAULT_REALM]))
 
+        response = self.client.get(url, {'sizes': 'true'})
+        self.assertEqual(response.json()['sizes'], {TEST_REALM: 1, settings.DEFAULT_REALM: 0})
+
     @override_settings(MULTITENANCY=False)
     def test_no_multitenancy(self, *args):
         self.assertIsNone(utils.get_multitenancy_model())
@@ -0,0 +1,131 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from rest_framework.throttling import SimpleRateThrottle
+
+from aether.sdk.cache import safe_cache_call
+from aether.sdk.multitenancy.utils import get_current_realm
+
+_RATE_CACHE_KEY = 'aether-sdk:realm-throttle:{}:{}'
+_IN_FLIGHT_CACHE_KEY = 'aether-sdk:realm-in-flight:{}'
+# releases the slots of the requests that never finished (killed workers)
+_IN_FLIGHT_TTL = 60 * 5
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate):
+    '''
+    Returns the number of requests and the period in seconds
+    of the given rate (``<number>/<period>``, like ``100/s`` or ``1000/minute``).
+    '''
+
+    if not rate:
+        return None, None
+
+    num, period = rate.split('/')
+    return int(num), _PERIODS[period[0]]
+
+
+def check_realm_rate(realm, rate):
+    '''
+    Counts the realm request in the current time window.
+
+    Returns the seconds to wait if the realm exceeded the rate, ``None`` otherwise.
+    '''
+
+    num_requests, duration = parse_rate(rate)
+    if not num_requests:
+        return None
+
+    now = time.time()
+    window = int(now // duration)
+    key = _RATE_CACHE_KEY.format(realm, window)
+    safe_cache_call(cache.add, key, 0, duration)
+    count = safe_cache_call(cache.incr, key)
+    if count is None or count <= num_requests:
+        return None
+
+    return max(1, int((window + 1) * duration - now))
+
+
+def acquire_realm_slot(realm, max_requests):
+    '''
+    Increases the number of realm requests in progress if it is under the limit.
+
+    Returns ``False`` if the realm reached the limit.
+    '''
+
+    if not max_requests:
+        return True
+
+    key = _IN_FLIGHT_CACHE_KEY.format(realm)
+    # the expiration is never extended, the slots leaked by killed workers
+    # are released at most ``_IN_FLIGHT_TTL`` seconds later
+    safe_cache_call(cache.add, key, 0, _IN_FLIGHT_TTL)
+    count = safe_cache_call(cache.incr, key)
+    if count is None or count <= max_requests:
+        return True
+
+    release_realm_slot(realm, max_requests)
+    return False
+
+
+def release_realm_slot(realm, max_requests):
+    '''
+    Decreases the number of realm requests in progress.
+    '''
+
+    if not max_requests:
+        return
+
+    key = _IN_FLIGHT_CACHE_KEY.format(realm)
+    try:
+        count = cache.decr(key)
+        if count < 0:
+            # acquired before the counter expired
+            cache.incr(key, -count)
+    except Exception:
+        pass  # expired or cache not available
+
+
+class RealmRateThrottle(SimpleRateThrottle):
+    '''
+    Limits the rate of requests by realm.
+
+    Uses the ``realm`` rate of ``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']``
+    or the ``settings.MULTITENANCY_THROTTLE_RATE`` value.
+    '''
+
+    scope = 'realm'
+
+    def get_rate(self):
+        if self.scope in self.THROTTLE_RATES:
+            return self.THROTTLE_RATES[self.scope]
+        return getattr(settings, 'MULTITENANCY_THROTTLE_RATE', None)
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {
+            'scope': self.scope,
+            'ident': get_current_realm(request),
+        }
@@ -16,13 +16,43 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import urllib.parse
+import uuid
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from django.apps import apps
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from django.db.models import F
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from django.dispatch import receiver
 from django.urls import resolve
 
-from aether.sdk.utils import find_in_request
+from aether.sdk.cache import is_shared_cache, safe_cache_call
+from aether.sdk.metrics import REALM_DB_QUERIES, REALM_DB_QUERY_SECONDS, REALM_REQUESTS
+from aether.sdk.utils import find_in_request, find_in_request_headers
+
+
+_MISSING = object()    # the realm was not resolved yet
+_NOT_FOUND = object()  # the realm was resolved but it is not in the request
+
+_AUTH_GROUP_CACHE_KEY = 'aether-sdk:realm-group:{}:{}'
+_AUTH_GROUPS_VERSION_KEY = 'aether-sdk:realm-group:version'
+_AUTH_GROUPS = {}  # realm: (version, group id)
+
+_MEMBERSHIP_CACHE_KEY = 'aether-sdk:realm-member:{}:{}'
+
+_REGISTERED_REALMS_CACHE_KEY = 'aether-sdk:registered-realms'
+
+RLS_REALM_VARIABLE = 'aether.realm'
+
+_ROUTED_REALM = ContextVar('aether_sdk_routed_realm', default=None)
 
 
 def get_multitenancy_model():
@@ -37,15 +67,89 @@ def get_multitenancy_model():
     return apps.get_model(app_label, model_name, require_ready=True)
 
 
+def list_realms():
+    '''
+    Returns the set of realms with linked instances plus the default one.
+    '''
+
+    return set(get_realms_sizes())
+
+
+def is_registered_realm(realm):
+    '''
+    Checks if the realm is the default one or is in the ``MtRealm`` registry.
+
+    The registry is kept in the default cache for ``settings.CACHE_TTL`` seconds,
+    the realms are known after linking their first instance.
+    '''
+
+    if not realm:
+        return False
+    if realm == settings.DEFAULT_REALM:
+        return True
+    if not settings.MULTITENANCY:
+        return False
+
+    realms = safe_cache_call(cache.get, _REGISTERED_REALMS_CACHE_KEY)
+    if realms is None:
+        from aether.sdk.multitenancy.models import MtRealm
+
+        realms = set(MtRealm.objects.values_list('name', flat=True))
+        safe_cache_call(cache.set, _REGISTERED_REALMS_CACHE_KEY, realms, settings.CACHE_TTL)
+    return realm in realms
+
+
+def get_realms_sizes():
+    '''
+    Returns the number of linked instances by realm, includes the default realm.
+    '''
+
+    if not settings.MULTITENANCY:
+        return {}
+
+    from aether.sdk.multitenancy.models import MtRealm
+
+    sizes = dict(MtRealm.objects.filter(instances__gt=0).values_list('name', 'instances'))
+    # include always the default realm
+    sizes.setdefault(settings.DEFAULT_REALM, 0)
+    return sizes
+
+
+def collect_realm_stats():
+    '''
+    Returns the number of requests, database queries and time spent in them
+    by realm and view, sorted by time. Collected by the current process
+    with the ``RealmQueryMetricsMiddleware``.
+    '''
+
+    stats = {}
+    for metric, key in [
+        (REALM_REQUESTS, 'requests'),
+        (REALM_DB_QUERIES, 'queries'),
+        (REALM_DB_QUERY_SECONDS, 'seconds'),
+    ]:
+        for sample in metric.collect()[0].samples:
+            if not sample.name.endswith('_total'):
+                continue
+            realm, view = sample.labels['realm'], sample.labels['view']
+            entry = stats.setdefault(
+                (realm, view),
+                {'realm': realm, 'view': view, 'requests': 0, 'queries': 0, 'seconds': 0.0},
+            )
+            entry[key] = sample.value
+
+    return sorted(stats.values(), key=lambda entry: entry['seconds'], reverse=True)
+
+
 def get_path_realm(request, default_realm=None):
     '''
     Returns the realm contained in the request path.
     '''
 
-    try:
-        return resolve(request.path).kwargs['realm']
-    except Exception:
-        return default_realm
+    realm = getattr(request, '_path_realm', _MISSING)
+    if realm is _MISSING:
+        realm = _resolve_path_realm(request)
+    return realm if realm is not None else default_realm
 
 
 def get_current_realm(request, default_realm=settings.DEFAULT_REALM):
@@ -56,12 +160,54 @@ def get_current_realm(request, default_realm=settings.DEFAULT_REALM):
     if not settings.MULTITENANCY:
         return None
 
-    if settings.GATEWAY_ENABLED:
-        realm = get_path_realm(request, default_realm=None)
-        if realm and realm != settings.GATEWAY_PUBLIC_REALM:
-            return realm
+    realm = getattr(request, '_current_realm', _MISSING)
+    if realm is _MISSING:
+        realm = _find_current_realm(request)
+    return realm if realm is not _NOT_FOUND else default_realm
 
-    return find_in_request(request, settings.REALM_COOKIE, default_realm)
+
+def resolve_realm(request, use_session=True):
+    '''
+    Resolves the realm once and keeps it in the request (``request.realm``).
+
+    The rest of realm helpers use the kept values instead of resolving
+    the request path and looking up the session, cookies and headers again.
+    '''
+
+    request = getattr(request, '_request', request)  # DRF request
+    if not hasattr(request, '_path_realm'):
+        request._path_realm = _resolve_path_realm(request)
+    request._current_realm = _find_current_realm(request, use_session)
+    request.realm = get_current_realm(request)
+    return request.realm
+
+
+def peek_realm(request):
+    '''
+    Returns the realm contained in the request path, cookies or headers
+    without looking up the session and without keeping it in the request.
+
+    To be used before the authentication, it does not hit the database.
+    '''
+
+    request = getattr(request, '_request', request)  # DRF request
+    if hasattr(request, '_current_realm'):
+        return get_current_realm(request)
+
+    realm = _find_current_realm(request, use_session=False)
+    return realm if realm is not _NOT_FOUND else settings.DEFAULT_REALM
+
+
+def set_current_realm(request, realm):
+    '''
+    Sets the current realm in the request session.
+    '''
+
+    request.session[settings.REALM_COOKIE] = realm
+    request.session.modified = True
+
+    if hasattr(getattr(request, '_request', request), '_current_realm'):
+        resolve_realm(request)
 
 
 def is_accessible_by_realm(request, obj):
@@ -75,11 +221,107 @@ def is_accessible_by_realm(request, obj):
     # Object instance should have a method named `is_accessible`.
     if getattr(obj, 'is_accessible', None) is not None:
         realm = get_current_realm(request)
+        if is_protected_by_rls(type(obj), realm):
+            # the database only returns the rows linked to the current realm
+            return True
         return obj.is_accessible(realm)
 
     return True
 
 
+def get_realm_database(realm):
+    '''
+    Returns the database alias of the realm, ``default`` if not indicated
+    in ``settings.MULTITENANCY_DATABASES``.
+    '''
+
+    return settings.MULTITENANCY_DATABASES.get(realm, DEFAULT_DB_ALIAS)
+
+
+def get_realm_databases():
+    '''
+    Returns the database aliases that keep realms data, ``default`` included.
+    '''
+
+    databases = getattr(settings, 'MULTITENANCY_DATABASES', {}).values()
+    return sorted({DEFAULT_DB_ALIAS, *databases})
+
+
+def get_routed_realm():
+    '''
+    Returns the realm used by the ``RealmRouter`` in the current context.
+    '''
+
+    return _ROUTED_REALM.get()
+
+
+def set_routed_realm(realm):
+    '''
+    Sets the realm used by the ``RealmRouter`` in the current context,
+    returns the token to reset it.
+    '''
+
+    return _ROUTED_REALM.set(realm)
+
+
+def reset_routed_realm(token):
+    try:
+        _ROUTED_REALM.reset(token)
+    except ValueError:
+        # created in another context
+        _ROUTED_REALM.set(None)
+
+
+@contextmanager
+def use_realm(realm):
+    '''
+    Routes the multitenancy models queries to the realm database within the block,
+    to be used outside of the requests (management commands, background jobs...).
+    '''
+
+    token = set_routed_realm(realm)
+    try:
+        yield
+    finally:
+        reset_routed_realm(token)
+
+
+def set_rls_realm(realm, using=DEFAULT_DB_ALIAS):
+    '''
+    Sets the realm in the database session variable checked by the row level
+    security policies, ``None`` resets it. Only for PostgreSQL databases.
+    '''
+
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    if not realm and connection.connection is None:
+        # closed connection, the new one starts without realm
+        connection.mt_rls_realm = None
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT set_config(%s, %s, false)', [RLS_REALM_VARIABLE, realm or ''])
+    # linked to the current database connection
+    connection.mt_rls_realm = (connection.connection, realm) if realm else None
+
+
+def is_protected_by_rls(model, realm):
+    '''
+    Indicates if the database only returns the model rows linked to the given realm.
+    '''
+
+    if not settings.MULTITENANCY_RLS or not getattr(model, 'mt_rls', False):
+        return False
+
+    connection = connections[router.db_for_read(model)]
+    return (
+        connection.vendor == 'postgresql' and
+        getattr(connection, 'mt_rls_realm', None) == (connection.connection, realm)
+    )
+
+
 def filter_by_realm(request, data, mt_field=None):
     '''
     Includes the realm filter in the given data object (Queryset or Manager)
@@ -89,9 +331,69 @@ def filter_by_realm(request, data, mt_field=None):
         return data
 
     # only returns the instances linked to the current realm
-    field = f'{mt_field}__mt__realm' if mt_field else 'mt__realm'
     realm = get_current_realm(request)
-    return data.annotate(mt_realm=F(field)).filter(mt_realm=realm)
+    condition = Q(mt_realm=realm)
+    if realm == settings.DEFAULT_REALM and getattr(data.model, 'mt_realm_field', None):
+        # the rows without local realm (``QuerySet.update``, raw inserts...)
+        # belong to the default realm, like in ``get_realm``
+        condition |= Q(mt_realm__isnull=True)
+    data = annotate_realm(data, mt_field).filter(condition)
+    if settings.MULTITENANCY_DATABASES:
+        data = data.using(get_realm_database(realm))
+    return data
+
+
+def annotate_realm(data, mt_field=None):
+    '''
+    Includes the instances realm, as ``mt_realm``, in the given data object
+    (Queryset or Manager).
+
+    The models use it in the ``get_realm`` and ``is_accessible`` methods
+    instead of querying the realm for each instance.
+    '''
+
+    # the realm is kept in the model table, there is no need to join other tables
+    local_field = getattr(data.model, 'mt_realm_field', None)
+    if local_field:
+        return data.annotate(mt_realm=F(local_field))
+
+    field = f'{mt_field}__mt__realm' if mt_field else 'mt__realm'
+    return data.annotate(mt_realm=F(field))
+
+
+def backfill_realm(model, realm_field='realm', mt_path=None, batch_size=1000):
+    '''
+    Copies the linked ``MtInstance`` realm into the model realm field in batches.
+
+    To be used in the data migrations after adding the field, the historical
+    models do not include the ``mt_realm_field`` and ``mt_path`` attributes::
+
+        migrations.RunPython(
+            lambda apps, _: backfill_realm(apps.get_model('app', 'Child'), mt_path='parent'),
+            migrations.RunPython.noop,
+        )
+    '''
+
+    field = f'{mt_path}__mt__realm' if mt_path else 'mt__realm'
+    manager = model._base_manager
+    last_pk = None
+
+    while True:
+        queryset = manager.order_by('pk')
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        rows = list(queryset.values_list('pk', field)[:batch_size])
+        if not rows:
+            break
+
+        # one update per realm within the batch
+        pks_by_realm = defaultdict(list)
+        for pk, realm in rows:
+            pks_by_realm[realm].append(pk)
+        for realm, pks in pks_by_realm.items():
+            manager.filter(pk__in=pks).update(**{realm_field: realm})
+
+        last_pk = rows[-1][0]
 
 
 def add_current_realm_in_headers(request, headers=None):
@@ -128,8 +430,56 @@ def get_auth_group(request):
     if not settings.MULTITENANCY:
         return None
 
-    group, _ = Group.objects.get_or_create(name=get_current_realm(request))
-    return group
+    realm = get_current_realm(request)
+    group_id = get_auth_group_id(realm)
+    # build it as if it were fetched from the database
+    return Group.from_db(router.db_for_read(Group), ['id', 'name'], [group_id, realm])
+
+
+def get_auth_group_id(realm):
+    '''
+    Returns the id of the authorization group that represents the realm.
+
+    The ids are kept in memory and in the cache, shared by all the processes,
+    and invalidated along with any group change. The invalidation expires after
+    ``settings.CACHE_TTL`` seconds, with a cache per process it is the time
+    the other processes need to see the group changes.
+    '''
+
+    version = _get_auth_groups_version()
+    try:
+        group_version, group_id = _AUTH_GROUPS[realm]
+        if group_version == version:
+            return group_id
+    except KeyError:
+        pass
+
+    key = _AUTH_GROUP_CACHE_KEY.format(version, urllib.parse.quote(realm, safe=''))
+    group_id = safe_cache_call(cache.get, key)
+    if group_id is None:
+        group_id = Group.objects.get_or_create(name=realm)[0].pk
+
+        def register():
+            _AUTH_GROUPS[realm] = (version, group_id)
+            safe_cache_call(cache.set, key, group_id, settings.CACHE_TTL)
+
+        # the group could be created within a transaction that is rolled back
+        transaction.on_commit(register)
+    else:
+        _AUTH_GROUPS[realm] = (version, group_id)
+
+    return group_id
+
+
+def invalidate_auth_groups():
+    '''
+    Forgets the known authorization group ids in all the processes.
+    '''
+
+    _AUTH_GROUPS.clear()
+    safe_cache_call(
+        cache.set, _AUTH_GROUPS_VERSION_KEY, uuid.uuid4().hex, settings.CACHE_TTL,
+    )
 
 
 def add_user_to_realm(request, user):
@@ -165,7 +515,31 @@ def check_user_in_realm(request, user):
     if user.is_staff:
         return True
 
-    return get_auth_group(request) in user.groups.all()
+    return is_user_in_group(user.pk, get_auth_group_id(get_current_realm(request)))
+
+
+def is_user_in_group(user_id, group_id):
+    '''
+    Checks if the user belongs to the group.
+
+    The result is cached and invalidated with any change in the user groups,
+    only if the default cache is shared by all the processes, otherwise the
+    changes made by one process would not be seen by the rest.
+    '''
+
+    UserGroups = get_user_model().groups.through
+    if not is_shared_cache():
+        return UserGroups.objects.filter(user_id=user_id, group_id=group_id).exists()
+
+    key = _MEMBERSHIP_CACHE_KEY.format(user_id, group_id)
+    is_member = safe_cache_call(cache.get, key)
+    if is_member is None:
+        is_member = UserGroups.objects.filter(user_id=user_id, group_id=group_id).exists()
+        # the value could change if the transaction is rolled back
+        transaction.on_commit(
+            lambda: safe_cache_call(cache.set, key, is_member, settings.CACHE_TTL)
+        )
+    return is_member
 
 
 def filter_users_by_realm(request, data):
@@ -177,4 +551,76 @@ def filter_users_by_realm(request, data):
         return data
 
     # only returns the users linked to the current realm
-    return data.filter(groups__name=get_auth_group(request).name)
+    return data.filter(groups__id=get_auth_group_id(get_current_realm(request)))
+
+
+def _get_auth_groups_version():
+    # expires to renew the ids known by the processes that do not share the cache
+    return safe_cache_call(
+        cache.get_or_set, _AUTH_GROUPS_VERSION_KEY, uuid.uuid4().hex, settings.CACHE_TTL,
+    )
+
+
+@receiver(m2m_changed)
+def _user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # the user model is not available while loading this module
+    if sender is not get_user_model().groups.through:
+        return
+    if action not in ('pre_clear', 'post_add', 'post_remove'):
+        return
+
+    if action == 'pre_clear':
+        # after clearing there is no way to know the removed relations
+        pk_set = (
+            instance.user_set.values_list('pk', flat=True)
+            if reverse
+            else instance.groups.values_list('pk', flat=True)
+        )
+
+    if reverse:  # from the group side: ``group.user_set.add(user)``
+        keys = [_MEMBERSHIP_CACHE_KEY.format(pk, instance.pk) for pk in pk_set]
+    else:
+        keys = [_MEMBERSHIP_CACHE_KEY.format(instance.pk, pk) for pk in pk_set]
+
+    safe_cache_call(cache.delete_many, keys)
+    # a concurrent request could cache the old value before committing the changes
+    transaction.on_commit(lambda: safe_cache_call(cache.delete_many, keys))
+
+
+@receiver(post_save, sender=Group)
+def _group_saved(sender, instance, created, **kwargs):
+    # the new groups do not change the known ones
+    if not created:
+        invalidate_auth_groups()
+
+
+@receiver(post_delete, sender=Group)
+def _group_deleted(sender, instance, **kwargs):
+    invalidate_auth_groups()
+
+
+@receiver(post_migrate)
+def _migrated(sender, **kwargs):
+    # also emitted after flushing the database
+    invalidate_auth_groups()
+
+
+def _resolve_path_realm(request):
+    try:
+        return resolve(request.path).kwargs['realm']
+    except Exception:
+        return None
+
+
+def _find_current_realm(request, use_session=True):
+    if settings.GATEWAY_ENABLED:
+        realm = get_path_realm(request, default_realm=None)
+        if realm and realm != settings.GATEWAY_PUBLIC_REALM:
+            return realm
+
+    if not use_session:
+        return getattr(request, 'COOKIES', {}).get(
+            settings.REALM_COOKIE,
+            find_in_request_headers(request, settings.REALM_COOKIE, _NOT_FOUND),
+        )
+    return find_in_request(request, settings.REALM_COOKIE, _NOT_FOUND)
@@ -17,19 +17,25 @@
 # under the License.
 
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext_lazy as _
 
 from rest_framework.decorators import action, api_view, permission_classes, renderer_classes
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import IsAdminUser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from aether.sdk.drf.views import CacheViewSetMixin
 from aether.sdk.multitenancy.utils import (
+    annotate_realm,
+    collect_realm_stats,
     filter_by_realm,
     filter_users_by_realm,
+    get_current_realm,
+    get_realms_sizes,
     is_accessible_by_realm,
 )
 
@@ -51,9 +57,14 @@ class MtViewSetMixin(CacheViewSetMixin):
         - 403 FORBIDDEN   if the instance is not accessible by current realm
         - 404 NOT_FOUND   if the instance does not exist
         - 204 NO_CONTENT  otherwise
+
+    Adds a list endpoint ``/is-accessible`` permitted with GET and POST methods,
+    checks a list of primary keys and returns the status of each one.
     '''
 
     mt_field = None
+    # the list endpoint ``/is-accessible`` only reads, even with POST method
+    cache_readonly_actions = ['are_accessible']
 
     def get_queryset(self):
         '''
@@ -63,6 +74,13 @@ class MtViewSetMixin(CacheViewSetMixin):
         qs = super(MtViewSetMixin, self).get_queryset()
         return filter_by_realm(self.request, qs, self.mt_field)
 
+    def get_cache_realm(self):
+        '''
+        Invalidates only the current realm cache namespace
+        '''
+
+        return get_current_realm(self.request)
+
     def get_object_or_404(self, pk):
         '''
         Custom method that raises NOT_FOUND error
@@ -79,12 +97,12 @@ class MtViewSetMixin(CacheViewSetMixin):
         otherwise returns the instance or ``None`` if it does not exist
         '''
 
-        # without filtering by realm
+        # without filtering by realm but including it in the same query
         qs = super(MtViewSetMixin, self).get_queryset()
-        if not qs.filter(pk=pk).exists():
+        obj = annotate_realm(qs, self.mt_field).filter(pk=pk).first()
+        if obj is None:
             return None
 
-        obj = qs.get(pk=pk)
         if not is_accessible_by_realm(self.request, obj):
             raise PermissionDenied(_('Not accessible by this realm'))
 
@@ -99,11 +117,74 @@ class MtViewSetMixin(CacheViewSetMixin):
             - 204 NO_CONTENT  otherwise
         '''
 
-        self.get_object_or_403(pk)
-        self.get_object_or_404(pk)
+        if self.get_object_or_403(pk) is None:
+            raise Http404
 
         return Response(status=204)
 
+    @action(detail=False, methods=['get', 'post'], url_path='is-accessible',
+            url_name='are-accessible')
+    def are_accessible(self, request, *args, **kwargs):
+        '''
+        Checks the given list of primary keys at once, expects them in the
+        ``pk`` query parameter (``?pk=1&pk=2`` or ``?pk=1,2``) or in the body,
+        as a list or as ``{"pk": [1, 2]}``.
+
+        Returns a dictionary with the status of each primary key:
+            - ``missing``     if the instance does not exist
+            - ``forbidden``   if the instance is not accessible by current realm
+            - ``accessible``  otherwise
+
+        Raises a 400 BAD_REQUEST error with more than
+        ``settings.MULTITENANCY_MAX_ACCESSIBLE_PKS`` primary keys.
+        '''
+
+        if request.method == 'GET':
+            values = request.query_params.getlist('pk')
+        else:
+            values = request.data.get('pk', []) if isinstance(request.data, dict) else request.data
+            if not isinstance(values, list):
+                values = [values]
+
+        qs = super(MtViewSetMixin, self).get_queryset()
+        pk_field = qs.model._meta.pk
+        pks = {}
+        for value in values:
+            for item in (value.split(',') if isinstance(value, str) else [value]):
+                key = str(item).strip()
+                if not key:
+                    continue
+                try:
+                    pks[key] = pk_field.to_python(key)
+                except (DjangoValidationError, TypeError, ValueError):
+                    # cannot be the primary key of any instance
+                    pks[key] = None
+
+                if len(pks) > settings.MULTITENANCY_MAX_ACCESSIBLE_PKS:
+                    raise ValidationError(
+                        _('No more than {} primary keys are allowed.')
+                        .format(settings.MULTITENANCY_MAX_ACCESSIBLE_PKS)
+                    )
+
+        # without filtering by realm but including it in the same query
+        lookup = {pk for pk in pks.values() if pk is not None}
+        objs = {
+            str(obj.pk): obj
+            for obj in annotate_realm(qs, self.mt_field).filter(pk__in=lookup)
+        } if lookup else {}
+
+        result = {}
+        for key, pk in pks.items():
+            obj = objs.get(str(pk)) if pk is not None else None
+            if obj is None:
+                result[key] = 'missing'
+            elif is_accessible_by_realm(request, obj):
+                result[key] = 'accessible'
+            else:
+                result[key] = 'forbidden'
+
+        return Response(data=result)
+
 
 class MtUserViewSetMixin(CacheViewSetMixin):
     '''
@@ -118,11 +199,18 @@ class MtUserViewSetMixin(CacheViewSetMixin):
         qs = super(MtUserViewSetMixin, self).get_queryset()
         return filter_users_by_realm(self.request, qs)
 
+    def get_cache_realm(self):
+        '''
+        Invalidates only the current realm cache namespace
+        '''
+
+        return get_current_realm(self.request)
+
 
 @api_view(['GET'])
 @renderer_classes([JSONRenderer])
 @permission_classes([IsAdminUser])
-def get_realms(*args, **kwargs):
+def get_realms(request, *args, **kwargs):
     '''
     Get the list of current realms.
 
@@ -131,16 +219,28 @@ def get_realms(*args, **kwargs):
 
     If MULTITENANCY is enabled then
     the default realm is always included in the list
+
+    With the `sizes` query parameter includes
+    the number of linked instances by realm.
     '''
     if settings.MULTITENANCY:
-        from aether.sdk.multitenancy.models import MtInstance
-        realms = set(
-            MtInstance.objects.values_list('realm', flat=True).order_by('realm').distinct()
-        )
-        # include always the default realm
-        realms.add(settings.DEFAULT_REALM)
-
+        sizes = get_realms_sizes()
     else:
-        realms = [settings.NO_MULTITENANCY_REALM]
+        sizes = {settings.NO_MULTITENANCY_REALM: 0}
+
+    data = {'realms': list(sizes)}
+    if request.query_params.get('sizes'):
+        data['sizes'] = sizes
+    return Response(data)
+
+
+@api_view(['GET'])
+@renderer_classes([JSONRenderer])
+@permission_classes([IsAdminUser])
+def get_realm_stats(*args, **kwargs):
+    '''
+    Get the number of requests, database queries and time spent in them
+    by realm and view collected by the current process, sorted by time.
+    '''
 
-    return Response({'realms': list(realms)})
+    return Response({'stats': collect_realm_stats()})
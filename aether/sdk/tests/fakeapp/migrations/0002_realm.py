@@ -0,0 +1,60 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+from django.conf import settings
+from django.db import migrations, models
+
+from aether.sdk.multitenancy.utils import backfill_realm
+
+
+def backfill(apps, schema_editor):
+    backfill_realm(apps.get_model('fakeapp', 'TestModel'))
+    backfill_realm(apps.get_model('fakeapp', 'TestChildModel'), mt_path='parent')
+
+
+if settings.MULTITENANCY:
+    multitenancy_dependencies = [
+        ('multitenancy', '0001_initial'),
+    ]
+    operations = [migrations.RunPython(backfill, migrations.RunPython.noop)]
+else:
+    multitenancy_dependencies = []
+    operations = []
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fakeapp', '0001_initial'),
+        *multitenancy_dependencies,
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testmodel',
+            name='realm',
+            field=models.TextField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='testchildmodel',
+            name='realm',
+            field=models.TextField(db_index=True, editable=False, null=True),
+        ),
+        *operations,
+    ]
@@ -25,6 +25,8 @@ from aether.sdk.multitenancy.models import MtModelAbstract, MtModelChildAbstract
 
 class TestModel(MtModelAbstract):
     name = models.TextField()
+    realm = models.TextField(null=True, db_index=True, editable=False)
+    mt_realm_field = 'realm'
 
     user = models.ForeignKey(
         blank=True,
@@ -41,9 +43,9 @@ class TestModel(MtModelAbstract):
 class TestChildModel(MtModelChildAbstract):
     name = models.TextField()
     parent = models.ForeignKey(to=TestModel, on_delete=models.CASCADE, related_name='children')
-
-    def get_mt_instance(self):
-        return self.parent
+    realm = models.TextField(null=True, db_index=True, editable=False)
+    mt_path = 'parent'
+    mt_realm_field = 'realm'
 
     class Meta:
         app_label = 'fakeapp'
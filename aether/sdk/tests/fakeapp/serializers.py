@@ -29,6 +29,7 @@ from aether.sdk.drf.serializers import (
     UserNameField,
 )
 from aether.sdk.multitenancy.serializers import (
+    MtListSerializer,
     MtModelSerializer,
     MtPrimaryKeyRelatedField,
     MtUserRelatedField,
@@ -62,6 +63,7 @@ class TestModelSerializer(MtModelSerializer):
     class Meta:
         model = TestModel
         fields = '__all__'
+        list_serializer_class = MtListSerializer
 
 
 class TestChildModelSerializer(DynamicFieldsModelSerializer):
@@ -16,17 +16,47 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import time
+
 from unittest import mock
 
 from django.test import override_settings
 from django.contrib.auth import get_user_model
+from django.core import checks
+from django.core.cache import cache as django_cache
 from django.urls import reverse
 
+from prometheus_client import REGISTRY
+
 from aether.sdk import cache
+from aether.sdk.multitenancy.utils import use_realm
 from aether.sdk.tests import AetherTestCase
 from aether.sdk.unittest import UrlsTestCase
 
 
+def run_now(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def fake_cacheops(memo):
+    # like cacheops, the key includes the function module, name, line and extra
+    def cached(timeout, extra=None):
+        def decorator(fn):
+            def get_key(args):
+                return (fn.__module__, fn.__name__, fn.__code__.co_firstlineno, extra, args)
+
+            def wrapper(*args):
+                key = get_key(args)
+                if key not in memo:
+                    memo[key] = fn(*args)
+                return memo[key]
+            wrapper.invalidate = lambda *args: memo.pop(get_key(args), None)
+            return wrapper
+        return decorator
+
+    return mock.Mock(cached=cached)
+
+
 @override_settings(DJANGO_USE_CACHE=True)
 class CacheTest(AetherTestCase, UrlsTestCase):
 
@@ -59,3 +89,418 @@ class CacheTest(AetherTestCase, UrlsTestCase):
         self.assertNotIn(model, cache.CONTENT_TYPE_CACHE)
         cache.get_content_type(model=model)
         self.assertNotIn(model, cache.CONTENT_TYPE_CACHE)
+
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=True)
+    def test__cache_wrap__hits(self, *args):
+        memo = {}
+
+        def get_calls(result):
+            return REGISTRY.get_sample_value(
+                'aether_sdk_cache_wrap_calls_total',
+                {'function': f'{__name__}.{double.__qualname__}', 'result': result},
+            ) or 0
+
+        with mock.patch.dict('sys.modules', {'cacheops': fake_cacheops(memo)}):
+            @cache.cache_wrap(timeout=10)
+            def double(value):
+                return value * 2
+
+        self.assertEqual(double.__name__, 'double')
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(get_calls('hit'), 1)
+        self.assertEqual(get_calls('miss'), 2)
+
+        double.invalidate(1)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(get_calls('miss'), 3)
+
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=True)
+    def test__cache_wrap__same_name(self, *args):
+        memo = {}
+
+        class First:
+            @staticmethod
+            def get(value):
+                return f'first-{value}'
+
+        class Second:
+            @staticmethod
+            def get(value):
+                return f'second-{value}'
+
+        with mock.patch.dict('sys.modules', {'cacheops': fake_cacheops(memo)}):
+            first = cache.cache_wrap(timeout=10)(First.get)
+            second = cache.cache_wrap(timeout=10)(Second.get)
+
+        self.assertEqual(first(1), 'first-1')
+        self.assertEqual(second(1), 'second-1')
+        self.assertEqual(len(memo), 2)
+
+    def test__realm_cache_version(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+
+        version = cache.get_realm_cache_version('realm-1')
+        self.assertEqual(cache.get_realm_cache_version('realm-1'), version)
+        key = cache.realm_cache_key('key', 'realm-1')
+        self.assertEqual(key, f'aether-sdk:realm:realm-1:{version}:key')
+        django_cache.set(key, 'value')
+        django_cache.set(cache.realm_cache_key('key', 'realm-2'), 'value-2')
+
+        cache.bump_realm_cache('realm-1')
+        self.assertEqual(cache.get_realm_cache_version('realm-1'), version + 1)
+        self.assertIsNone(django_cache.get(cache.realm_cache_key('key', 'realm-1')))
+        self.assertEqual(django_cache.get(cache.realm_cache_key('key', 'realm-2')), 'value-2')
+
+        # lost counter
+        django_cache.delete('aether-sdk:cache-version:realm:realm-1')
+        cache.bump_realm_cache('realm-1')
+        self.assertGreater(cache.get_realm_cache_version('realm-1'), version + 1)
+
+    def test__clear_cache__realm(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        django_cache.set('key', 'value')
+        version = cache.get_realm_cache_version('realm-1')
+
+        with override_settings(DJANGO_CACHE_INVALIDATION='realm'):
+            cache.clear_cache(realm='realm-1')
+        self.assertEqual(django_cache.get('key'), 'value')
+        self.assertEqual(cache.get_realm_cache_version('realm-1'), version + 1)
+
+        with override_settings(DJANGO_CACHE_INVALIDATION='all'):
+            cache.clear_cache(realm='realm-1')
+        self.assertIsNone(django_cache.get('key'))
+
+        django_cache.set('key', 'value')
+        cache.clear_cache()
+        self.assertIsNone(django_cache.get('key'))
+
+    def test__cache_tags(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        UserModel = get_user_model()
+
+        def get_invalidations(tag):
+            return REGISTRY.get_sample_value(
+                'aether_sdk_cache_tag_invalidations_total', {'tag': tag},
+            ) or 0
+
+        self.assertEqual(cache.realm_tag('realm-1'), 'realm:realm-1')
+        self.assertEqual(cache.model_tag(UserModel), 'model:auth.user')
+        self.assertEqual(cache.model_tag(UserModel, 'realm-1'), 'model:auth.user:realm:realm-1')
+        self.assertEqual(cache.object_tag(UserModel, 1), 'object:auth.user:1')
+
+        model_key = cache.tagged_cache_key('key', [cache.model_tag(UserModel)])
+        object_key = cache.tagged_cache_key('key', [cache.object_tag(UserModel, 1)])
+        self.assertNotEqual(model_key, object_key)
+        self.assertEqual(model_key, cache.tagged_cache_key('key', [cache.model_tag(UserModel)]))
+        django_cache.set(model_key, 'model')
+        django_cache.set(object_key, 'object')
+
+        object_invalidations = get_invalidations('object:auth.user')
+        cache.invalidate_tags([cache.object_tag(UserModel, 1)])
+        self.assertEqual(get_invalidations('object:auth.user'), object_invalidations + 1)
+
+        # the missing versions are created without warnings
+        with mock.patch('aether.sdk.cache.logger') as mock_logger:
+            cache.invalidate_tags([cache.object_tag(UserModel, 2)])
+        mock_logger.warning.assert_not_called()
+        self.assertIsNotNone(django_cache.get(cache._TAG_VERSION_KEY.format('object:auth.user:2')))
+        self.assertIsNone(
+            django_cache.get(cache.tagged_cache_key('key', [cache.object_tag(UserModel, 1)]))
+        )
+        self.assertEqual(
+            django_cache.get(cache.tagged_cache_key('key', [cache.model_tag(UserModel)])),
+            'model',
+        )
+
+    def test__clear_cache__tags(self):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        django_cache.set('key', 'value')
+        tags = ['model:auth.user', 'object:auth.user:1']
+        versions = cache.get_tags_versions(tags + ['realm:realm-1'])
+
+        with override_settings(DJANGO_CACHE_INVALIDATION='tags'):
+            cache.clear_cache(realm='realm-1', tags=tags)
+            self.assertEqual(django_cache.get('key'), 'value')
+            self.assertEqual(
+                cache.get_tags_versions(versions.keys()),
+                {tag: version + 1 for tag, version in versions.items()},
+            )
+
+            cache.clear_cache(tags=tags[:1])
+            self.assertEqual(django_cache.get('key'), 'value')
+            self.assertEqual(
+                cache.get_tags_versions(tags),
+                {'model:auth.user': versions['model:auth.user'] + 2,
+                 'object:auth.user:1': versions['object:auth.user:1'] + 1},
+            )
+
+            cache.clear_cache(tags=tags, purge=True)
+            self.assertIsNone(django_cache.get('key'))
+
+        django_cache.set('key', 'value')
+        with override_settings(DJANGO_CACHE_INVALIDATION='realm'):
+            # the tags are ignored
+            cache.clear_cache(tags=tags)
+        self.assertIsNone(django_cache.get('key'))
+
+    def test__check_shared_cache(self):
+        local_cache = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared_cache = {'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/tmp/aether-sdk-tests',
+        }}
+
+        with override_settings(DJANGO_USE_CACHE=True, CACHES=local_cache):
+            with override_settings(DJANGO_CACHE_INVALIDATION='all'):
+                self.assertEqual(cache.check_shared_cache(), [])
+
+            for mode in ('realm', 'tags'):
+                with override_settings(DJANGO_CACHE_INVALIDATION=mode):
+                    errors = cache.check_shared_cache()
+                    self.assertEqual([e.id for e in errors], ['aether.sdk.E001'])
+                    # registered at startup
+                    self.assertIn(errors[0], checks.run_checks(tags=[checks.Tags.caches]))
+
+            with override_settings(DJANGO_USE_CACHE=False, DJANGO_CACHE_INVALIDATION='tags'):
+                self.assertEqual(cache.check_shared_cache(), [])
+
+        with override_settings(DJANGO_USE_CACHE=True, CACHES=shared_cache,
+                               DJANGO_CACHE_INVALIDATION='tags'):
+            self.assertEqual(cache.check_shared_cache(), [])
+
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=True)
+    def test__cache_wrap__tags(self, *args):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        memo = {}
+        calls = []
+
+        with mock.patch.dict('sys.modules', {'cacheops': fake_cacheops(memo)}):
+            @cache.cache_wrap(timeout=10, tags=lambda pk: [f'object:auth.user:{pk}'])
+            def double(pk):
+                calls.append(pk)
+                return pk * 2
+
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(calls, [1, 2])
+
+        cache.invalidate_tags(['object:auth.user:1'])
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [1, 2, 1])
+
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=True)
+    def test__cache_wrap__realm(self, *args):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        memo = {}
+        calls = []
+
+        with mock.patch.dict('sys.modules', {'cacheops': fake_cacheops(memo)}):
+            @cache.cache_wrap(timeout=10, realm=True)
+            def double(value):
+                calls.append(value)
+                return value * 2
+
+        with use_realm('realm-1'):
+            self.assertEqual(double(1), 2)
+            self.assertEqual(double(1), 2)
+        with use_realm('realm-2'):
+            self.assertEqual(double(1), 2)
+        self.assertEqual(calls, [1, 1])
+
+        cache.bump_realm_cache('realm-1')
+        with use_realm('realm-1'):
+            self.assertEqual(double(1), 2)
+        with use_realm('realm-2'):
+            self.assertEqual(double(1), 2)
+            double.invalidate(1)
+            self.assertEqual(double(1), 2)
+        self.assertEqual(calls, [1, 1, 1, 1])
+
+    def test__lru_cache(self):
+        def get_value(name, labels):
+            return REGISTRY.get_sample_value(name, {'function': 'lru-test', **labels}) or 0
+
+        lru = cache.LRUCache(max_size=2, timeout=10, name='lru-test')
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)  # "b" is the least recently used now
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(get_value('aether_sdk_cache_wrap_size', {}), 2)
+        self.assertEqual(
+            get_value('aether_sdk_cache_wrap_evictions_total', {'reason': 'size'}), 1)
+
+        with mock.patch('aether.sdk.cache.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual(lru.get('a', 'missing'), 'missing')
+        self.assertEqual(len(lru), 1)
+        self.assertEqual(
+            get_value('aether_sdk_cache_wrap_evictions_total', {'reason': 'expired'}), 1)
+
+        lru.delete('c')
+        lru.delete('unknown')
+        self.assertEqual(len(lru), 0)
+
+    @override_settings(CACHE_WRAP_MAX_SIZE=10)
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=False)
+    def test__cache_wrap__lru(self, *args):
+        calls = []
+
+        @cache.cache_wrap(timeout=10)
+        def get_name(realm, token):
+            calls.append(realm)
+            return f'{realm}-{token["access_token"]}'
+
+        token = {'access_token': 'abc', 'scopes': ['a', 'b']}
+        self.assertEqual(get_name('realm', token), 'realm-abc')
+        self.assertEqual(get_name('realm', dict(reversed(token.items()))), 'realm-abc')
+        self.assertEqual(get_name(realm='realm', token=token), 'realm-abc')
+        self.assertEqual(calls, ['realm', 'realm'])
+        self.assertEqual(len(get_name.cache), 2)
+
+        # not hashable arguments are never cached
+        token = {'access_token': 'abc', 'scopes': bytearray(b'a')}
+        self.assertEqual(get_name('realm', token), 'realm-abc')
+        self.assertEqual(get_name('realm', token), 'realm-abc')
+        self.assertEqual(len(calls), 4)
+
+        get_name.invalidate(realm='realm', token={'access_token': 'abc', 'scopes': ['a', 'b']})
+        self.assertEqual(len(get_name.cache), 1)
+
+    @override_settings(CACHE_WRAP_MAX_SIZE=0)
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=False)
+    def test__cache_wrap__disabled(self, *args):
+        def fn():
+            return 1
+
+        self.assertIs(cache.cache_wrap()(fn), fn)
+
+    @override_settings(CACHE_WRAP_MAX_SIZE=10)
+    @mock.patch('aether.sdk.cache._run_in_background', side_effect=run_now)
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=False)
+    def test__cache_wrap__stale(self, *args):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        clock = [1000.0]
+        calls = []
+
+        def get_value(name, result):
+            return REGISTRY.get_sample_value(name, {
+                'function': f'{__name__}.{get_token.__qualname__}',
+                'result': result,
+            }) or 0
+
+        @cache.cache_wrap(timeout=10, stale_ttl=60)
+        def get_token(realm):
+            calls.append(realm)
+            if len(calls) > 2:
+                raise RuntimeError('keycloak is down')
+            return len(calls)
+
+        with mock.patch('aether.sdk.cache.time.time', side_effect=lambda: clock[0]):
+            self.assertEqual(get_token('realm'), 1)
+            clock[0] += 5
+            self.assertEqual(get_token('realm'), 1)
+            self.assertEqual(len(calls), 1)
+
+            # expired, serves the stale value and refreshes it
+            clock[0] += 10
+            self.assertEqual(get_token('realm'), 1)
+            self.assertEqual(get_value('aether_sdk_cache_wrap_calls_total', 'stale'), 1)
+            self.assertEqual(get_value('aether_sdk_cache_wrap_refreshes_total', 'success'), 1)
+            self.assertEqual(get_token('realm'), 2)
+            self.assertEqual(len(calls), 2)
+
+            # the refresh fails, keeps serving the stale value
+            clock[0] += 20
+            self.assertEqual(get_token('realm'), 2)
+            self.assertEqual(get_token('realm'), 2)
+            self.assertEqual(len(calls), 4)
+            self.assertEqual(get_value('aether_sdk_cache_wrap_refreshes_total', 'failure'), 2)
+
+    @override_settings(CACHE_WRAP_MAX_SIZE=10)
+    @mock.patch('aether.sdk.cache._run_in_background', side_effect=run_now)
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=False)
+    def test__cache_wrap__early_refresh(self, *args):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        clock = [1000.0]
+        calls = []
+
+        @cache.cache_wrap(timeout=10, early_refresh=1)
+        def get_token(realm):
+            calls.append(realm)
+            clock[0] += 1  # it takes one second
+            return len(calls)
+
+        with mock.patch('aether.sdk.cache.time.time', side_effect=lambda: clock[0]):
+            self.assertEqual(get_token('realm'), 1)
+            clock[0] += 5
+
+            with mock.patch('aether.sdk.cache.random.random', return_value=0):
+                self.assertEqual(get_token('realm'), 1)
+            self.assertEqual(len(calls), 1)
+
+            # -log(0.0001) ~ 9.2 seconds earlier
+            with mock.patch('aether.sdk.cache.random.random', return_value=0.9999):
+                self.assertEqual(get_token('realm'), 1)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(get_token('realm'), 2)
+
+    @override_settings(CACHE_WRAP_MAX_SIZE=10)
+    @mock.patch('aether.sdk.cache._is_cacheops_enabled', return_value=False)
+    def test__cache_wrap__lock(self, *args):
+        django_cache.clear()
+        self.addCleanup(django_cache.clear)
+        calls = []
+
+        @cache.cache_wrap(timeout=10, lock=True)
+        def get_token(realm):
+            calls.append(realm)
+            return len(calls)
+
+        lock_key = cache._lock_key(f'{__name__}.{get_token.__qualname__}', ('realm',), {})
+        django_cache.add(lock_key, 1)
+
+        # another caller is computing it, waits for it
+        def computed(seconds):
+            get_token.cache.set(cache._make_key(('realm',), {}), (10, time.time(), 0))
+            django_cache.delete(lock_key)
+
+        with mock.patch('aether.sdk.cache.time.sleep', side_effect=computed) as mock_sleep:
+            self.assertEqual(get_token('realm'), 10)
+        mock_sleep.assert_called_once()
+        self.assertEqual(calls, [])
+
+        # the lock is released after storing the value
+        get_token.invalidate('realm')
+        self.assertEqual(get_token('realm'), 1)
+        self.assertEqual(get_token('realm'), 1)
+        self.assertIsNone(django_cache.get(lock_key))
+
+        # does not wait forever, computes it without storing it
+        get_token.invalidate('realm')
+        django_cache.add(lock_key, 1)
+        with override_settings(CACHE_WRAP_LOCK_TIMEOUT=0):
+            self.assertEqual(get_token('realm'), 2)
+            self.assertEqual(get_token('realm'), 3)
+        self.assertEqual(len(get_token.cache), 0)
+
+    def test__run_in_background(self):
+        from aether.sdk.multitenancy.utils import get_routed_realm
+
+        with use_realm('realm-1'):
+            future = cache._run_in_background(get_routed_realm)
+        self.assertEqual(future.result(timeout=5), 'realm-1')
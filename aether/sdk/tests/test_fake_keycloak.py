@@ -0,0 +1,108 @@
+# Copyright (C) 2023 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+
+import base64
+import hashlib
+import hmac
+
+from requests.exceptions import HTTPError
+
+from django.conf import settings
+
+from aether.sdk.auth.keycloak import utils
+from aether.sdk.fake_keycloak import FakeKeycloakServer, benchmark
+from aether.sdk.tests import AetherTestCase
+from aether.sdk.utils import request as exec_request
+
+REALM = 'testing'
+
+
+class FakeKeycloakServerTests(AetherTestCase):
+
+    def test__server(self):
+        with FakeKeycloakServer(realms=[REALM], users={'user': 'secret'}) as server:
+            self.assertEqual(utils._KC_URL, server.url)
+
+            # realms
+            utils.check_realm(REALM)
+            with self.assertRaises(HTTPError):
+                utils.check_realm('fake')
+
+            # login
+            with self.assertRaises(HTTPError):
+                utils._authenticate(REALM, {'grant_type': 'password', 'username': 'user'})
+            token, userinfo = utils._authenticate(REALM, {
+                'grant_type': 'password',
+                'username': 'user',
+                'password': 'secret',
+            })
+            self.assertEqual(userinfo['preferred_username'], 'user')
+            self.assertEqual(userinfo['email'], 'user@testing.example.com')
+
+            # the tokens are realm dependent
+            with self.assertRaises(HTTPError):
+                utils._get_user_info('fake', token['access_token'])
+            server.realms.append('other')
+            with self.assertRaises(HTTPError):
+                utils._get_user_info('other', token['access_token'])
+            # and type dependent
+            with self.assertRaises(HTTPError):
+                utils._get_user_info(REALM, token['refresh_token'])
+
+            # refresh
+            response = utils.refresh_kc_token(REALM, token)
+            self.assertEqual(response.status_code, 200)
+            new_token = response.json()
+            self.assertNotEqual(new_token['access_token'], token['access_token'])
+
+            # logout
+            self.assertTrue(utils.logout_kc_token(REALM, token['refresh_token']))
+            self.assertEqual(utils.refresh_kc_token(REALM, token).status_code, 401)
+            with self.assertRaises(HTTPError):
+                utils._get_user_info(REALM, token['access_token'])
+            # the new session is still valid
+            utils._get_user_info(REALM, new_token['access_token'])
+
+            # signed JWT
+            jwks = exec_request(
+                method='get',
+                url=f'{server.url}/{REALM}/protocol/openid-connect/certs',
+            ).json()
+            key = jwks['keys'][0]
+            self.assertEqual(key['alg'], 'HS256')
+            secret = base64.urlsafe_b64decode(key['k'] + '=' * (-len(key['k']) % 4))
+            header, payload, signature = new_token['access_token'].split('.')
+            expected = base64.urlsafe_b64encode(
+                hmac.new(secret, f'{header}.{payload}'.encode(), hashlib.sha256).digest()
+            ).rstrip(b'=').decode()
+            self.assertEqual(signature, expected)
+
+            self.assertEqual(server.requests[0], ('HEAD', f'/{REALM}/account'))
+
+        self.assertEqual(utils._KC_URL, settings.KEYCLOAK_SERVER_URL)
+
+    def test__server__latency(self):
+        with FakeKeycloakServer(latency=0.05) as server:
+            token = server.issue_token(REALM, 'user')
+            stats = benchmark(lambda: utils._get_user_info(REALM, token['access_token']),
+                              iterations=3, warmup=0)
+
+        self.assertEqual(stats['iterations'], 3)
+        self.assertGreaterEqual(stats['p50'], 50)
+        self.assertLess(stats['rps'], 20)
@@ -70,13 +70,15 @@ def find_in_request(request, key, default_value=None):
     https://docs.djangoproject.com/en/3.2/ref/request-response/#django.http.HttpRequest.COOKIES
     '''
 
-    return getattr(request, 'session', {}).get(
-        key,
-        getattr(request, 'COOKIES', {}).get(
-            key,
-            find_in_request_headers(request, key, default_value)
-        )
-    )
+    session = getattr(request, 'session', {})
+    if key in session:
+        return session[key]
+
+    cookies = getattr(request, 'COOKIES', {})
+    if key in cookies:
+        return cookies[key]
+
+    return find_in_request_headers(request, key, default_value)
 
 
 def find_in_request_headers(request, key, default_value=None):
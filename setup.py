@@ -49,7 +49,7 @@ setup(
     author_email='info@ehealthafrica.org',
     license='Apache2 License',
 
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=[
         'django<4',
         'django-cors-headers',